@@ -0,0 +1,2566 @@
+#!/usr/bin/env python3
+"""
+Color labels shared by the Nautilus and Nemo extensions, and their command line
+Label storage, the index of labelled files, caches and background jobs. Only
+Gio and GLib are imported, so the command line runs without a file manager:
+    python3 color_labels_core.py list -r ~/Pictures
+Place next to the extension, in ~/.local/share/nautilus-python/extensions or
+~/.local/share/nemo-python/extensions.
+"""
+import os
+import re
+import sys
+import json
+import fnmatch
+import mmap
+import errno
+import time
+import struct
+import zlib
+import sqlite3
+import threading
+import argparse
+import subprocess
+import select
+import ctypes
+import ctypes.util
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from abc import ABC, abstractmethod
+from itertools import chain
+from pathlib import Path
+from gi.repository import Gio, GLib
+
+# Label colors, in palette order
+PALETTE = {
+    'blueberry': {
+        'name': 'Blueberry',
+        'emoji': '🔵',
+        'hex': '#3689e6',
+        'emblem': 'label-blueberry'
+    },
+    'mint': {
+        'name': 'Mint',
+        'emoji': '🟢',
+        'hex': '#28bca3',
+        'emblem': 'label-mint'
+    },
+    'banana': {
+        'name': 'Banana',
+        'emoji': '🟡',
+        'hex': '#f9c440',
+        'emblem': 'label-banana'
+    },
+    'orange': {
+        'name': 'Orange',
+        'emoji': '🟠',
+        'hex': '#ffa154',
+        'emblem': 'label-orange'
+    },
+    'strawberry': {
+        'name': 'Strawberry',
+        'emoji': '🔴',
+        'hex': '#ed5353',
+        'emblem': 'label-strawberry'
+    },
+    'grape': {
+        'name': 'Grape',
+        'emoji': '🟣',
+        'hex': '#a56de2',
+        'emblem': 'label-grape'
+    },
+    'cocoa': {
+        'name': 'Cocoa',
+        'emoji': '🟤',
+        'hex': '#8a715e',
+        'emblem': 'label-cocoa'
+    },
+    'slate': {
+        'name': 'Slate',
+        'emoji': '⚪',
+        'hex': '#667885',
+        'emblem': 'label-slate'
+    }
+}
+
+# Where labels are stored: 'gvfs' (metadata::emblems), 'xattr' (user.xdg.tags) or 'sqlite'
+DEFAULT_BACKEND = 'gvfs'
+
+# Label attributes read by the gvfs backend, by priority
+LABEL_ATTRIBUTES = ('metadata::emblems',)
+
+def get_emblems_from_info(info, attributes=LABEL_ATTRIBUTES):
+    """Return the emblems stored in a Gio.FileInfo, as a list"""
+    # The first attribute holding emblems wins
+    for attribute in attributes:
+        try:
+            if info.get_attribute_type(attribute) == Gio.FileAttributeType.STRINGV:
+                emblems = info.get_attribute_stringv(attribute) or []
+            else:
+                # Single emblem string, as written by earlier versions
+                emblem = info.get_attribute_as_string(attribute)
+                emblems = [emblem.strip()] if emblem and emblem.strip() else []
+        except Exception:
+            emblems = []
+        if emblems:
+            return list(emblems)
+    return []
+
+# Marks a label that must be read from metadata before writing
+UNKNOWN_LABEL = object()
+
+class LabelSet:
+    """Labels of a file as a bitmask over the palette, bit n being the n-th color
+
+    Masks are what caches and the index keep. Metadata holds the emblem names
+    of the set bits, always in palette order, so a set of labels has a single
+    stored form. A lone emblem, as written before files could carry several
+    labels, reads as a set of one.
+    """
+
+    SEPARATOR = ','
+
+    def __init__(self, emblems):
+        self.emblems = tuple(dict.fromkeys(emblems))
+        self.bits = {emblem: 1 << number for number, emblem in enumerate(self.emblems)}
+        # Mask with every label
+        self.all = (1 << len(self.emblems)) - 1
+
+    def from_emblems(self, emblems):
+        """Return the mask of emblem names, ignoring the ones which aren't labels"""
+        mask = 0
+        for emblem in emblems:
+            mask |= self.bits.get(emblem, 0)
+        return mask
+
+    def to_emblems(self, mask):
+        """Return the emblem names of a mask, in palette order"""
+        if not mask:
+            return []
+        return [emblem for emblem in self.emblems if mask & self.bits[emblem]]
+
+    def serialize(self, mask):
+        """Return the stored form of a mask, empty without label"""
+        return self.SEPARATOR.join(self.to_emblems(mask))
+
+    def parse(self, value):
+        """Return the mask of a stored form, a single emblem included"""
+        if not value:
+            return 0
+        return self.from_emblems(emblem.strip() for emblem in value.split(self.SEPARATOR))
+
+    @staticmethod
+    def split(mask):
+        """Return the masks of the single labels of a mask, lowest bit first"""
+        singles = []
+        while mask:
+            single = mask & -mask
+            singles.append(single)
+            mask ^= single
+        return singles
+
+    @staticmethod
+    def matches(mask, all_of=0, any_of=0):
+        """Tell whether a mask has every label of all_of and, if given, one of any_of"""
+        return (mask & all_of) == all_of and (not any_of or (mask & any_of) != 0)
+
+class LabelBackend(ABC):
+    """Base class of label storages, labels are handled as LabelSet masks
+
+    read(), read_directory() and write() are synchronous and safe to call from
+    worker threads, and every backend must implement them. The asynchronous
+    variants call back in the main loop; by default they run the synchronous
+    ones on a small shared thread pool.
+    """
+
+    name = None
+    executor = None
+
+    def __init__(self, label_emblems):
+        # Emblem names known as labels, in palette order
+        self.labels = LabelSet(label_emblems)
+        self.label_emblems = set(self.labels.emblems)
+
+    @abstractmethod
+    def read(self, file_path):
+        """Return the label mask of a file, 0 without label"""
+
+    @abstractmethod
+    def read_directory(self, directory):
+        """Return {child name: label mask} for every child of a directory"""
+
+    @abstractmethod
+    def write(self, file_path, mask):
+        """Store the labels of a file (0 removes them), returns True on success"""
+
+    def write_many(self, changes):
+        """Store (file path, label mask) changes, returns a success flag per change"""
+        return [self.write(file_path, mask) for file_path, mask in changes]
+
+    def read_tree(self, directory):
+        """Yield (file path, label mask) for every labelled file below a directory"""
+        for root, dirs, files in os.walk(directory):
+            try:
+                snapshot = self.read_directory(root)
+            except Exception as e:
+                print(f"Error reading labels: {e}")
+                continue
+            for name, mask in snapshot.items():
+                if mask:
+                    yield os.path.join(root, name), mask
+
+    def run_in_thread(self, function, callback, cancellable=None):
+        """Run function in the thread pool, then callback(result, error) in the main loop"""
+        if LabelBackend.executor is None:
+            LabelBackend.executor = ThreadPoolExecutor(
+                max_workers=2,
+                thread_name_prefix='color-labels-read'
+            )
+
+        def task():
+            if cancellable is not None and cancellable.is_cancelled():
+                return
+            try:
+                result, error = function(), None
+            except FileNotFoundError:
+                result, error = 0, None
+            except Exception as e:
+                result, error = None, e
+            GLib.idle_add(lambda: callback(result, error) and False)
+
+        LabelBackend.executor.submit(task)
+
+    def read_async(self, file_path, cancellable, callback):
+        """Read labels, then callback(mask, error) in the main loop"""
+        self.run_in_thread(lambda: self.read(file_path), callback, cancellable)
+
+    def read_directory_async(self, directory, callback):
+        """Read a directory, then callback(snapshot or None) in the main loop"""
+        self.run_in_thread(
+            lambda: self.read_directory(directory),
+            lambda snapshot, error: callback(None if error else snapshot)
+        )
+
+class GvfsMetadataBackend(LabelBackend):
+    """Labels in gvfs metadata::emblems, shared with Nautilus, Nemo and Folder Color"""
+
+    name = 'gvfs'
+    # Label attributes by priority, the first one is written and the others cleared
+    ATTRIBUTES = LABEL_ATTRIBUTES
+    # Children fetched per asynchronous enumeration step
+    BATCH_SIZE = 1000
+
+    def __init__(self, label_emblems):
+        super().__init__(label_emblems)
+        self.reader = GvfsMetadataReader(
+            keys=[attribute.split('::', 1)[1] for attribute in self.ATTRIBUTES]
+        )
+
+    def get_attributes(self, file_path):
+        """Return the label attributes to read for a file"""
+        return self.ATTRIBUTES
+
+    def read(self, file_path):
+        attributes = self.get_attributes(os.path.abspath(file_path))
+        info = Gio.File.new_for_path(file_path).query_info(
+            ','.join(attributes),
+            Gio.FileQueryInfoFlags.NONE,
+            None
+        )
+        return self.labels.from_emblems(get_emblems_from_info(info, attributes))
+
+    def read_directory(self, directory):
+        snapshot = {}
+        attributes = self.get_attributes(os.path.abspath(directory))
+        enumerator = Gio.File.new_for_path(directory).enumerate_children(
+            'standard::name,' + ','.join(attributes),
+            Gio.FileQueryInfoFlags.NONE,
+            None
+        )
+        while True:
+            info = enumerator.next_file(None)
+            if info is None:
+                break
+            emblems = get_emblems_from_info(info, attributes)
+            snapshot[info.get_name()] = self.labels.from_emblems(emblems)
+        enumerator.close(None)
+        return snapshot
+
+    def write(self, file_path, mask):
+        try:
+            info = Gio.FileInfo()
+            emblems = self.labels.to_emblems(mask)
+            if emblems:
+                info.set_attribute_stringv('metadata::emblems', emblems)
+            else:
+                info.set_attribute_string('metadata::emblems', '')
+            # Clear the fallback attributes in the same write
+            for attribute in self.get_attributes(os.path.abspath(file_path))[1:]:
+                info.set_attribute_string(attribute, '')
+            file = Gio.File.new_for_path(file_path)
+            file.set_attributes_from_info(info, Gio.FileQueryInfoFlags.NONE, None)
+            return True
+        except Exception as e:
+            print(f"Failed to set emblem metadata: {e}")
+            return False
+
+    def read_tree(self, directory):
+        # Read the metadata database directly when possible
+        if not self.reader.supports(directory):
+            yield from super().read_tree(directory)
+            return
+        for file_path, emblems in self.reader.read_subtree(directory):
+            mask = self.labels.from_emblems(emblems)
+            if mask:
+                yield file_path, mask
+
+    def read_async(self, file_path, cancellable, callback):
+        attributes = self.get_attributes(os.path.abspath(file_path))
+        Gio.File.new_for_path(file_path).query_info_async(
+            ','.join(attributes),
+            Gio.FileQueryInfoFlags.NONE,
+            GLib.PRIORITY_LOW,
+            cancellable,
+            self.on_info_ready,
+            (attributes, callback)
+        )
+
+    def on_info_ready(self, file_gio, result, data):
+        """Hand the labels of an asynchronous query over to the caller"""
+        attributes, callback = data
+        try:
+            info = file_gio.query_info_finish(result)
+        except GLib.Error as e:
+            # Files removed in the meantime simply have no label
+            if e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.NOT_FOUND):
+                callback(0, None)
+            else:
+                callback(None, e)
+            return
+        callback(self.labels.from_emblems(get_emblems_from_info(info, attributes)), None)
+
+    def read_directory_async(self, directory, callback):
+        attributes = self.get_attributes(os.path.abspath(directory))
+        Gio.File.new_for_path(directory).enumerate_children_async(
+            'standard::name,' + ','.join(attributes),
+            Gio.FileQueryInfoFlags.NONE,
+            GLib.PRIORITY_LOW,
+            None,
+            self.on_enumerator_ready,
+            ({}, attributes, callback)
+        )
+
+    def on_enumerator_ready(self, directory_gio, result, data):
+        """Start reading children once the enumerator is open"""
+        snapshot, attributes, callback = data
+        try:
+            enumerator = directory_gio.enumerate_children_finish(result)
+        except GLib.Error as e:
+            print(f"Error prefetching emblems: {e}")
+            callback(None)
+            return
+
+        enumerator.next_files_async(
+            self.BATCH_SIZE,
+            GLib.PRIORITY_LOW,
+            None,
+            self.on_children_ready,
+            data
+        )
+
+    def on_children_ready(self, enumerator, result, data):
+        """Collect a batch of children and continue until the directory is exhausted"""
+        snapshot, attributes, callback = data
+        try:
+            infos = enumerator.next_files_finish(result)
+        except GLib.Error as e:
+            print(f"Error prefetching emblems: {e}")
+            enumerator.close_async(GLib.PRIORITY_LOW, None, None, None)
+            callback(None)
+            return
+
+        if not infos:
+            enumerator.close_async(GLib.PRIORITY_LOW, None, None, None)
+            callback(snapshot)
+            return
+
+        for info in infos:
+            snapshot[info.get_name()] = self.labels.from_emblems(get_emblems_from_info(info, attributes))
+
+        enumerator.next_files_async(
+            self.BATCH_SIZE,
+            GLib.PRIORITY_LOW,
+            None,
+            self.on_children_ready,
+            data
+        )
+
+class XattrBackend(LabelBackend):
+    """Labels in the user.xdg.tags extended attribute, kept by cp -a, tar and rsync -X"""
+
+    name = 'xattr'
+    ATTRIBUTE = 'user.xdg.tags'
+
+    def read_tags(self, file_path):
+        """Return the list of XDG tags of a file"""
+        try:
+            value = os.getxattr(file_path, self.ATTRIBUTE)
+        except OSError as e:
+            if e.errno in (errno.ENODATA, errno.ENOTSUP):
+                return []
+            raise
+        return [tag.strip() for tag in value.decode('utf-8', 'replace').split(',') if tag.strip()]
+
+    def read(self, file_path):
+        return self.labels.from_emblems(self.read_tags(file_path))
+
+    def read_directory(self, directory):
+        snapshot = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    snapshot[entry.name] = self.read(entry.path)
+                except OSError:
+                    snapshot[entry.name] = 0
+        return snapshot
+
+    def write(self, file_path, mask):
+        try:
+            # Keep tags set by other applications
+            tags = [tag for tag in self.read_tags(file_path) if tag not in self.label_emblems]
+            tags.extend(self.labels.to_emblems(mask))
+            if tags:
+                os.setxattr(file_path, self.ATTRIBUTE, ','.join(tags).encode('utf-8'))
+            else:
+                try:
+                    os.removexattr(file_path, self.ATTRIBUTE)
+                except OSError as e:
+                    if e.errno != errno.ENODATA:
+                        raise
+            return True
+        except Exception as e:
+            print(f"Failed to set label attribute: {e}")
+            return False
+
+class SQLiteBackend(LabelBackend):
+    """Labels in a local SQLite database, independent from the file system"""
+
+    name = 'sqlite'
+    DATABASE = Path.home() / '.local' / 'share' / 'color-labels' / 'labels.sqlite'
+
+    def __init__(self, label_emblems, database=None):
+        super().__init__(label_emblems)
+        database = Path(database) if database else self.DATABASE
+        database.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(database), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS labels ('
+                'path TEXT PRIMARY KEY, parent TEXT NOT NULL, emblem TEXT NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS labels_parent ON labels (parent)'
+            )
+
+    def read(self, file_path):
+        file_path = os.path.abspath(file_path)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT emblem FROM labels WHERE path = ?', (file_path,)
+            ).fetchone()
+        return self.labels.parse(row[0]) if row else 0
+
+    def read_directory(self, directory):
+        directory = os.path.abspath(directory)
+        snapshot = {name: 0 for name in os.listdir(directory)}
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT path, emblem FROM labels WHERE parent = ?', (directory,)
+            ).fetchall()
+        for file_path, value in rows:
+            name = os.path.basename(file_path)
+            if name in snapshot:
+                snapshot[name] = self.labels.parse(value)
+        return snapshot
+
+    def write(self, file_path, mask):
+        file_path = os.path.abspath(file_path)
+        # Stored as emblem names, like the other storages
+        value = self.labels.serialize(mask)
+        try:
+            with self.lock, self.connection:
+                if value:
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO labels (path, parent, emblem) VALUES (?, ?, ?)',
+                        (file_path, os.path.dirname(file_path), value)
+                    )
+                else:
+                    self.connection.execute('DELETE FROM labels WHERE path = ?', (file_path,))
+            return True
+        except Exception as e:
+            print(f"Failed to store label: {e}")
+            return False
+
+    def write_many(self, changes):
+        # One transaction for the whole batch
+        stored = []
+        removed = []
+        for file_path, mask in changes:
+            file_path = os.path.abspath(file_path)
+            if mask:
+                stored.append((file_path, os.path.dirname(file_path), self.labels.serialize(mask)))
+            else:
+                removed.append((file_path,))
+        try:
+            with self.lock, self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO labels (path, parent, emblem) VALUES (?, ?, ?)', stored
+                )
+                self.connection.executemany('DELETE FROM labels WHERE path = ?', removed)
+            return [True] * len(changes)
+        except Exception as e:
+            print(f"Failed to store labels: {e}")
+            return [False] * len(changes)
+
+    def read_tree(self, directory):
+        directory = os.path.abspath(directory).rstrip('/')
+        # Every path below "dir/" sorts before "dir0", the character after '/'
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT path, emblem FROM labels WHERE path >= ? AND path < ?',
+                (directory + '/', directory + '0')
+            ).fetchall()
+        return ((file_path, self.labels.parse(value)) for file_path, value in rows)
+
+# Available label storages, by name
+LABEL_BACKENDS = {
+    backend.name: backend
+    for backend in (GvfsMetadataBackend, XattrBackend, SQLiteBackend)
+}
+
+class DirectoryEmblemPrefetcher:
+    """Answer label lookups from a single read of the parent directory"""
+
+    # Number of directory snapshots kept in memory
+    MAX_DIRECTORIES = 16
+    # Seconds before a snapshot is considered stale and read again
+    SNAPSHOT_LIFETIME = 30
+
+    def __init__(self, backend):
+        self.backend = backend
+        # directory path -> (load time, {child name: labels})
+        self.snapshots = OrderedDict()
+        # directory path -> [(child name, callback)] waiting for a directory read
+        self.waiters = {}
+
+    def get_snapshot(self, directory):
+        """Return the fresh snapshot of a directory, or None"""
+        entry = self.snapshots.get(directory)
+        if entry is None:
+            return None
+
+        loaded_at, snapshot = entry
+        if time.monotonic() - loaded_at > self.SNAPSHOT_LIFETIME:
+            del self.snapshots[directory]
+            return None
+
+        self.snapshots.move_to_end(directory)
+        return snapshot
+
+    def store_snapshot(self, directory, snapshot):
+        """Keep a directory snapshot, dropping the least recently used ones"""
+        self.snapshots[directory] = (time.monotonic(), snapshot)
+        self.snapshots.move_to_end(directory)
+        while len(self.snapshots) > self.MAX_DIRECTORIES:
+            self.snapshots.popitem(last=False)
+
+    def peek(self, file_path):
+        """Return (found, labels) from an existing snapshot, or None if not loaded"""
+        directory, name = os.path.split(file_path)
+        snapshot = self.get_snapshot(directory)
+        if snapshot is None:
+            return None
+        if name not in snapshot:
+            # Created after the directory was read, must be queried on its own
+            return (False, None)
+        return (True, snapshot[name])
+
+    def lookup(self, file_path):
+        """Return (found, labels), reading the parent directory on first use"""
+        result = self.peek(file_path)
+        if result is not None:
+            return result
+
+        directory = os.path.dirname(file_path)
+        try:
+            snapshot = self.backend.read_directory(directory)
+        except Exception as e:
+            print(f"Error prefetching labels: {e}")
+            return (False, None)
+
+        self.store_snapshot(directory, snapshot)
+        return self.peek(file_path) or (False, None)
+
+    def request(self, file_path, callback):
+        """Call callback(found, labels) once the parent directory is read"""
+        directory, name = os.path.split(file_path)
+        waiters = self.waiters.get(directory)
+        if waiters is not None:
+            # Read already running for this directory
+            waiters.append((name, callback))
+            return
+
+        self.waiters[directory] = [(name, callback)]
+        self.backend.read_directory_async(
+            directory,
+            lambda snapshot: self.finish_request(directory, snapshot)
+        )
+
+    def finish_request(self, directory, snapshot):
+        """Answer every lookup waiting on a directory read"""
+        if snapshot is not None:
+            self.store_snapshot(directory, snapshot)
+
+        for name, callback in self.waiters.pop(directory, []):
+            if snapshot is not None and name in snapshot:
+                callback(True, snapshot[name])
+            else:
+                callback(False, None)
+
+    def update(self, file_path, labels):
+        """Keep an existing snapshot in sync after a label change"""
+        directory, name = os.path.split(file_path)
+        entry = self.snapshots.get(directory)
+        if entry is not None:
+            entry[1][name] = labels
+
+    def forget(self, file_path):
+        """Drop a child from its directory snapshot so it is queried again"""
+        directory, name = os.path.split(file_path)
+        entry = self.snapshots.get(directory)
+        if entry is not None:
+            entry[1].pop(name, None)
+
+class LabelCache:
+    """Bounded LRU cache of file labels, invalidated by directory monitors"""
+
+    # Default number of files kept in the cache
+    MAX_ENTRIES = 50000
+    # Number of directories watched for changes
+    MAX_DIRECTORIES = 64
+
+    def __init__(self, max_entries=None, on_change=None):
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        # Called with the path of every file reported by a directory monitor
+        self.on_change = on_change
+        # file path -> (inode, mtime, labels)
+        self.entries = OrderedDict()
+        # directory path -> (Gio.FileMonitor, set of cached child paths)
+        self.directories = OrderedDict()
+
+    def get(self, file_path):
+        """Return (found, labels) for a file whose inode and mtime did not change"""
+        entry = self.entries.get(file_path)
+        if entry is None:
+            return (False, None)
+
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            self.invalidate(file_path)
+            return (False, None)
+
+        inode, mtime, labels = entry
+        if (st.st_ino, st.st_mtime_ns) != (inode, mtime):
+            self.invalidate(file_path)
+            return (False, None)
+
+        self.entries.move_to_end(file_path)
+        return (True, labels)
+
+    def put(self, file_path, labels):
+        """Remember the labels of a file, keyed on its current inode and mtime"""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return
+
+        directory = os.path.dirname(file_path)
+        if not self.watch(directory):
+            return
+
+        self.entries[file_path] = (st.st_ino, st.st_mtime_ns, labels)
+        self.entries.move_to_end(file_path)
+        self.directories[directory][1].add(file_path)
+
+        while len(self.entries) > self.max_entries:
+            old_path, _ = self.entries.popitem(last=False)
+            old_directory = self.directories.get(os.path.dirname(old_path))
+            if old_directory:
+                old_directory[1].discard(old_path)
+
+    def watch(self, directory):
+        """Make sure a directory is monitored, evicting the least recently used watch"""
+        if directory in self.directories:
+            self.directories.move_to_end(directory)
+            return True
+
+        try:
+            monitor = Gio.File.new_for_path(directory).monitor_directory(
+                Gio.FileMonitorFlags.NONE,
+                None
+            )
+            monitor.connect('changed', self.on_directory_changed)
+        except Exception as e:
+            print(f"Failed to monitor directory: {e}")
+            return False
+
+        self.directories[directory] = (monitor, set())
+        while len(self.directories) > self.MAX_DIRECTORIES:
+            self.forget_directory(next(iter(self.directories)))
+        return True
+
+    def forget_directory(self, directory):
+        """Stop watching a directory and drop its entries, which can't be trusted anymore"""
+        monitor, paths = self.directories.pop(directory)
+        monitor.cancel()
+        for file_path in paths:
+            self.entries.pop(file_path, None)
+
+    def on_directory_changed(self, monitor, file, other_file, event_type):
+        """Drop entries of files changed, moved or removed behind our back"""
+        for changed in (file, other_file):
+            if changed is None:
+                continue
+            file_path = changed.get_path()
+            if file_path:
+                self.invalidate(file_path)
+                if self.on_change:
+                    self.on_change(file_path)
+
+    def invalidate(self, file_path):
+        """Forget the cached labels of a file"""
+        if self.entries.pop(file_path, None) is not None:
+            directory = self.directories.get(os.path.dirname(file_path))
+            if directory:
+                directory[1].discard(file_path)
+
+class GvfsMetadataReader:
+    """Read labels straight from the gvfs metadata database, without the daemon
+
+    The tree file and its journal are memory-mapped and parsed in place, so a
+    whole subtree is read in one pass. Like the other label sources, lookup()
+    answers (found, emblems); found is False when the database can't be used.
+    gvfs keeps one tree per mount: "home" for the home directory, "root" for
+    the mount on /, "uuid-<UUID>" or "label-<LABEL>" for other devices.
+    """
+
+    DIRECTORY = Path.home() / '.local' / 'share' / 'gvfs-metadata'
+    # Device links naming the uuid- and label- trees, as udev exposes them to gvfs
+    DEVICE_LINKS = (('uuid-', '/dev/disk/by-uuid'), ('label-', '/dev/disk/by-label'))
+    # Default metadata keys holding the label, by priority (without the metadata:: prefix)
+    KEYS = ('emblems',)
+
+    TREE_MAGIC = b'\xda\x1ameta'
+    JOURNAL_MAGIC = b'\xda\x1ajour'
+    # MetaJournalHeader: magic, major, minor, random tag, file size, number of entries
+    JOURNAL_HEADER = struct.Struct('>6sBBIII')
+    # sizeof(MetaJournalEntry): size, crc32, mtime, type and a path, padded to 8 bytes
+    JOURNAL_ENTRY_MIN_SIZE = 24
+    KEY_IS_LIST = 1 << 31
+    # Journal operations
+    SET_KEY, SETV_KEY, UNSET_KEY, COPY_PATH, REMOVE_PATH = range(5)
+
+    def __init__(self, directory=None, keys=None):
+        self.directory = Path(directory) if directory else self.DIRECTORY
+        self.home = os.path.realpath(Path.home())
+        self.keys = tuple(keys) if keys else self.KEYS
+        # device -> mount point, and device -> tree name or None
+        self.mount_points = {}
+        self.device_trees = {}
+
+    def locate(self, file_path):
+        """Return (tree name, mount point, path inside the tree), the tree name is
+        None when gvfs keeps no tree for the mount of the file
+        """
+        directory, name = os.path.split(os.path.abspath(file_path))
+        file_path = os.path.join(os.path.realpath(directory), name)
+        tree_name, mount_point = self.find_tree(file_path)
+        if tree_name is None:
+            return None, None, None
+        if mount_point == '/':
+            return tree_name, mount_point, file_path
+        return tree_name, mount_point, file_path[len(mount_point):] or '/'
+
+    def find_tree(self, file_path):
+        """Return (tree name, mount point) the way gvfs picks the tree of a file"""
+        device = self.get_device(file_path)
+        if device is None:
+            return None, None
+        if (file_path == self.home or file_path.startswith(self.home + os.sep)) \
+                and device == self.get_device(self.home):
+            return 'home', self.home
+
+        mount_point = self.get_mount_point(file_path, device)
+        if mount_point == '/':
+            return 'root', mount_point
+        if device not in self.device_trees:
+            self.device_trees[device] = self.get_device_tree(device)
+        return self.device_trees[device], mount_point
+
+    def get_device(self, file_path):
+        """Return the device of a file, or of its closest existing parent"""
+        while True:
+            try:
+                return os.stat(file_path).st_dev
+            except OSError:
+                if file_path in ('', '/'):
+                    return None
+                file_path = os.path.dirname(file_path)
+
+    def get_mount_point(self, file_path, device):
+        """Return the topmost parent of a file on the same device"""
+        mount_point = self.mount_points.get(device)
+        if mount_point and (file_path + '/').startswith(mount_point.rstrip('/') + '/'):
+            return mount_point
+
+        mount_point = file_path
+        while mount_point != '/':
+            parent = os.path.dirname(mount_point)
+            if self.get_device(parent) != device:
+                break
+            mount_point = parent
+        self.mount_points[device] = mount_point
+        return mount_point
+
+    def get_device_tree(self, device):
+        """Return "uuid-<UUID>" or "label-<LABEL>" for a block device, or None"""
+        for prefix, links in self.DEVICE_LINKS:
+            try:
+                names = sorted(os.listdir(links))
+            except OSError:
+                continue
+            for name in names:
+                try:
+                    if os.stat(os.path.join(links, name)).st_rdev == device:
+                        return prefix + name
+                except OSError:
+                    continue
+        return None
+
+    def lookup(self, file_path):
+        """Return (found, emblems) for a single file"""
+        tree_name, mount_point, tree_path = self.locate(file_path)
+        state = self.open(tree_name) if tree_name else None
+        if state is None:
+            return (False, None)
+
+        tree, overlay, removed = state
+        try:
+            values = {}
+            if not self.is_removed(tree_path, removed):
+                dirent = self.find_dirent(tree, tree_path)
+                if dirent is not None:
+                    values = self.read_values(tree, dirent)
+            values.update(overlay.get(tree_path, {}))
+            return (True, self.pick_emblems(values))
+        finally:
+            tree['map'].close()
+
+    def read_subtree(self, directory):
+        """Yield (file path, emblems) for every file with emblems below a directory"""
+        tree_name, mount_point, tree_root = self.locate(directory)
+        state = self.open(tree_name) if tree_name else None
+        if state is None:
+            return
+
+        tree, overlay, removed = state
+        prefix = '' if mount_point == '/' else mount_point
+        root_prefix = tree_root.rstrip('/') + '/'
+        try:
+            seen = set()
+            dirent = self.find_dirent(tree, tree_root)
+            if dirent is not None:
+                for tree_path, values in self.walk(tree, dirent, tree_root):
+                    if removed and self.is_removed(tree_path, removed):
+                        values = {}
+                    if tree_path in overlay:
+                        values.update(overlay[tree_path])
+                        seen.add(tree_path)
+                    emblems = self.pick_emblems(values)
+                    if emblems:
+                        yield (prefix + tree_path if tree_path != '/' else prefix or '/', emblems)
+
+            # Files only known from the journal
+            for tree_path, values in overlay.items():
+                if tree_path in seen or not (tree_path + '/').startswith(root_prefix):
+                    continue
+                emblems = self.pick_emblems(values)
+                if emblems:
+                    yield (prefix + tree_path, emblems)
+        finally:
+            tree['map'].close()
+
+    def supports(self, directory):
+        """Tell whether the database holding a directory can be read directly"""
+        tree_name = self.locate(directory)[0]
+        tree = self.open_tree(tree_name) if tree_name else None
+        if tree is None:
+            return False
+        tree['map'].close()
+        return True
+
+    def pick_emblems(self, values):
+        """Return the emblems among the values of a file, as a list"""
+        for key in self.keys:
+            value = values.get(key)
+            if isinstance(value, str):
+                value = [value]
+            if value:
+                return list(value)
+        return []
+
+    def open(self, tree_name):
+        """Map a tree and replay its journal, returns (tree, overlay, removed) or None"""
+        tree = self.open_tree(tree_name)
+        if tree is None:
+            return None
+        try:
+            overlay, removed = self.read_journal(tree, tree_name)
+        except Exception as e:
+            print(f"Error reading metadata journal: {e}")
+            tree['map'].close()
+            return None
+        return tree, overlay, removed
+
+    def open_tree(self, tree_name):
+        """Map a tree file and index the keys we are interested in"""
+        try:
+            with open(self.directory / tree_name, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            if data[:6] != self.TREE_MAGIC or data[6] != 1 or data[7] != 0:
+                raise ValueError('unsupported tree format')
+            rotated, tag, root, attributes = struct.unpack_from('>IIII', data, 8)
+
+            keys = {}
+            for i in range(self.u32(data, attributes)):
+                name = self.read_string(data, self.u32(data, attributes + 4 + 4 * i))
+                if name in self.keys:
+                    keys[i] = name
+            return {'map': data, 'tag': tag, 'root': root, 'keys': keys}
+
+        except Exception as e:
+            print(f"Error reading metadata tree: {e}")
+            data.close()
+            return None
+
+    def u32(self, data, offset):
+        """Read a big-endian 32 bits integer"""
+        return struct.unpack_from('>I', data, offset)[0]
+
+    def read_string(self, data, offset):
+        """Read a NUL-terminated string"""
+        end = data.find(b'\0', offset)
+        if end < 0:
+            raise ValueError('unterminated string')
+        return data[offset:end].decode('utf-8', 'surrogateescape')
+
+    def find_child(self, tree, dirent, name):
+        """Binary search a child entry by name, entries are sorted by strcmp"""
+        data = tree['map']
+        children = self.u32(data, dirent + 4)
+        if not children:
+            return None
+
+        wanted = name.encode('utf-8', 'surrogateescape')
+        low, high = 0, self.u32(data, children)
+        while low < high:
+            middle = (low + high) // 2
+            entry = children + 4 + 16 * middle
+            name_offset = self.u32(data, entry)
+            candidate = data[name_offset:data.find(b'\0', name_offset)]
+            if candidate == wanted:
+                return entry
+            if candidate < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def find_dirent(self, tree, tree_path):
+        """Return the offset of the entry for a path, or None"""
+        dirent = tree['root']
+        for name in tree_path.strip('/').split('/'):
+            if not name:
+                continue
+            dirent = self.find_child(tree, dirent, name)
+            if dirent is None:
+                return None
+        return dirent
+
+    def read_values(self, tree, dirent):
+        """Return {key: value} of the interesting keys stored on an entry"""
+        data = tree['map']
+        values = {}
+        metadata = self.u32(data, dirent + 8)
+        if not metadata:
+            return values
+
+        for i in range(self.u32(data, metadata)):
+            key, value = struct.unpack_from('>II', data, metadata + 4 + 8 * i)
+            name = tree['keys'].get(key & ~self.KEY_IS_LIST)
+            if name is None:
+                continue
+            if key & self.KEY_IS_LIST:
+                values[name] = [
+                    self.read_string(data, self.u32(data, value + 4 + 4 * j))
+                    for j in range(self.u32(data, value))
+                ]
+            else:
+                values[name] = self.read_string(data, value)
+        return values
+
+    def walk(self, tree, dirent, tree_path):
+        """Yield (path, values) for an entry and all its descendants"""
+        data = tree['map']
+        stack = [(dirent, tree_path.rstrip('/') or '/')]
+        while stack:
+            dirent, path = stack.pop()
+            yield path, self.read_values(tree, dirent)
+
+            children = self.u32(data, dirent + 4)
+            if not children:
+                continue
+            base = '' if path == '/' else path
+            for i in range(self.u32(data, children)):
+                entry = children + 4 + 16 * i
+                name = self.read_string(data, self.u32(data, entry))
+                stack.append((entry, f"{base}/{name}"))
+
+    def is_removed(self, tree_path, removed):
+        """Tell whether a path was removed by the journal after the tree was written"""
+        path = tree_path
+        while True:
+            if path in removed:
+                return True
+            if path in ('', '/'):
+                return False
+            path = path.rsplit('/', 1)[0] or '/'
+
+    def read_journal(self, tree, tree_name):
+        """Replay the journal, returns ({path: {key: value}}, set of removed paths)
+
+        A value of None means the key was unset.
+        """
+        overlay = {}
+        removed = set()
+        journal = self.directory / f"{tree_name}-{tree['tag']:08x}.log"
+        try:
+            with open(journal, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return overlay, removed
+
+        try:
+            if len(data) < self.JOURNAL_HEADER.size:
+                return overlay, removed
+            magic, major, _, tag, _, _ = self.JOURNAL_HEADER.unpack_from(data)
+            if magic != self.JOURNAL_MAGIC or major != 1 or tag != tree['tag']:
+                return overlay, removed
+            for entry_type, path, payload in self.iter_journal(data):
+                if entry_type == self.SET_KEY:
+                    key, end = self.read_journal_string(data, payload)
+                    if key in self.keys:
+                        overlay.setdefault(path, {})[key] = self.read_journal_string(data, end)[0]
+                elif entry_type == self.SETV_KEY:
+                    key, end = self.read_journal_string(data, payload)
+                    if key in self.keys:
+                        end = (end + 3) & ~3
+                        strings = []
+                        offset = end + 4
+                        for _ in range(self.u32(data, end)):
+                            value, offset = self.read_journal_string(data, offset)
+                            strings.append(value)
+                        overlay.setdefault(path, {})[key] = strings
+                elif entry_type == self.UNSET_KEY:
+                    key = self.read_journal_string(data, payload)[0]
+                    if key in self.keys:
+                        overlay.setdefault(path, {})[key] = None
+                elif entry_type == self.REMOVE_PATH:
+                    self.remove_overlay(overlay, path)
+                    removed.add(path)
+                elif entry_type == self.COPY_PATH:
+                    source = self.read_journal_string(data, payload)[0]
+                    self.copy_overlay(tree, overlay, removed, source, path)
+        finally:
+            data.close()
+        return overlay, removed
+
+    def iter_journal(self, data):
+        """Yield (type, path, payload offset) of journal entries, up to the first invalid one"""
+        num_entries = self.JOURNAL_HEADER.unpack_from(data)[5]
+        offset = self.JOURNAL_HEADER.size
+        for _ in range(num_entries):
+            if not self.is_journal_entry(data, offset):
+                return
+            entry_type = data[offset + 16]
+            path, payload = self.read_journal_string(data, offset + 17)
+            yield entry_type, path, payload
+            offset += self.u32(data, offset)
+
+    def is_journal_entry(self, data, offset):
+        """Validate an entry as gvfs does: its size, trailing size and checksum"""
+        if offset + 8 > len(data):
+            return False
+        size, crc = struct.unpack_from('>II', data, offset)
+        if size % 4 or size < self.JOURNAL_ENTRY_MIN_SIZE or size > len(data) - offset:
+            return False
+        if self.u32(data, offset + size - 4) != size:
+            return False
+        # Checksum of the entry after its size and checksum, trailing size included
+        return zlib.crc32(data[offset + 8:offset + size]) == crc
+
+    def read_journal_string(self, data, offset):
+        """Read a string from a journal entry, returns (string, next offset)"""
+        end = data.find(b'\0', offset)
+        return data[offset:end].decode('utf-8', 'surrogateescape'), end + 1
+
+    def remove_overlay(self, overlay, tree_path):
+        """Drop journal values of a removed path and its descendants"""
+        prefix = tree_path.rstrip('/') + '/'
+        for path in [p for p in overlay if p == tree_path or p.startswith(prefix)]:
+            del overlay[path]
+
+    def copy_overlay(self, tree, overlay, removed, source, destination):
+        """Apply a journal copy of a subtree, using tree and journal values of the source"""
+        copied = {}
+        dirent = None if self.is_removed(source, removed) else self.find_dirent(tree, source)
+        if dirent is not None:
+            for path, values in self.walk(tree, dirent, source):
+                if values and not self.is_removed(path, removed):
+                    copied[path] = values
+        prefix = source.rstrip('/') + '/'
+        for path, values in overlay.items():
+            if path == source or path.startswith(prefix):
+                copied.setdefault(path, {}).update(values)
+
+        self.remove_overlay(overlay, destination)
+        removed.add(destination)
+        for path, values in copied.items():
+            overlay[destination.rstrip('/') + path[len(source.rstrip('/')):]] = dict(values)
+
+class LabelIndex:
+    """Persistent index of labelled files, to find every file with some labels at once
+
+    files keeps the LabelSet mask of each file, file_labels one row per label
+    of a file, keyed by (label, path). A search walks the files of one label
+    in file_labels, in path order and within a folder if asked, and tests the
+    masks of those files only, never the whole table.
+    """
+
+    DATABASE = Path.home() / '.local' / 'share' / 'color-labels' / 'index.sqlite'
+
+    def __init__(self, labels, database=None):
+        database = Path(database) if database else self.DATABASE
+        database.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(database))
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(files)')]
+            rows = []
+            if 'emblem' in columns:
+                # Indexed with a single emblem per file, convert to masks
+                rows = [
+                    (file_path, parent, labels.parse(emblem))
+                    for file_path, parent, emblem in self.connection.execute(
+                        'SELECT path, parent, emblem FROM files'
+                    )
+                ]
+                self.connection.execute('DROP TABLE files')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT PRIMARY KEY, parent TEXT NOT NULL, labels INTEGER NOT NULL)'
+            )
+            # Folders are searched as a range of paths, the parent index isn't used
+            self.connection.execute('DROP INDEX IF EXISTS files_parent')
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files (path, parent, labels) VALUES (?, ?, ?)',
+                [row for row in rows if row[2]]
+            )
+            indexed = self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'file_labels'"
+            ).fetchone()
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS file_labels ('
+                'label INTEGER NOT NULL, path TEXT NOT NULL, PRIMARY KEY (label, path)) WITHOUT ROWID'
+            )
+            if not indexed:
+                # Index written before file_labels existed
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO file_labels (label, path) VALUES (?, ?)',
+                    (
+                        (single, file_path)
+                        for file_path, mask in self.connection.execute('SELECT path, labels FROM files').fetchall()
+                        for single in LabelSet.split(mask)
+                    )
+                )
+        # Changes recorded from the file manager, written from an idle callback
+        self.pending = []
+        self.source_id = 0
+
+    def record(self, file_path, mask):
+        """Queue a label change, all changes of a label operation share one transaction"""
+        self.pending.append((file_path, mask))
+        if not self.source_id:
+            self.source_id = GLib.idle_add(self.flush)
+
+    def flush(self):
+        """Write queued label changes"""
+        pending, self.pending = self.pending, []
+        self.source_id = 0
+        try:
+            self.update(pending)
+        except Exception as e:
+            print(f"Failed to update label index: {e}")
+        return GLib.SOURCE_REMOVE
+
+    def update(self, changes):
+        """Apply (file path, label mask) changes in a single transaction"""
+        with self.connection:
+            for file_path, mask in changes:
+                file_path = os.path.abspath(file_path)
+                row = self.connection.execute(
+                    'SELECT labels FROM files WHERE path = ?', (file_path,)
+                ).fetchone()
+                previous = row[0] if row else 0
+                if mask == previous:
+                    continue
+                if mask:
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO files (path, parent, labels) VALUES (?, ?, ?)',
+                        (file_path, os.path.dirname(file_path), mask)
+                    )
+                else:
+                    self.connection.execute('DELETE FROM files WHERE path = ?', (file_path,))
+                # Only the labels which changed
+                self.connection.executemany(
+                    'DELETE FROM file_labels WHERE label = ? AND path = ?',
+                    [(single, file_path) for single in LabelSet.split(previous & ~mask)]
+                )
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO file_labels (label, path) VALUES (?, ?)',
+                    [(single, file_path) for single in LabelSet.split(mask & ~previous)]
+                )
+
+    def find(self, all_of, any_of=0, directory=None):
+        """Return the paths of the files with every label of all_of and one of any_of
+
+        Both are masks, an empty any_of matches every file. With all_of, the
+        files of its first label are looked up and the rest of both masks is
+        tested on them; otherwise the files of each label of any_of are.
+        """
+        if all_of:
+            query = (
+                'SELECT l.path FROM file_labels AS l JOIN files AS f ON f.path = l.path '
+                'WHERE l.label = ? AND (f.labels & ?) = ? AND (? = 0 OR (f.labels & ?) != 0)'
+            )
+            parameters = [LabelSet.split(all_of)[0], all_of, all_of, any_of, any_of]
+        elif any_of:
+            singles = LabelSet.split(any_of)
+            query = (
+                'SELECT DISTINCT l.path FROM file_labels AS l '
+                f'WHERE l.label IN ({", ".join("?" * len(singles))})'
+            )
+            parameters = singles
+        else:
+            # Every labelled file
+            query = 'SELECT l.path FROM files AS l WHERE 1'
+            parameters = []
+        if directory is not None:
+            directory = os.path.abspath(directory).rstrip('/')
+            # Every path below "dir/" sorts before "dir0", the character after '/'
+            query += ' AND l.path >= ? AND l.path < ?'
+            parameters += [directory + '/', directory + '0']
+        rows = self.connection.execute(query + ' ORDER BY l.path', parameters)
+        return [row[0] for row in rows]
+
+    def entries(self, directory):
+        """Return {path: label mask} of the indexed files below a directory"""
+        directory = os.path.abspath(directory).rstrip('/')
+        rows = self.connection.execute(
+            'SELECT path, labels FROM files WHERE path >= ? AND path < ?',
+            (directory + '/', directory + '0')
+        )
+        return dict(rows)
+
+    def reconcile(self, backend, directory):
+        """Bring the index in line with label storage below a directory
+
+        Returns the number of (added, changed, removed) entries.
+        """
+        # Paths from label storage must compare with the absolute ones indexed
+        directory = os.path.abspath(directory)
+        indexed = self.entries(directory)
+        changes = []
+        added = changed = 0
+
+        # Labels present in storage
+        for file_path, mask in backend.read_tree(directory):
+            previous = indexed.pop(file_path, None)
+            if previous is None:
+                added += 1
+                changes.append((file_path, mask))
+            elif previous != mask:
+                changed += 1
+                changes.append((file_path, mask))
+
+        # Indexed files whose labels or file are gone
+        removed = len(indexed)
+        changes.extend((file_path, 0) for file_path in indexed)
+
+        self.update(changes)
+        return added, changed, removed
+
+class RefreshQueue:
+    """Batch FileInfo invalidations and flush them from a single idle callback"""
+
+    def __init__(self):
+        self.pending = []
+        self.source_id = 0
+
+    def add(self, file_info):
+        """Schedule a redraw of a file once the current label operation is done"""
+        self.pending.append(file_info)
+        if not self.source_id:
+            self.source_id = GLib.idle_add(self.flush)
+
+    def flush(self):
+        """Ask the file manager to reload extension info of every queued file"""
+        pending, self.pending = self.pending, []
+        self.source_id = 0
+        for file_info in pending:
+            try:
+                file_info.invalidate_extension_info()
+            except Exception as e:
+                print(f"Failed to refresh file: {e}")
+        return GLib.SOURCE_REMOVE
+
+def get_file_path(file_info):
+    """Return the local path of a file manager item, or None
+
+    Remote locations (sftp://, smb://...) have one when gvfs exposes them
+    through FUSE; virtual ones such as trash:// have none.
+    """
+    try:
+        return Gio.File.new_for_uri(file_info.get_uri()).get_path()
+    except Exception:
+        return None
+
+def iter_folder(directory, recursive=False):
+    """Yield the paths of the items in a directory, and below it if recursive
+
+    Entries are yielded as os.scandir reads them, and only the directories
+    still to visit are kept, depth first, so huge trees don't fill memory.
+    """
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as iterator:
+                for entry in iterator:
+                    yield entry.path
+                    if recursive and entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        except OSError as e:
+            print(f"Error scanning {current}: {e}")
+
+class MountClassifier:
+    """Decide how labels are read on each mount, so a slow one never freezes the window
+
+    Mounts are classified from /proc/self/mountinfo and Gio.Mount, neither of
+    which touches the mounted file systems. Every kind of mount has a mode:
+    - sync: labels are read in the main loop, files may be stat'ed
+    - async: asynchronous reads only, never a stat from the main loop
+    - deferred: read on a worker thread of the mount, the file is redrawn then
+    - skip: labels are not shown
+    and a latency budget: once a read takes longer, or is still running past
+    it, the mount is skipped for COOLDOWN seconds.
+    """
+
+    MOUNTINFO = '/proc/self/mountinfo'
+    # File systems reached over the network
+    NETWORK_TYPES = {
+        'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', '9p', 'ceph',
+        'glusterfs', 'lustre', 'gpfs', 'coda', 'davfs',
+        'fuse.sshfs', 'fuse.rclone', 'fuse.s3fs', 'fuse.gvfsd-fuse', 'fuse.davfs2',
+        'fuse.curlftpfs', 'fuse.gcsfuse', 'fuse.goofys'
+    }
+    # FUSE file systems on a local disk
+    LOCAL_FUSE_TYPES = {'fuseblk', 'fuse.ntfs-3g', 'fuse.exfat', 'fuse.bindfs', 'fuse.mergerfs'}
+    # Mount kind -> (mode, latency budget in seconds)
+    POLICIES = {
+        'local': ('sync', None),
+        'removable': ('async', 1.0),
+        'fuse': ('async', 0.5),
+        'network': ('deferred', 0.25)
+    }
+    # Mount point -> (mode, latency budget), overriding the policy of its kind
+    MOUNT_POLICIES = {}
+    # Seconds labels are skipped on a mount which exceeded its budget
+    COOLDOWN = 60
+    # Worker threads per mount for deferred reads
+    MOUNT_WORKERS = 2
+
+    def __init__(self):
+        # [(mount point, kind)], longest mount point first, None until read
+        self.mounts = None
+        # mount point -> time until which labels are skipped
+        self.slow = {}
+        # mount point -> {token: start time} of the reads in progress
+        self.running = {}
+        # mount point -> ThreadPoolExecutor
+        self.executors = {}
+        try:
+            self.volume_monitor = Gio.VolumeMonitor.get()
+            for signal in ('mount-added', 'mount-removed', 'mount-changed'):
+                self.volume_monitor.connect(signal, self.on_mounts_changed)
+        except Exception as e:
+            print(f"Mount monitoring unavailable: {e}")
+            self.volume_monitor = None
+
+    def on_mounts_changed(self, volume_monitor, mount):
+        """Read mounts again on next use"""
+        self.mounts = None
+
+    def load_mounts(self):
+        """Classify every mount point"""
+        removable = set()
+        if self.volume_monitor is not None:
+            for mount in self.volume_monitor.get_mounts():
+                root = mount.get_root().get_path()
+                if root and mount.can_eject():
+                    removable.add(root)
+
+        mounts = []
+        try:
+            with open(self.MOUNTINFO) as mountinfo:
+                for line in mountinfo:
+                    fields = line.split()
+                    separator = fields.index('-')
+                    # Spaces and such are escaped as octal, e.g. \040
+                    mount_point = re.sub(
+                        r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), fields[4]
+                    )
+                    fstype = fields[separator + 1]
+                    mounts.append((mount_point, self.get_kind(fstype, mount_point in removable)))
+        except (OSError, ValueError, IndexError) as e:
+            print(f"Error reading mounts: {e}")
+
+        mounts.sort(key=lambda mount: len(mount[0]), reverse=True)
+        self.mounts = mounts
+
+    def get_kind(self, fstype, removable=False):
+        """Return the kind of a mount from its file system type"""
+        if fstype in self.NETWORK_TYPES:
+            return 'network'
+        if fstype.startswith('fuse') and fstype not in self.LOCAL_FUSE_TYPES:
+            return 'fuse'
+        if removable:
+            return 'removable'
+        return 'local'
+
+    def get_mount(self, file_path):
+        """Return (mount point, kind) of the mount holding a path"""
+        if self.mounts is None:
+            self.load_mounts()
+        for mount_point, kind in self.mounts:
+            if mount_point == '/' or file_path == mount_point or \
+                    file_path.startswith(mount_point + '/'):
+                return mount_point, kind
+        return '/', 'local'
+
+    def get_policy(self, mount_point, kind):
+        """Return (mode, latency budget) of a mount"""
+        return self.MOUNT_POLICIES.get(mount_point) or self.POLICIES[kind]
+
+    def get_mode(self, file_path):
+        """Return (mode, mount point) for reading the labels of a file"""
+        mount_point, kind = self.get_mount(file_path)
+        mode, budget = self.get_policy(mount_point, kind)
+        if mode != 'sync' and self.is_slow(mount_point, budget):
+            return 'skip', mount_point
+        return mode, mount_point
+
+    def is_slow(self, mount_point, budget):
+        """Tell whether a mount is over its budget, or has a read stuck past it"""
+        now = time.monotonic()
+        if self.slow.get(mount_point, 0) > now:
+            return True
+        if budget is not None:
+            for started in self.running.get(mount_point, {}).values():
+                if now - started > budget:
+                    self.slow[mount_point] = now + self.COOLDOWN
+                    return True
+        return False
+
+    def begin(self, mount_point):
+        """Start timing a read on a mount, returns a token for end()"""
+        token = object()
+        self.running.setdefault(mount_point, {})[token] = time.monotonic()
+        return token
+
+    def end(self, mount_point, token, elapsed=None):
+        """Stop timing a read, the mount is skipped for a while if it took too long
+
+        elapsed is the duration of the read itself when known, otherwise the
+        time since begin() is used.
+        """
+        started = self.running.get(mount_point, {}).pop(token, None)
+        if started is None:
+            return
+        if elapsed is None:
+            elapsed = time.monotonic() - started
+        budget = self.get_policy(mount_point, self.get_mount(mount_point)[1])[1]
+        if budget is not None and elapsed > budget:
+            self.slow[mount_point] = time.monotonic() + self.COOLDOWN
+
+    def submit(self, mount_point, function, callback):
+        """Run function on a worker of the mount, then callback(result, error) in the main loop
+
+        Each mount has its own workers, so a hung one only holds up its own reads.
+        """
+        executor = self.executors.get(mount_point)
+        if executor is None:
+            executor = self.executors[mount_point] = ThreadPoolExecutor(
+                max_workers=self.MOUNT_WORKERS,
+                thread_name_prefix='color-labels-mount'
+            )
+        token = self.begin(mount_point)
+
+        def finish(result, error, elapsed):
+            self.end(mount_point, token, elapsed)
+            callback(result, error)
+            return GLib.SOURCE_REMOVE
+
+        def task():
+            started = time.monotonic()
+            try:
+                result, error = function(), None
+            except FileNotFoundError:
+                result, error = 0, None
+            except Exception as e:
+                result, error = None, e
+            GLib.idle_add(finish, result, error, time.monotonic() - started)
+
+        executor.submit(task)
+
+class ProgressNotification:
+    """Desktop notification updated in place, at most once per interval"""
+
+    # Minimum seconds between two updates
+    INTERVAL = 0.5
+
+    def __init__(self, app_name, summary, cancel_label=None, on_cancel=None):
+        self.app_name = app_name
+        self.summary = summary
+        self.actions = ['cancel', cancel_label] if on_cancel else []
+        self.on_cancel = on_cancel
+        self.notification_id = 0
+        self.last_update = 0
+        self.in_flight = False
+        self.queued = None
+        self.closed = False
+        self.subscription = 0
+
+        try:
+            self.connection = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+            if on_cancel:
+                self.subscription = self.connection.signal_subscribe(
+                    'org.freedesktop.Notifications',
+                    'org.freedesktop.Notifications',
+                    'ActionInvoked',
+                    '/org/freedesktop/Notifications',
+                    None,
+                    Gio.DBusSignalFlags.NONE,
+                    self.on_action_invoked
+                )
+        except Exception as e:
+            print(f"Notifications unavailable: {e}")
+            self.connection = None
+
+    def update(self, body, force=False):
+        """Show new progress, unless the previous update is too recent"""
+        now = time.monotonic()
+        if self.closed or (not force and now - self.last_update < self.INTERVAL):
+            return
+        self.last_update = now
+        self.send(body)
+
+    def send(self, body):
+        """Create or replace the notification"""
+        if self.connection is None:
+            return
+        if self.in_flight:
+            # The notification id is needed to replace it, send once known
+            self.queued = body
+            return
+
+        self.in_flight = True
+        self.connection.call(
+            'org.freedesktop.Notifications',
+            '/org/freedesktop/Notifications',
+            'org.freedesktop.Notifications',
+            'Notify',
+            GLib.Variant('(susssasa{sv}i)', (
+                self.app_name,
+                self.notification_id,
+                'emblem-default',
+                self.summary,
+                body,
+                self.actions,
+                {'transient': GLib.Variant('b', True)},
+                0
+            )),
+            GLib.VariantType('(u)'),
+            Gio.DBusCallFlags.NONE,
+            -1,
+            None,
+            self.on_notify_done
+        )
+
+    def on_notify_done(self, connection, result):
+        """Remember the notification id and send any update queued meanwhile"""
+        self.in_flight = False
+        try:
+            self.notification_id = connection.call_finish(result).unpack()[0]
+        except GLib.Error as e:
+            print(f"Failed to show notification: {e}")
+
+        if self.closed:
+            self.close()
+        elif self.queued is not None:
+            body, self.queued = self.queued, None
+            self.send(body)
+
+    def on_action_invoked(self, connection, sender, path, interface, signal, parameters):
+        """Cancel the job when its notification button is clicked"""
+        notification_id, action = parameters.unpack()
+        if notification_id == self.notification_id and action == 'cancel':
+            self.on_cancel()
+            self.close()
+
+    def close(self):
+        """Remove the notification once the job is over"""
+        self.closed = True
+        if self.subscription:
+            self.connection.signal_unsubscribe(self.subscription)
+            self.subscription = 0
+        if self.in_flight or not self.notification_id:
+            return
+
+        notification_id, self.notification_id = self.notification_id, 0
+        self.connection.call(
+            'org.freedesktop.Notifications',
+            '/org/freedesktop/Notifications',
+            'org.freedesktop.Notifications',
+            'CloseNotification',
+            GLib.Variant('(u)', (notification_id,)),
+            None,
+            Gio.DBusCallFlags.NONE,
+            -1,
+            None,
+            None
+        )
+
+class LabelJob:
+    """Progress of a bulk label operation, shared between the main loop and workers"""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.writes = 0
+        self.pending_batches = 0
+        self.cancelled = threading.Event()
+        self.notification = None
+        self.done_callback = None
+        # Streamed jobs: items are still being produced, and batches free to hold
+        self.producing = False
+        self.slots = None
+
+    def get_progress(self):
+        """Return the progress text, the total is only a lower bound while producing"""
+        if self.producing:
+            return f"{self.done} / {self.total}…"
+        return f"{self.done} / {self.total}"
+
+class LabelJobRunner:
+    """Run bulk label operations on a bounded pool of background threads"""
+
+    # Selections up to this size are labelled at once on the main thread
+    SMALL_SELECTION = 200
+    # Worker threads shared by all jobs
+    MAX_WORKERS = 4
+    # Files written by a worker before handing them back to the main loop
+    BATCH_SIZE = 250
+    # Batches of a streamed job held at once, written or waiting, bounding its memory
+    STREAM_BATCHES = MAX_WORKERS * 2
+
+    def __init__(self, app_name):
+        self.app_name = app_name
+        self.executor = None
+
+    def create_job(self, total, summary, cancel_label, done):
+        """Return a new job with its progress notification"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.MAX_WORKERS,
+                thread_name_prefix='color-labels'
+            )
+
+        job = LabelJob(total)
+        job.done_callback = done
+        job.notification = ProgressNotification(
+            self.app_name, summary, cancel_label, job.cancelled.set
+        )
+        return job
+
+    def start(self, items, work, finish, summary, cancel_label, done=None):
+        """Call work(item) in workers, then finish(item) in the main loop and done(job) at the end
+
+        work returns the number of metadata writes it made.
+        """
+        job = self.create_job(len(items), summary, cancel_label, done)
+        job.notification.update(job.get_progress(), force=True)
+
+        for start in range(0, len(items), self.BATCH_SIZE):
+            job.pending_batches += 1
+            self.executor.submit(
+                self.run_batch, job, items[start:start + self.BATCH_SIZE], work, finish
+            )
+        return job
+
+    def start_stream(self, items, work, finish, summary, cancel_label, done=None):
+        """Like start(), for an iterable of items whose length isn't known
+
+        The iterable is consumed by a thread of its own, which waits while
+        STREAM_BATCHES batches are held, so memory stays the same for a
+        thousand items or millions.
+        """
+        job = self.create_job(0, summary, cancel_label, done)
+        job.producing = True
+        job.slots = threading.BoundedSemaphore(self.STREAM_BATCHES)
+        job.notification.update(job.get_progress(), force=True)
+
+        threading.Thread(
+            target=self.produce_batches,
+            args=(job, items, work, finish),
+            name='color-labels-scan',
+            daemon=True
+        ).start()
+        return job
+
+    def produce_batches(self, job, items, work, finish):
+        """Cut items into batches as they come and queue them (producer thread)"""
+        try:
+            for batch in batched(items, self.BATCH_SIZE):
+                job.slots.acquire()
+                if job.cancelled.is_set():
+                    job.slots.release()
+                    break
+                GLib.idle_add(self.submit_batch, job, batch, work, finish)
+        except Exception as e:
+            print(f"Error listing files: {e}")
+        # Queued after every batch, idle callbacks run in order
+        GLib.idle_add(self.finish_producing, job)
+
+    def submit_batch(self, job, batch, work, finish):
+        """Hand a produced batch to the workers (main loop)"""
+        job.total += len(batch)
+        job.pending_batches += 1
+        self.executor.submit(self.run_batch, job, batch, work, finish)
+        return GLib.SOURCE_REMOVE
+
+    def finish_producing(self, job):
+        """Note that all items were produced (main loop)"""
+        job.producing = False
+        self.check_done(job)
+        return GLib.SOURCE_REMOVE
+
+    def run_batch(self, job, batch, work, finish):
+        """Write a batch in a worker thread, then hand it back to the main loop"""
+        completed = []
+        writes = 0
+        for item in batch:
+            if job.cancelled.is_set():
+                break
+            try:
+                writes += work(item)
+                completed.append(item)
+            except Exception as e:
+                print(f"Error applying label: {e}")
+
+        GLib.idle_add(self.finish_batch, job, completed, writes, finish)
+
+    def finish_batch(self, job, completed, writes, finish):
+        """Update display and progress for a written batch (main loop)"""
+        for item in completed:
+            try:
+                finish(item)
+            except Exception as e:
+                print(f"Error applying label: {e}")
+
+        job.done += len(completed)
+        job.writes += writes
+        job.pending_batches -= 1
+        if job.slots:
+            job.slots.release()
+        self.check_done(job)
+        return GLib.SOURCE_REMOVE
+
+    def check_done(self, job):
+        """Close a job once every batch is written, otherwise show its progress (main loop)"""
+        if job.pending_batches == 0 and not job.producing:
+            job.notification.close()
+            if job.done_callback:
+                job.done_callback(job)
+        else:
+            job.notification.update(job.get_progress())
+
+class EmblemAssets:
+    """Label emblems pre-rendered into the user hicolor icon theme
+
+    Every color is rendered once per emblem size and scale as a PNG, so icon
+    lookups find an asset of the right size instead of rescaling an SVG on
+    each draw. A scalable SVG covers the sizes in between.
+    """
+
+    THEME_DIR = Path.home() / '.local' / 'share' / 'icons' / 'hicolor'
+    SIZES = (16, 24, 32, 48, 64)
+    SCALES = (1, 2)
+    # Part of the emblem stamp, bump it when the rendering changes
+    VERSION = 2
+
+    def __init__(self, colors):
+        # {emblem name: hex color}
+        self.colors = colors
+
+    def directories(self):
+        """Return (directory, size, scale) of every emblem directory"""
+        directories = [
+            (f"{size}x{size}{f'@{scale}' if scale > 1 else ''}/emblems", size, scale)
+            for size in self.SIZES
+            for scale in self.SCALES
+        ]
+        directories.append(('scalable/emblems', 16, 1))
+        return directories
+
+    @staticmethod
+    def render_png(hex_color, pixels):
+        """Return the PNG data of an anti-aliased disc filling the image"""
+        red, green, blue = (int(hex_color[i:i + 2], 16) for i in (1, 3, 5))
+        radius = pixels / 2
+        # 4x4 samples per pixel, only along the edge of the disc
+        offsets = [(i + 0.5) / 4 for i in range(4)]
+        rows = bytearray()
+        for y in range(pixels):
+            rows.append(0)
+            for x in range(pixels):
+                distance = ((x + 0.5 - radius) ** 2 + (y + 0.5 - radius) ** 2) ** 0.5
+                if distance <= radius - 0.71:
+                    alpha = 255
+                elif distance >= radius + 0.71:
+                    alpha = 0
+                else:
+                    covered = sum(
+                        1 for dy in offsets for dx in offsets
+                        if (x + dx - radius) ** 2 + (y + dy - radius) ** 2 <= radius * radius
+                    )
+                    alpha = round(255 * covered / 16)
+                rows += bytes((red, green, blue, alpha))
+
+        def chunk(kind, data):
+            return (struct.pack('>I', len(data)) + kind + data
+                    + struct.pack('>I', zlib.crc32(kind + data)))
+
+        return (b'\x89PNG\r\n\x1a\n'
+                + chunk(b'IHDR', struct.pack('>IIBBBBB', pixels, pixels, 8, 6, 0, 0, 0))
+                + chunk(b'IDAT', zlib.compress(bytes(rows), 9))
+                + chunk(b'IEND', b''))
+
+    @staticmethod
+    def render_svg(hex_color):
+        """Return the scalable emblem"""
+        return f'''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<svg
+   width="16"
+   height="16"
+   viewBox="0 0 4.233333 4.233333"
+   version="1.1"
+   id="svg1"
+   xmlns="http://www.w3.org/2000/svg"
+   xmlns:svg="http://www.w3.org/2000/svg">
+  <defs
+     id="defs1" />
+  <g
+     id="layer1">
+    <ellipse
+       style="fill:{hex_color};fill-opacity:1;stroke-width:0.264999"
+       id="path1"
+       cx="2.1166666"
+       cy="2.1166666"
+       rx="2.1170001"
+       ry="2.1166666" />
+  </g>
+</svg>'''.encode()
+
+    @staticmethod
+    def write_if_changed(file_path, data):
+        """Write a file unless it already holds data, returns True if written"""
+        try:
+            if file_path.read_bytes() == data:
+                return False
+        except OSError:
+            pass
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = file_path.with_name(f'.{file_path.name}.tmp')
+        temporary.write_bytes(data)
+        os.replace(temporary, file_path)
+        print(f"✓ Created: {file_path}")
+        return True
+
+    def provision(self):
+        """Write missing or outdated emblems, returns True once all are in place"""
+        written = 0
+        complete = True
+        for emblem, hex_color in self.colors.items():
+            for directory, size, scale in self.directories():
+                try:
+                    if directory.startswith('scalable'):
+                        data = self.render_svg(hex_color)
+                        file_name = f'{emblem}.svg'
+                    else:
+                        data = self.render_png(hex_color, size * scale)
+                        file_name = f'{emblem}.png'
+                    written += self.write_if_changed(self.THEME_DIR / directory / file_name, data)
+                except Exception as e:
+                    print(f"Error creating {emblem} in {directory}: {e}")
+                    complete = False
+
+            # Earlier versions wrote a 16x16 SVG, next to the PNG it would be ambiguous
+            legacy = self.THEME_DIR / '16x16' / 'emblems' / f'{emblem}.svg'
+            if legacy.exists():
+                legacy.unlink()
+                written += 1
+
+        try:
+            written += self.update_index_theme()
+        except Exception as e:
+            print(f"Warning: Could not update index.theme: {e}")
+
+        if written:
+            self.update_icon_cache()
+        return complete
+
+    def find_system_index(self):
+        """Return the hicolor index.theme of the system, or None"""
+        data_dirs = os.environ.get('XDG_DATA_DIRS') or '/usr/local/share:/usr/share'
+        for data_dir in data_dirs.split(':'):
+            index_file = Path(data_dir) / 'icons' / 'hicolor' / 'index.theme'
+            if data_dir and index_file.exists():
+                return index_file
+        return None
+
+    def update_index_theme(self):
+        """Declare the emblem directories in the user hicolor index.theme
+
+        GTK takes the index of the first hicolor directory it finds, the user
+        one included, so the user index is derived from the system one and only
+        written when an emblem directory is missing from it.
+        """
+        index_file = self.THEME_DIR / 'index.theme'
+        base = index_file if index_file.exists() else self.find_system_index()
+        if base is not None:
+            content = base.read_text()
+        else:
+            content = '[Icon Theme]\nName=Hicolor\nComment=Fallback icon theme\nHidden=true\nDirectories=\n'
+
+        sections = set(re.findall(r'^\[(.+)\]\s*$', content, re.M))
+        missing = [entry for entry in self.directories() if entry[0] not in sections]
+        if not missing:
+            return False
+
+        lines = content.splitlines()
+        keys = {}
+        section = None
+        for number, line in enumerate(lines):
+            if line.startswith('['):
+                section = line.strip()
+            elif section == '[Icon Theme]' and '=' in line:
+                keys[line.split('=', 1)[0].strip()] = number
+
+        for directory, size, scale in missing:
+            key = 'ScaledDirectories' if scale > 1 and 'ScaledDirectories' in keys else 'Directories'
+            if key not in keys:
+                lines.insert(1, 'Directories=')
+                keys = {name: number + 1 for name, number in keys.items()}
+                keys['Directories'] = 1
+            number = keys[key]
+            separator = '' if lines[number].rstrip().endswith(('=', ',')) else ','
+            lines[number] = lines[number].rstrip() + separator + directory
+
+        for directory, size, scale in missing:
+            lines.append('')
+            lines.append(f'[{directory}]')
+            lines.append(f'Size={size}')
+            if scale > 1:
+                lines.append(f'Scale={scale}')
+            lines.append('Context=Emblems')
+            if directory.startswith('scalable'):
+                lines.extend(['MinSize=8', 'MaxSize=512', 'Type=Scalable'])
+            else:
+                lines.append('Type=Fixed')
+
+        index_file.parent.mkdir(parents=True, exist_ok=True)
+        index_file.write_text('\n'.join(lines) + '\n')
+        return True
+
+    def update_icon_cache(self):
+        """Update icon cache"""
+        try:
+            subprocess.run(['gtk-update-icon-cache', str(self.THEME_DIR)],
+                         check=False, capture_output=True)
+            print("✓ Icon cache updated")
+        except Exception as e:
+            print(f"Warning: Could not update icon cache: {e}")
+
+def find_emblem(name):
+    """Return the emblem of a label given by color id, name or emblem"""
+    name = name.lower()
+    for color_id, color_info in PALETTE.items():
+        if name in (color_id, color_info['name'].lower(), color_info['emblem']):
+            return color_info['emblem']
+    raise argparse.ArgumentTypeError(f"unknown label: {name}")
+
+def get_color_ids(labels, mask):
+    """Return the color ids of a label mask, in palette order"""
+    emblems = labels.to_emblems(mask)
+    return [
+        color_id for color_id, color_info in PALETTE.items()
+        if color_info['emblem'] in emblems
+    ]
+
+def print_record(**record):
+    """Write one NDJSON record on standard output"""
+    print(json.dumps(record, ensure_ascii=False))
+
+def scan_directory(directory):
+    """Return (entries, subdirectories) of a directory, paths only"""
+    entries = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as iterator:
+            for entry in iterator:
+                entries.append(entry.path)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+    except OSError as e:
+        print(f"Error scanning {directory}: {e}", file=sys.stderr)
+    return entries, subdirectories
+
+def walk_paths(paths, recursive, executor, jobs):
+    """Yield the given paths and, if recursive, everything below them
+
+    Directories are scanned in parallel, with a bounded number in flight, and
+    entries are yielded as soon as their directory has been read.
+    """
+    directories = deque()
+    for path in paths:
+        yield os.path.abspath(path)
+        if recursive and os.path.isdir(path) and not os.path.islink(path):
+            directories.append(os.path.abspath(path))
+
+    running = set()
+    while directories or running:
+        while directories and len(running) < jobs * 2:
+            running.add(executor.submit(scan_directory, directories.popleft()))
+
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            entries, subdirectories = future.result()
+            directories.extend(subdirectories)
+            yield from entries
+
+def make_filter(patterns, regex):
+    """Return a function telling whether a path passes the glob and regex filters"""
+    expression = re.compile(regex) if regex else None
+
+    def accept(file_path):
+        if patterns and not any(fnmatch.fnmatch(os.path.basename(file_path), p) for p in patterns):
+            return False
+        return expression is None or expression.search(file_path) is not None
+
+    return accept
+
+def batched(iterable, size):
+    """Yield lists of at most size items"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def write_label_batch(backend, changes):
+    """Write (path, added mask, removed mask) changes, skipping files left as they are"""
+    results = []
+    writes = []
+    removals = set()
+    for file_path, add, remove in changes:
+        try:
+            current = backend.read(file_path)
+        except Exception as e:
+            results.append((file_path, 0, 'error', str(e)))
+            continue
+        labels = (current & ~remove) | add
+        if labels == current:
+            results.append((file_path, current, 'unchanged', None))
+        else:
+            writes.append((file_path, labels))
+            if not labels & ~current:
+                # Labels only taken away
+                removals.add(file_path)
+
+    for (file_path, labels), written in zip(writes, backend.write_many(writes)):
+        if written:
+            action = 'removed' if file_path in removals else 'applied'
+            results.append((file_path, labels, action, None))
+        else:
+            results.append((file_path, labels, 'error', 'write failed'))
+    return results
+
+def run_writes(backend, index, changes, executor, jobs, batch_size):
+    """Write label changes in batches spread over the thread pool, reporting NDJSON"""
+    running = set()
+    failed = False
+
+    def collect(done):
+        nonlocal failed
+        indexed = []
+        for future in done:
+            for file_path, labels, action, error in future.result():
+                record = {
+                    'path': file_path,
+                    'labels': get_color_ids(backend.labels, labels),
+                    'action': action
+                }
+                if error:
+                    record['error'] = error
+                    failed = True
+                elif action != 'unchanged':
+                    indexed.append((file_path, labels))
+                print_record(**record)
+        if index and indexed:
+            index.update(indexed)
+
+    for batch in batched(changes, batch_size):
+        running.add(executor.submit(write_label_batch, backend, batch))
+        if len(running) >= jobs * 2:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            collect(done)
+    collect(running)
+    return 1 if failed else 0
+
+class AutoLabelRules:
+    """Rules labelling the files that appear in watched directories
+
+    Rules are read from a JSON list such as:
+        [{"directory": "~/Downloads", "glob": "*.pdf", "label": "orange"},
+         {"directory": "~/Pictures", "mime": "image/*", "label": "grape", "recursive": true}]
+    A rule applies to the files directly in its directory, or below it when
+    recursive, and matches when its glob (file name), regex (full path) and
+    mime conditions all do. glob, mime and label may also be lists.
+    """
+
+    RULES_FILE = Path.home() / '.config' / 'color-labels' / 'rules.json'
+
+    def __init__(self, labels, rules):
+        # [(directory, recursive, name expression, path expression, mime expression, mask)]
+        self.rules = []
+        for rule in rules:
+            self.rules.append((
+                os.path.abspath(os.path.expanduser(rule['directory'])),
+                bool(rule.get('recursive')),
+                self.compile_globs(rule.get('glob')),
+                re.compile(rule['regex']) if rule.get('regex') else None,
+                self.compile_globs(rule.get('mime')),
+                labels.from_emblems(find_emblem(label) for label in self.as_list(rule['label']))
+            ))
+        self.needs_mime = any(rule[4] is not None for rule in self.rules)
+
+    @classmethod
+    def load(cls, labels, rules_file=None):
+        """Read rules from a JSON file"""
+        with open(rules_file or cls.RULES_FILE) as f:
+            return cls(labels, json.load(f))
+
+    @staticmethod
+    def as_list(value):
+        """Return a rule value which may be a single string as a list"""
+        return [value] if isinstance(value, str) else list(value)
+
+    def compile_globs(self, patterns):
+        """Compile glob patterns into one expression, None when there are none"""
+        if not patterns:
+            return None
+        return re.compile('|'.join(fnmatch.translate(p) for p in self.as_list(patterns)))
+
+    def directories(self):
+        """Return the watched directories, recursive ones first"""
+        directories = {}
+        for directory, recursive, *_ in self.rules:
+            directories[directory] = directories.get(directory, False) or recursive
+        return sorted(directories.items(), key=lambda item: not item[1])
+
+    def match(self, file_path):
+        """Return the labels of every rule matching a path, in a single pass"""
+        parent = os.path.dirname(file_path)
+        name = os.path.basename(file_path)
+        mime = None
+        mask = 0
+        for directory, recursive, names, expression, mimes, labels in self.rules:
+            if parent != directory and not (recursive and parent.startswith(directory + '/')):
+                continue
+            if names is not None and not names.match(name):
+                continue
+            if expression is not None and not expression.search(file_path):
+                continue
+            if mimes is not None:
+                if mime is None:
+                    # Guessed from the name, the file itself isn't read
+                    mime = Gio.content_type_guess(name, None)[0] or ''
+                if not mimes.match(mime):
+                    continue
+            mask |= labels
+        return mask
+
+class AutoLabelWatcher:
+    """Label files as rules match them, from inotify events
+
+    Events are read in bulk and only collected; once the directories are
+    quiet for QUIET seconds, or after MAX_DELAY at the latest, the files
+    are matched and labelled in batches, so unpacking thousands of files
+    makes a few batched writes instead of one write per file.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+    EVENT = struct.Struct('iIII')
+
+    # Seconds without events before collected files are labelled
+    QUIET = 0.5
+    # Longest wait for labelling collected files during a burst
+    MAX_DELAY = 2.0
+    # Collected files after which labelling doesn't wait any longer
+    MAX_PENDING = 10000
+
+    def __init__(self, rules, backend, index, executor, jobs, batch_size):
+        self.rules = rules
+        self.backend = backend
+        self.index = index
+        self.executor = executor
+        self.jobs = jobs
+        self.batch_size = batch_size
+        # watch descriptor -> (directory, recursive)
+        self.watches = {}
+        # Files seen since the last labelling, in order
+        self.pending = OrderedDict()
+        self.first_pending = 0
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, directory, recursive):
+        """Watch a directory, and the directories below it when recursive"""
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(current), self.WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                print(f"Error watching {current}: {os.strerror(error)}", file=sys.stderr)
+                if error == errno.ENOSPC:
+                    # Out of watches (fs.inotify.max_user_watches), others would fail too
+                    return
+                continue
+            self.watches[wd] = (current, recursive)
+
+            if recursive:
+                try:
+                    with os.scandir(current) as iterator:
+                        stack.extend(
+                            entry.path for entry in iterator if entry.is_dir(follow_symlinks=False)
+                        )
+                except OSError as e:
+                    print(f"Error scanning {current}: {e}", file=sys.stderr)
+
+    def run(self):
+        """Watch the rule directories until interrupted"""
+        for directory, recursive in self.rules.directories():
+            self.add_watch(directory, recursive)
+        print(f"Watching {len(self.watches)} directories", file=sys.stderr)
+
+        while True:
+            timeout = None
+            if self.pending:
+                timeout = max(0, min(self.QUIET, self.first_pending + self.MAX_DELAY - time.monotonic()))
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if readable:
+                self.read_events(os.read(self.fd, 65536))
+            if self.pending and (
+                not readable or time.monotonic() - self.first_pending >= self.MAX_DELAY
+            ):
+                self.label_pending()
+
+    def read_events(self, data):
+        """Collect the files named by a buffer of inotify events"""
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost, look at every watched directory again
+                print("Event queue overflow, rescanning", file=sys.stderr)
+                for directory, _ in list(self.watches.values()):
+                    for file_path in iter_folder(directory):
+                        self.add_pending(file_path)
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            watch = self.watches.get(wd)
+            if watch is None or not name:
+                continue
+            directory, recursive = watch
+            file_path = os.path.join(directory, name)
+            self.add_pending(file_path)
+
+            if recursive and mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.add_watch(file_path, True)
+                # Files may have arrived before the watch existed
+                for child_path in iter_folder(file_path, True):
+                    self.add_pending(child_path)
+
+    def add_pending(self, file_path):
+        """Collect a file for the next labelling"""
+        if not self.pending:
+            self.first_pending = time.monotonic()
+        self.pending[file_path] = None
+        if len(self.pending) >= self.MAX_PENDING:
+            self.label_pending()
+
+    def label_pending(self):
+        """Label the collected files matching a rule, in batches"""
+        paths = self.pending
+        self.pending = OrderedDict()
+        changes = []
+        for file_path in paths:
+            mask = self.rules.match(file_path)
+            if mask and os.path.lexists(file_path):
+                changes.append((file_path, mask, 0))
+        if changes:
+            run_writes(self.backend, self.index, changes, self.executor, self.jobs, self.batch_size)
+            sys.stdout.flush()
+
+def main():
+    """Command line access to labels and to the label index"""
+    parser = argparse.ArgumentParser(description='Color labels')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    find_parser = commands.add_parser('find', help='List files with labels from the index')
+    find_parser.add_argument('labels', nargs='+', metavar='label',
+                             help='label colors, e.g. mint grape, then optionally a directory')
+    find_parser.add_argument('--any', action='store_true',
+                             help='files with any of the labels rather than all of them')
+
+    reconcile_parser = commands.add_parser('reconcile', help='Fix index drift from label storage')
+    reconcile_parser.add_argument('directory', nargs='?', default=str(Path.home()))
+
+    apply_parser = commands.add_parser('apply', help='Add a label to files')
+    apply_parser.add_argument('label', type=find_emblem, help='label color, e.g. strawberry')
+    apply_parser.add_argument('--replace', action='store_true',
+                              help='drop the other labels of the files')
+    remove_parser = commands.add_parser('remove', help='Remove labels from files')
+    remove_parser.add_argument('--label', type=find_emblem, action='append', default=[],
+                               help='only remove this label (repeatable)')
+    list_parser = commands.add_parser('list', help='List labelled files')
+    list_parser.add_argument('--label', type=find_emblem, action='append', default=[],
+                             help='only list files with this label (repeatable)')
+    list_parser.add_argument('--any', action='store_true',
+                             help='files with any of the labels rather than all of them')
+    copy_parser = commands.add_parser('copy', help='Copy labels from a tree onto another')
+    copy_parser.add_argument('source')
+    copy_parser.add_argument('destination')
+
+    watch_parser = commands.add_parser('watch', help='Label new files by rules until interrupted')
+    watch_parser.add_argument('--rules', default=str(AutoLabelRules.RULES_FILE),
+                              help='JSON rules file')
+
+    for command_parser in (apply_parser, remove_parser, list_parser, copy_parser, watch_parser):
+        if command_parser not in (copy_parser, watch_parser):
+            command_parser.add_argument('paths', nargs='+', metavar='path')
+        if command_parser is not watch_parser:
+            command_parser.add_argument('-r', '--recursive', action='store_true',
+                                        help='include everything below directories')
+            command_parser.add_argument('--glob', action='append', default=[],
+                                        help='only files whose name matches this pattern (repeatable)')
+            command_parser.add_argument('--regex', help='only files whose path matches this expression')
+        command_parser.add_argument('--jobs', type=int, default=os.cpu_count() or 4,
+                                    help='number of worker threads')
+        command_parser.add_argument('--batch-size', type=int, default=500,
+                                    help='labels written per batch')
+
+    for command_parser in (find_parser, reconcile_parser, apply_parser, remove_parser,
+                           list_parser, copy_parser, watch_parser):
+        command_parser.add_argument('--backend', choices=sorted(LABEL_BACKENDS),
+                                    default=DEFAULT_BACKEND)
+
+    # Operands may also follow options, as in "find mint --any grape": argparse
+    # ends a list of positionals at the first option, the rest comes back here
+    args, extra = parser.parse_known_args()
+    operands = {'find': 'labels', 'apply': 'paths', 'remove': 'paths', 'list': 'paths'}
+    if extra and args.command in operands and not any(arg.startswith('-') for arg in extra):
+        getattr(args, operands[args.command]).extend(extra)
+    elif extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+
+    backend = LABEL_BACKENDS[args.backend](
+        color_info['emblem'] for color_info in PALETTE.values()
+    )
+    labels = backend.labels
+
+    if args.command == 'find':
+        terms = list(args.labels)
+        directory = None
+        # A last argument which isn't a label is the directory to search
+        if len(terms) > 1:
+            try:
+                find_emblem(terms[-1])
+            except argparse.ArgumentTypeError:
+                directory = terms.pop()
+        try:
+            mask = labels.from_emblems(find_emblem(term) for term in terms)
+        except argparse.ArgumentTypeError as e:
+            parser.error(str(e))
+        if args.any:
+            paths = LabelIndex(labels).find(0, mask, directory)
+        else:
+            paths = LabelIndex(labels).find(mask, 0, directory)
+        for file_path in paths:
+            print(file_path)
+        return 0
+
+    if args.command == 'reconcile':
+        added, changed, removed = LabelIndex(labels).reconcile(backend, args.directory)
+        print(f"{added} added, {changed} changed, {removed} removed")
+        return 0
+
+    try:
+        index = LabelIndex(labels)
+    except Exception as e:
+        print(f"Label index unavailable: {e}", file=sys.stderr)
+        index = None
+
+    jobs = max(1, args.jobs)
+
+    if args.command == 'watch':
+        try:
+            rules = AutoLabelRules.load(labels, args.rules)
+        except (OSError, ValueError, KeyError, TypeError, re.error, argparse.ArgumentTypeError) as e:
+            parser.error(f"invalid rules in {args.rules}: {e}")
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='color-labels') as executor:
+            try:
+                AutoLabelWatcher(rules, backend, index, executor, jobs, args.batch_size).run()
+            except KeyboardInterrupt:
+                pass
+        return 0
+
+    accept = make_filter(args.glob, args.regex)
+
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='color-labels') as executor:
+        if args.command in ('apply', 'remove'):
+            if args.command == 'apply':
+                add = labels.from_emblems([args.label])
+                remove = labels.all if args.replace else 0
+            else:
+                add = 0
+                remove = labels.from_emblems(args.label) if args.label else labels.all
+            changes = (
+                (file_path, add, remove)
+                for file_path in walk_paths(args.paths, args.recursive, executor, jobs)
+                if accept(file_path)
+            )
+            status = run_writes(backend, index, changes, executor, jobs, args.batch_size)
+
+        elif args.command == 'list':
+            status = 0
+            wanted = labels.from_emblems(args.label)
+            all_of, any_of = (0, wanted) if args.any else (wanted, 0)
+            for path in args.paths:
+                # Backends report the paths below the one they are given as is
+                path = os.path.abspath(path)
+                if args.recursive and os.path.isdir(path):
+                    # Labelled files only, in one pass over label storage
+                    labelled = backend.read_tree(path)
+                    own = backend.read(path)
+                    if own:
+                        labelled = chain([(path, own)], labelled)
+                else:
+                    labelled = [(path, backend.read(path))]
+                for file_path, mask in labelled:
+                    if mask and accept(file_path) and labels.matches(mask, all_of, any_of):
+                        print_record(path=file_path, labels=get_color_ids(labels, mask))
+
+        elif args.command == 'copy':
+            source = os.path.abspath(args.source)
+            destination = os.path.abspath(args.destination)
+            if args.recursive and os.path.isdir(source):
+                labelled = chain([(source, backend.read(source))], backend.read_tree(source))
+            else:
+                labelled = [(source, backend.read(source))]
+            # The labels of the source replace those of the destination
+            changes = (
+                (destination + file_path[len(source):], mask, labels.all)
+                for file_path, mask in labelled
+                if mask and accept(file_path)
+                and os.path.lexists(destination + file_path[len(source):])
+            )
+            status = run_writes(backend, index, changes, executor, jobs, args.batch_size)
+
+    sys.stdout.flush()
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
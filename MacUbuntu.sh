@@ -963,6 +963,7 @@ wget https://github.com/M-Rick/MacUbuntu/raw/main/Nautilus/Lock-Nautilus.py -P ~
 
 # Labels
 wget https://github.com/M-Rick/MacUbuntu/raw/main/Nautilus/Labels-Nautilus.py -P ~/.local/share/nautilus-python/extensions/
+wget https://github.com/M-Rick/MacUbuntu/raw/main/Common/color_labels_core.py -P ~/.local/share/nautilus-python/extensions/
 
 
 # Nemo Extensions
@@ -975,6 +976,7 @@ wget https://github.com/M-Rick/MacUbuntu/raw/main/Nemo/Lock-Nemo.py -P ~/.local/
 
 # Labels
 wget https://github.com/M-Rick/MacUbuntu/raw/main/Nemo/Labels-Nemo.py -P ~/.local/share/nemo-python/extensions/
+wget https://github.com/M-Rick/MacUbuntu/raw/main/Common/color_labels_core.py -P ~/.local/share/nemo-python/extensions/
 
 
 
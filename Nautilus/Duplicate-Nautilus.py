@@ -5,10 +5,19 @@ Place in: ~/.local/share/nautilus-python/extensions/duplicate_files.py
 """
 
 import os
+import errno
+import fcntl
+import json
 import shutil
 import locale
-from gi.repository import Nautilus, GObject
-from urllib.parse import unquote
+import time
+import secrets
+import threading
+import ctypes
+import ctypes.util
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from gi.repository import Nautilus, GObject, Gio, GLib
 from pathlib import Path
 
 def get_localized_text():
@@ -19,117 +28,232 @@ def get_localized_text():
         'en': {  # English (default)
             'label': 'Duplicate',
             'tip': 'Duplicate selected files',
-            'copy_suffix': ' copy'
+            'copy_suffix': ' copy',
+            'progress': 'Duplicating',
+            'done': 'Duplication complete',
+            'cancelled': 'Duplication cancelled',
+            'failed': 'Duplication failed',
+            'cancel': 'Cancel'
         },
         'de': {  # German
             'label': 'Duplizieren',
             'tip': 'Ausgewählte Dateien duplizieren',
-            'copy_suffix': ' - Kopie'
+            'copy_suffix': ' - Kopie',
+            'progress': 'Wird dupliziert',
+            'done': 'Duplizieren abgeschlossen',
+            'cancelled': 'Duplizieren abgebrochen',
+            'failed': 'Duplizieren fehlgeschlagen',
+            'cancel': 'Abbrechen'
         },
         'nl': {  # Dutch
             'label': 'Dupliceren',
             'tip': 'Geselecteerde bestanden dupliceren',
-            'copy_suffix': ' - kopie'
+            'copy_suffix': ' - kopie',
+            'progress': 'Bezig met dupliceren',
+            'done': 'Dupliceren voltooid',
+            'cancelled': 'Dupliceren geannuleerd',
+            'failed': 'Dupliceren mislukt',
+            'cancel': 'Annuleren'
         },
         'sv': {  # Swedish
             'label': 'Duplicera',
             'tip': 'Duplicera valda filer',
-            'copy_suffix': ' - kopia'
+            'copy_suffix': ' - kopia',
+            'progress': 'Duplicerar',
+            'done': 'Duplicering klar',
+            'cancelled': 'Duplicering avbruten',
+            'failed': 'Duplicering misslyckades',
+            'cancel': 'Avbryt'
         },
         'da': {  # Danish
             'label': 'Duplikér',
             'tip': 'Duplikér valgte filer',
-            'copy_suffix': ' - kopi'
+            'copy_suffix': ' - kopi',
+            'progress': 'Duplikerer',
+            'done': 'Duplikering fuldført',
+            'cancelled': 'Duplikering annulleret',
+            'failed': 'Duplikering mislykkedes',
+            'cancel': 'Annuller'
         },
         'no': {  # Norwegian
             'label': 'Dupliser',
             'tip': 'Dupliser valgte filer',
-            'copy_suffix': ' - kopi'
+            'copy_suffix': ' - kopi',
+            'progress': 'Dupliserer',
+            'done': 'Duplisering fullført',
+            'cancelled': 'Duplisering avbrutt',
+            'failed': 'Duplisering mislyktes',
+            'cancel': 'Avbryt'
         },
         'fi': {  # Finnish
             'label': 'Monista',
             'tip': 'Monista valitut tiedostot',
-            'copy_suffix': ' - kopio'
+            'copy_suffix': ' - kopio',
+            'progress': 'Monistetaan',
+            'done': 'Monistaminen valmis',
+            'cancelled': 'Monistaminen peruttu',
+            'failed': 'Monistaminen epäonnistui',
+            'cancel': 'Peruuta'
         },
         'fr': {  # French
             'label': 'Dupliquer',
             'tip': 'Dupliquer les fichiers sélectionnés',
-            'copy_suffix': ' - copie'
+            'copy_suffix': ' - copie',
+            'progress': 'Duplication en cours',
+            'done': 'Duplication terminée',
+            'cancelled': 'Duplication annulée',
+            'failed': 'Échec de la duplication',
+            'cancel': 'Annuler'
         },
         'it': {  # Italian
             'label': 'Duplica',
             'tip': 'Duplica i file selezionati',
-            'copy_suffix': ' - copia'
+            'copy_suffix': ' - copia',
+            'progress': 'Duplicazione in corso',
+            'done': 'Duplicazione completata',
+            'cancelled': 'Duplicazione annullata',
+            'failed': 'Duplicazione non riuscita',
+            'cancel': 'Annulla'
         },
         'es': {  # Spanish
             'label': 'Duplicar',
             'tip': 'Duplicar archivos seleccionados',
-            'copy_suffix': ' - copia'
+            'copy_suffix': ' - copia',
+            'progress': 'Duplicando',
+            'done': 'Duplicación completada',
+            'cancelled': 'Duplicación cancelada',
+            'failed': 'Error al duplicar',
+            'cancel': 'Cancelar'
         },
         'pt': {  # Portuguese
             'label': 'Duplicar',
             'tip': 'Duplicar arquivos selecionados',
-            'copy_suffix': ' - cópia'
+            'copy_suffix': ' - cópia',
+            'progress': 'A duplicar',
+            'done': 'Duplicação concluída',
+            'cancelled': 'Duplicação cancelada',
+            'failed': 'Falha na duplicação',
+            'cancel': 'Cancelar'
         },
         'ro': {  # Romanian
             'label': 'Duplicare',
             'tip': 'Duplică fișierele selectate',
-            'copy_suffix': ' - copie'
+            'copy_suffix': ' - copie',
+            'progress': 'Se duplică',
+            'done': 'Duplicare finalizată',
+            'cancelled': 'Duplicare anulată',
+            'failed': 'Duplicarea a eșuat',
+            'cancel': 'Anulează'
         },
         'pl': {  # Polish
             'label': 'Duplikuj',
             'tip': 'Duplikuj wybrane pliki',
-            'copy_suffix': ' - kopia'
+            'copy_suffix': ' - kopia',
+            'progress': 'Duplikowanie',
+            'done': 'Duplikowanie zakończone',
+            'cancelled': 'Duplikowanie anulowane',
+            'failed': 'Duplikowanie nie powiodło się',
+            'cancel': 'Anuluj'
         },
         'hu': {  # Hungarian
             'label': 'Duplikálás',
             'tip': 'Kiválasztott fájlok duplikálása',
-            'copy_suffix': ' - másolat'
+            'copy_suffix': ' - másolat',
+            'progress': 'Kettőzés folyamatban',
+            'done': 'Kettőzés kész',
+            'cancelled': 'Kettőzés megszakítva',
+            'failed': 'Kettőzés sikertelen',
+            'cancel': 'Mégse'
         },
         'ru': {  # Russian
             'label': 'Дублировать',
             'tip': 'Дублировать выбранные файлы',
-            'copy_suffix': ' - копия'
+            'copy_suffix': ' - копия',
+            'progress': 'Дублирование',
+            'done': 'Дублирование завершено',
+            'cancelled': 'Дублирование отменено',
+            'failed': 'Ошибка дублирования',
+            'cancel': 'Отмена'
         },
         'zh_CN': {  # Simplified Chinese
             'label': '复制',
             'tip': '复制所选文件',
-            'copy_suffix': ' 的副本'
+            'copy_suffix': ' 的副本',
+            'progress': '正在复制',
+            'done': '复制完成',
+            'cancelled': '复制已取消',
+            'failed': '复制失败',
+            'cancel': '取消'
         },
         'zh_TW': {  # Traditional Chinese
             'label': '複製',
             'tip': '複製所選檔案',
-            'copy_suffix': ' 的副本'
+            'copy_suffix': ' 的副本',
+            'progress': '正在複製',
+            'done': '複製完成',
+            'cancelled': '複製已取消',
+            'failed': '複製失敗',
+            'cancel': '取消'
         },
         'ja': {  # Japanese
             'label': '複製',
             'tip': '選択されたファイルを複製',
-            'copy_suffix': ' のコピー'
+            'copy_suffix': ' のコピー',
+            'progress': '複製中',
+            'done': '複製が完了しました',
+            'cancelled': '複製をキャンセルしました',
+            'failed': '複製に失敗しました',
+            'cancel': 'キャンセル'
         },
         'ko': {  # Korean
             'label': '복제',
             'tip': '선택한 파일 복제',
-            'copy_suffix': ' 사본'
+            'copy_suffix': ' 사본',
+            'progress': '복제 중',
+            'done': '복제 완료',
+            'cancelled': '복제 취소됨',
+            'failed': '복제 실패',
+            'cancel': '취소'
         },
         'hi': {  # Hindi
             'label': 'प्रतिलिपि',
             'tip': 'चयनित फाइलों की प्रतिलिपि बनाएं',
-            'copy_suffix': ' की प्रति'
+            'copy_suffix': ' की प्रति',
+            'progress': 'प्रतिलिपि बनाई जा रही है',
+            'done': 'प्रतिलिपि पूर्ण',
+            'cancelled': 'प्रतिलिपि रद्द',
+            'failed': 'प्रतिलिपि विफल',
+            'cancel': 'रद्द करें'
         },
         'ar': {  # Arabic
             'label': 'تكرار',
             'tip': 'تكرار الملفات المحددة',
-            'copy_suffix': ' - نسخة'
+            'copy_suffix': ' - نسخة',
+            'progress': 'جارٍ التكرار',
+            'done': 'اكتمل التكرار',
+            'cancelled': 'أُلغي التكرار',
+            'failed': 'فشل التكرار',
+            'cancel': 'إلغاء'
         },
         'he': {  # Hebrew
             'label': 'שכפול',
             'tip': 'שכפול הקבצים הנבחרים',
-            'copy_suffix': ' - עותק'
+            'copy_suffix': ' - עותק',
+            'progress': 'משכפל',
+            'done': 'השכפול הושלם',
+            'cancelled': 'השכפול בוטל',
+            'failed': 'השכפול נכשל',
+            'cancel': 'ביטול'
         },
         'tr': {  # Turkish
             'label': 'Çoğalt',
             'tip': 'Seçili dosyaları çoğalt',
-            'copy_suffix': ' - kopya'
+            'copy_suffix': ' - kopya',
+            'progress': 'Çoğaltılıyor',
+            'done': 'Çoğaltma tamamlandı',
+            'cancelled': 'Çoğaltma iptal edildi',
+            'failed': 'Çoğaltma başarısız',
+            'cancel': 'İptal'
         }
     }
     
@@ -181,10 +305,814 @@ def get_localized_text():
 TEXTS = get_localized_text()
 
 
+class ProgressNotification:
+    """Desktop notification updated in place, at most once per interval"""
+
+    # Minimum seconds between two updates
+    INTERVAL = 0.5
+
+    def __init__(self, app_name, summary, cancel_label=None, on_cancel=None):
+        self.app_name = app_name
+        self.summary = summary
+        self.actions = ['cancel', cancel_label] if on_cancel else []
+        self.on_cancel = on_cancel
+        self.notification_id = 0
+        self.last_update = 0
+        self.in_flight = False
+        self.queued = None
+        self.finished = False
+        self.subscription = 0
+
+        try:
+            self.connection = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+            if on_cancel:
+                self.subscription = self.connection.signal_subscribe(
+                    'org.freedesktop.Notifications',
+                    'org.freedesktop.Notifications',
+                    'ActionInvoked',
+                    '/org/freedesktop/Notifications',
+                    None,
+                    Gio.DBusSignalFlags.NONE,
+                    self.on_action_invoked
+                )
+        except Exception as e:
+            print(f"Notifications unavailable: {e}")
+            self.connection = None
+
+    def update(self, body, force=False):
+        """Show new progress, unless the previous update is too recent"""
+        now = time.monotonic()
+        if self.finished or (not force and now - self.last_update < self.INTERVAL):
+            return
+        self.last_update = now
+        self.send(body)
+
+    def finish(self, summary, body):
+        """Replace the progress with a final message, which stays like any notification"""
+        self.finished = True
+        self.summary = summary
+        self.actions = []
+        if self.subscription:
+            self.connection.signal_unsubscribe(self.subscription)
+            self.subscription = 0
+        self.send(body)
+
+    def send(self, body):
+        """Create or replace the notification"""
+        if self.connection is None:
+            return
+        if self.in_flight:
+            # The notification id is needed to replace it, send once known
+            self.queued = body
+            return
+
+        self.in_flight = True
+        self.connection.call(
+            'org.freedesktop.Notifications',
+            '/org/freedesktop/Notifications',
+            'org.freedesktop.Notifications',
+            'Notify',
+            GLib.Variant('(susssasa{sv}i)', (
+                self.app_name,
+                self.notification_id,
+                'edit-copy',
+                self.summary,
+                body,
+                self.actions,
+                {'transient': GLib.Variant('b', not self.finished)},
+                -1
+            )),
+            GLib.VariantType('(u)'),
+            Gio.DBusCallFlags.NONE,
+            -1,
+            None,
+            self.on_notify_done
+        )
+
+    def on_notify_done(self, connection, result):
+        """Remember the notification id and send any update queued meanwhile"""
+        self.in_flight = False
+        try:
+            self.notification_id = connection.call_finish(result).unpack()[0]
+        except GLib.Error as e:
+            print(f"Failed to show notification: {e}")
+
+        if self.queued is not None:
+            body, self.queued = self.queued, None
+            self.send(body)
+
+    def on_action_invoked(self, connection, sender, path, interface, signal, parameters):
+        """Cancel the job when its notification button is clicked"""
+        notification_id, action = parameters.unpack()
+        if notification_id == self.notification_id and action == 'cancel':
+            self.on_cancel()
+
+class DuplicateCancelled(Exception):
+    """Raised in a worker to stop a duplication cancelled by the user"""
+
+class DuplicateJob:
+    """Progress of a duplication, shared between the main loop and its worker"""
+
+    def __init__(self, sources):
+        self.sources = sources
+        # Source -> (files, bytes) it holds
+        self.measures = {}
+        self.total_files = 0
+        self.total_bytes = 0
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self.duplicated = 0
+        self.failed = 0
+        # Copy tier -> number of files it copied
+        self.tiers = Counter()
+        self.started = time.monotonic()
+        self.last_report = 0
+        self.cancelled = threading.Event()
+        # Files are copied by several threads at once
+        self.lock = threading.Lock()
+        self.notification = None
+        # Timeout showing the progress, and whether the job is over (main loop)
+        self.show_source = 0
+        self.finished = False
+
+    def get_eta(self):
+        """Return the estimated seconds left, None until it can be told"""
+        elapsed = time.monotonic() - self.started
+        if not self.copied_bytes or elapsed < 1:
+            return None
+        rate = self.copied_bytes / elapsed
+        return max(0, self.total_bytes - self.copied_bytes) / rate
+
+class DuplicateEngine:
+    """Duplicate files and folders on worker threads
+
+    Progress (files, bytes, time left) is shown in a notification once a job
+    runs for more than SHOW_AFTER seconds, with a Cancel button. A cancelled
+    or failed duplicate is removed, the ones already finished are kept.
+    """
+
+    # Jobs copying at once, further ones wait for a free worker
+    MAX_JOBS = 2
+    # Most threads copying the files of a folder, fewer with fewer CPUs or a spinning disk
+    MAX_COPY_WORKERS = 8
+    # Folders holding fewer files are copied one file at a time on the job's thread
+    SMALL_TREE_FILES = 1000
+    # Batches of files queued for the copy threads at once, per thread
+    COPY_QUEUE = 4
+    # Small files are handed to the copy threads this many at a time, up to COPY_BATCH_BYTES
+    COPY_BATCH = 64
+    COPY_BATCH_BYTES = 8 * 1024 * 1024
+    # Bytes read and written at a time by the userspace copy
+    CHUNK_SIZE = 1024 * 1024
+    # Bytes copied by one kernel call, between cancellation checks
+    RANGE_SIZE = 64 * 1024 * 1024
+    # Ways to copy a file, fastest first, each one picks up where the previous gave up
+    TIERS = ('reflink', 'copy_file_range', 'sendfile', 'userspace')
+    # ioctl sharing the extents of a whole file on copy-on-write file systems (linux/fs.h)
+    FICLONE = 0x40049409
+    # Errors telling a tier doesn't work for these files
+    UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS}
+    # Seconds before a job shows its progress
+    SHOW_AFTER = 1.0
+    # Duplicates are written under a hidden name starting with this, then renamed
+    STAGING_PREFIX = '.duplicate-'
+    # One marker per duplicate being written, to find those left by a crash
+    STAGING_MARKERS = Path.home() / '.local' / 'share' / 'duplicate' / 'staging'
+    # Folders holding this many files are flushed by one syncfs of their file
+    # system rather than a fsync per file and folder, 0 to always use syncfs
+    SYNCFS_TREE_FILES = 1000
+    # renameat2 flag failing instead of replacing an existing name (linux/fs.h)
+    RENAME_NOREPLACE = 1
+    AT_FDCWD = -100
+
+    def __init__(self, app_name):
+        self.app_name = app_name
+        self.executor = None
+        # Final names are chosen and taken one duplicate at a time
+        self.name_lock = threading.Lock()
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        except OSError:
+            self.libc = None
+        # (tier, source device, destination device) known not to work
+        self.unsupported = set()
+        # Device -> number of threads copying onto it
+        self.copy_workers = {}
+
+    def start(self, paths):
+        """Duplicate paths in the background"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.MAX_JOBS,
+                thread_name_prefix='duplicate'
+            )
+        job = DuplicateJob(paths)
+        self.executor.submit(self.run, job)
+        job.show_source = GLib.timeout_add(int(self.SHOW_AFTER * 1000), self.on_show_timeout, job)
+        return job
+
+    def run(self, job):
+        """Measure, then duplicate every source of a job (worker thread)"""
+        try:
+            for source in job.sources:
+                files, size = self.measure(job, source)
+                job.measures[source] = (files, size)
+                job.total_files += files
+                job.total_bytes += size
+
+            for source in job.sources:
+                if job.cancelled.is_set():
+                    break
+                try:
+                    self.duplicate_single_file(job, source)
+                    job.duplicated += 1
+                except DuplicateCancelled:
+                    break
+                except Exception as e:
+                    # In case of error, continue with other files
+                    print(f"Error during duplication: {e}")
+                    job.failed += 1
+        except DuplicateCancelled:
+            pass
+        GLib.idle_add(self.finish_job, job)
+
+    def measure(self, job, path):
+        """Return the number of files and bytes to copy for a path"""
+        try:
+            if not os.path.isdir(path) or os.path.islink(path):
+                return 1, os.lstat(path).st_size
+        except OSError:
+            return 0, 0
+
+        files = 0
+        size = 0
+        stack = [path]
+        while stack:
+            if job.cancelled.is_set():
+                raise DuplicateCancelled()
+            try:
+                with os.scandir(stack.pop()) as iterator:
+                    for entry in iterator:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            files += 1
+                            if entry.is_file(follow_symlinks=False):
+                                size += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+        return files, size
+
+    def get_copy_path(self, original_path):
+        """Return a free name for the duplicate of a path"""
+        path = Path(original_path)
+        parent_dir = path.parent
+        name = path.stem
+        suffix = path.suffix
+
+        # Build copy name (localized)
+        copy_suffix = TEXTS['copy_suffix']
+        if suffix:
+            copy_name = f"{name}{copy_suffix}{suffix}"
+        else:
+            copy_name = f"{name}{copy_suffix}"
+
+        copy_path = parent_dir / copy_name
+
+        # Handle name conflicts
+        counter = 2
+        while os.path.lexists(copy_path):
+            if suffix:
+                copy_name = f"{name}{copy_suffix} {counter}{suffix}"
+            else:
+                copy_name = f"{name}{copy_suffix} {counter}"
+            copy_path = parent_dir / copy_name
+            counter += 1
+        return str(copy_path)
+
+    def duplicate_single_file(self, job, original_path):
+        """Duplicate a single file or folder
+
+        The copy is written to a hidden sibling and given its name by an atomic
+        rename once complete, so a duplicate under its final name is never
+        partial. If the extension dies first, sweep_staging removes it later.
+        """
+        is_dir = os.path.isdir(original_path)
+        if not is_dir and not os.path.isfile(original_path):
+            raise OSError(f"Not a file or folder: {original_path}")
+
+        staging_path, marker = self.create_staging(os.path.dirname(original_path), is_dir)
+        try:
+            try:
+                # Perform copy
+                if is_dir:
+                    self.copy_tree(job, original_path, staging_path)
+                else:
+                    self.copy_file(job, original_path, staging_path)
+                # The data reaches the disk before the name does
+                self.sync_staging(job, original_path, staging_path, is_dir)
+                copy_path = self.publish(staging_path, original_path)
+            except BaseException:
+                self.remove_partial(staging_path)
+                raise
+            # Then the name itself
+            self.sync_path(os.path.dirname(copy_path))
+        finally:
+            self.remove_marker(marker)
+
+    def create_staging(self, parent_dir, is_dir):
+        """Create a hidden file or folder to copy into, returns it with its marker"""
+        self.STAGING_MARKERS.mkdir(parents=True, exist_ok=True)
+        while True:
+            token = secrets.token_hex(8)
+            staging_path = os.path.join(parent_dir, f"{self.STAGING_PREFIX}{token}")
+            marker = self.STAGING_MARKERS / f"{os.getpid()}-{token}.json"
+            # The marker comes first, a crash must never leave an unknown staging entry
+            marker.write_text(json.dumps({'pid': os.getpid(), 'path': staging_path}))
+            try:
+                if is_dir:
+                    os.mkdir(staging_path, 0o700)
+                else:
+                    os.close(os.open(staging_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+                return staging_path, marker
+            except FileExistsError:
+                self.remove_marker(marker)
+            except BaseException:
+                self.remove_marker(marker)
+                raise
+
+    def remove_marker(self, marker):
+        """Forget a staging entry"""
+        try:
+            marker.unlink()
+        except OSError:
+            pass
+
+    def sync_staging(self, job, original_path, staging_path, is_dir):
+        """Flush a finished duplicate to disk, before it is given its name
+
+        A file, or a folder of few files, is flushed with fsync, files first
+        and folders deepest first; a big folder with a single syncfs, which
+        writes back its whole file system.
+        """
+        files, _ = job.measures.get(original_path, (0, 0))
+        if not is_dir:
+            self.sync_path(staging_path)
+        elif files >= self.SYNCFS_TREE_FILES:
+            self.sync_file_system(staging_path)
+        else:
+            for folder, _, names in os.walk(staging_path, topdown=False):
+                for name in names:
+                    path = os.path.join(folder, name)
+                    # A symbolic link is in its folder, flushed with it
+                    if not os.path.islink(path):
+                        self.sync_path(path)
+                self.sync_path(folder)
+
+    def sync_path(self, path):
+        """Flush a file or a folder entry list to disk"""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def sync_file_system(self, path):
+        """Flush the file system holding a path, a single syncfs for a whole folder"""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if self.libc is None or self.libc.syncfs(fd) != 0:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def publish(self, staging_path, original_path):
+        """Give a finished duplicate a free name in one rename, never replacing anything"""
+        with self.name_lock:
+            while True:
+                copy_path = self.get_copy_path(original_path)
+                try:
+                    self.rename_noreplace(staging_path, copy_path)
+                    return copy_path
+                except FileExistsError:
+                    # Taken by someone else meanwhile, pick the next name
+                    continue
+
+    def rename_noreplace(self, source, destination):
+        """Rename atomically, raising FileExistsError rather than replacing destination"""
+        if self.libc is not None and hasattr(self.libc, 'renameat2'):
+            result = self.libc.renameat2(
+                self.AT_FDCWD, os.fsencode(source),
+                self.AT_FDCWD, os.fsencode(destination),
+                self.RENAME_NOREPLACE
+            )
+            if result == 0:
+                return
+            error = ctypes.get_errno()
+            if error == errno.EEXIST:
+                raise FileExistsError(error, os.strerror(error), destination)
+            if error not in (errno.EINVAL, errno.ENOSYS):
+                raise OSError(error, os.strerror(error), source)
+        # No renameat2 here: check, then rename, under the name lock
+        if os.path.lexists(destination):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), destination)
+        os.rename(source, destination)
+
+    def sweep_staging(self):
+        """Remove the staging entries of duplications which never finished
+
+        Only the markers are listed, the file system isn't scanned; entries
+        of a process still running are left alone.
+        """
+        try:
+            markers = list(self.STAGING_MARKERS.iterdir())
+        except OSError:
+            return
+
+        orphans = []
+        for marker in markers:
+            try:
+                data = json.loads(marker.read_text())
+                pid = int(data['pid'])
+                staging_path = data['path']
+            except (OSError, ValueError, KeyError, TypeError):
+                self.remove_marker(marker)
+                continue
+            if pid != os.getpid() and self.is_running(pid):
+                continue
+            if os.path.basename(staging_path).startswith(self.STAGING_PREFIX):
+                orphans.append((marker, staging_path))
+            else:
+                self.remove_marker(marker)
+
+        if orphans:
+            threading.Thread(
+                target=self.remove_orphans, args=(orphans,), name='duplicate-sweep', daemon=True
+            ).start()
+
+    def is_running(self, pid):
+        """Tell whether a process exists"""
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def remove_orphans(self, orphans):
+        """Remove orphaned staging entries, then their markers (sweep thread)"""
+        for marker, staging_path in orphans:
+            if os.path.lexists(staging_path):
+                print(f"Removing unfinished duplicate {staging_path}")
+                self.remove_partial(staging_path)
+            self.remove_marker(marker)
+
+    def get_copy_workers(self, path):
+        """Return how many threads copy files onto the device holding a path
+
+        One on a spinning disk, where parallel writes only add seeks, else
+        one per CPU, fewer when the kind of device can't be told.
+        """
+        try:
+            device = os.stat(path).st_dev
+        except OSError:
+            return 1
+        workers = self.copy_workers.get(device)
+        if workers is None:
+            rotational = self.is_rotational(device)
+            cpus = os.cpu_count() or 1
+            if rotational:
+                workers = 1
+            elif rotational is None:
+                # Network, FUSE, tmpfs, btrfs volumes...
+                workers = min(cpus, self.MAX_COPY_WORKERS // 2)
+            else:
+                workers = min(cpus, self.MAX_COPY_WORKERS)
+            self.copy_workers[device] = workers
+        return workers
+
+    def is_rotational(self, device):
+        """Tell whether a block device is a spinning disk, None when unknown"""
+        block = f'/sys/dev/block/{os.major(device)}:{os.minor(device)}'
+        # A partition has the queue of its disk
+        for queue in (f'{block}/queue/rotational', f'{block}/../queue/rotational'):
+            try:
+                with open(queue) as rotational:
+                    return rotational.read().strip() == '1'
+            except OSError:
+                continue
+        return None
+
+    def copy_tree(self, job, source, destination):
+        """Copy the content of a folder into an existing one, symbolic links as links
+
+        Folders are created in order on this thread. Files are copied here
+        too for small trees or a single copy thread, else by a pool of copy
+        threads sized for the device. Folder metadata is applied last,
+        deepest first, once nothing is written into them anymore.
+        """
+        files, _ = job.measures.get(source, (0, 0))
+        workers = self.get_copy_workers(destination)
+        copy_executor = None
+        if workers > 1 and files >= self.SMALL_TREE_FILES:
+            copy_executor = ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix='duplicate-copy'
+            )
+        # (source, destination) of every folder, parents before children
+        folders = [(source, destination)]
+        stack = [(source, destination)]
+        running = set()
+        # [(source, destination)] of files for the next copy thread, and their size
+        batch = []
+        batch_bytes = 0
+        try:
+            while stack:
+                folder_source, folder_destination = stack.pop()
+                with os.scandir(folder_source) as iterator:
+                    for entry in iterator:
+                        if job.cancelled.is_set():
+                            raise DuplicateCancelled()
+                        target = os.path.join(folder_destination, entry.name)
+                        if entry.is_symlink():
+                            os.symlink(os.readlink(entry.path), target)
+                            shutil.copystat(entry.path, target, follow_symlinks=False)
+                            self.add_progress(job, 1, 0)
+                        elif entry.is_dir():
+                            os.mkdir(target)
+                            folders.append((entry.path, target))
+                            stack.append((entry.path, target))
+                        elif copy_executor is None and entry.is_file():
+                            self.copy_file(job, entry.path, target)
+                        elif entry.is_file():
+                            batch.append((entry.path, target))
+                            batch_bytes += entry.stat(follow_symlinks=False).st_size
+                            if len(batch) < self.COPY_BATCH and batch_bytes < self.COPY_BATCH_BYTES:
+                                continue
+                            if len(running) >= workers * self.COPY_QUEUE:
+                                running = self.wait_copies(running, FIRST_COMPLETED)
+                            running.add(copy_executor.submit(self.copy_files, job, batch))
+                            batch = []
+                            batch_bytes = 0
+                        else:
+                            # Sockets, pipes and devices aren't copied
+                            self.add_progress(job, 1, 0)
+            if batch:
+                running.add(copy_executor.submit(self.copy_files, job, batch))
+            self.wait_copies(running)
+        except BaseException:
+            # Stop the copies not started yet, the others end before cleanup
+            for future in running:
+                future.cancel()
+            wait(running)
+            raise
+        finally:
+            if copy_executor is not None:
+                copy_executor.shutdown(wait=False)
+
+        for folder_source, folder_destination in reversed(folders):
+            shutil.copystat(folder_source, folder_destination)
+
+    def wait_copies(self, running, return_when=ALL_COMPLETED):
+        """Wait for file copies, raising the first error, returns those still running"""
+        done, running = wait(running, return_when=return_when)
+        for future in done:
+            future.result()
+        return running
+
+    def copy_files(self, job, files):
+        """Copy a batch of (source, destination) files (copy thread)"""
+        for source, destination in files:
+            self.copy_file(job, source, destination)
+
+    def copy_file(self, job, source, destination):
+        """Copy a regular file with its metadata, with the fastest tier that works for it"""
+        with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+            source_fd = source_file.fileno()
+            destination_fd = destination_file.fileno()
+            status = os.fstat(source_fd)
+            devices = (status.st_dev, os.fstat(destination_fd).st_dev)
+
+            if status.st_blocks * 512 < status.st_size:
+                tiers = self.copy_sparse(job, source_fd, destination_fd, devices, status.st_size)
+            else:
+                tiers = {self.copy_range(job, source_fd, destination_fd, devices, 0, None)}
+        shutil.copystat(source, destination)
+        with job.lock:
+            for tier in tiers:
+                job.tiers[tier] += 1
+        self.add_progress(job, 1, 0)
+
+    def copy_range(self, job, source_fd, destination_fd, devices, offset, end):
+        """Copy from offset to end, or to the end of the file when None, returns the tier used
+
+        Each tier picks up at the offset where the previous one gave up, after
+        an error or a copy shorter than the file. A reflink clones whole files
+        only.
+        """
+        expected = end if end is not None else os.fstat(source_fd).st_size
+        # Next offset to copy, advanced by the tiers as they copy
+        position = [offset]
+        for tier in self.TIERS:
+            if (tier, devices) in self.unsupported:
+                continue
+            if tier == 'reflink' and (position[0] or end is not None):
+                continue
+            try:
+                getattr(self, f'copy_by_{tier}')(job, source_fd, destination_fd, position, end)
+            except OSError as e:
+                if tier == 'userspace' or e.errno not in self.UNSUPPORTED:
+                    raise
+                # Not for these file systems, don't try again with them
+                self.unsupported.add((tier, devices))
+                continue
+            if position[0] < expected and tier != 'userspace':
+                # Ended early, some file systems report 0 bytes instead of an error
+                continue
+            return tier
+
+    def copy_sparse(self, job, source_fd, destination_fd, devices, size):
+        """Copy a file with holes, leaving them in the duplicate, returns the tiers used
+
+        A reflink keeps the holes as it is. Otherwise only the data extents
+        found with SEEK_DATA and SEEK_HOLE are copied, since the kernel copies
+        would fill holes with zeros.
+        """
+        if ('reflink', devices) not in self.unsupported:
+            try:
+                self.copy_by_reflink(job, source_fd, destination_fd, [0], None)
+                return {'reflink', 'sparse'}
+            except OSError as e:
+                if e.errno not in self.UNSUPPORTED:
+                    raise
+                self.unsupported.add(('reflink', devices))
+
+        tiers = {'sparse'}
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(source_fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Only a hole is left
+                    break
+                if e.errno not in self.UNSUPPORTED or offset:
+                    raise
+                # No hole detection on this file system, copy it all
+                return {self.copy_range(job, source_fd, destination_fd, devices, 0, None)}
+            end = os.lseek(source_fd, start, os.SEEK_HOLE)
+            # The hole skipped counts as copied
+            self.add_progress(job, 0, start - offset)
+            tiers.add(self.copy_range(job, source_fd, destination_fd, devices, start, end))
+            offset = end
+
+        # Trailing hole
+        os.ftruncate(destination_fd, size)
+        self.add_progress(job, 0, max(0, size - offset))
+        return tiers
+
+    # The copy_by_* tiers copy from position[0] to end (to the end of the file
+    # when None) and move position[0] past every byte written, so that when one
+    # fails midway the next one neither copies nor counts those bytes again
+
+    def copy_by_reflink(self, job, source_fd, destination_fd, position, end):
+        """Share the extents of the source, instant and taking no space"""
+        fcntl.ioctl(destination_fd, self.FICLONE, source_fd)
+        size = os.fstat(destination_fd).st_size
+        position[0] = size
+        self.add_progress(job, 0, size)
+
+    def copy_by_copy_file_range(self, job, source_fd, destination_fd, position, end):
+        """Copy inside the kernel, which may offload it to the file system or the device"""
+        if not hasattr(os, 'copy_file_range'):
+            raise OSError(errno.ENOSYS, 'copy_file_range needs Python 3.8')
+        while end is None or position[0] < end:
+            if job.cancelled.is_set():
+                raise DuplicateCancelled()
+            offset = position[0]
+            count = self.RANGE_SIZE if end is None else min(self.RANGE_SIZE, end - offset)
+            copied = os.copy_file_range(source_fd, destination_fd, count, offset, offset)
+            if not copied:
+                break
+            position[0] = offset + copied
+            self.add_progress(job, 0, copied)
+
+    def copy_by_sendfile(self, job, source_fd, destination_fd, position, end):
+        """Copy inside the kernel through the page cache"""
+        os.lseek(destination_fd, position[0], os.SEEK_SET)
+        while end is None or position[0] < end:
+            if job.cancelled.is_set():
+                raise DuplicateCancelled()
+            offset = position[0]
+            count = self.RANGE_SIZE if end is None else min(self.RANGE_SIZE, end - offset)
+            copied = os.sendfile(destination_fd, source_fd, offset, count)
+            if not copied:
+                break
+            position[0] = offset + copied
+            self.add_progress(job, 0, copied)
+
+    def copy_by_userspace(self, job, source_fd, destination_fd, position, end):
+        """Read and write chunks, works everywhere"""
+        buffer = bytearray(self.CHUNK_SIZE)
+        view = memoryview(buffer)
+        while end is None or position[0] < end:
+            if job.cancelled.is_set():
+                raise DuplicateCancelled()
+            offset = position[0]
+            count = self.CHUNK_SIZE if end is None else min(self.CHUNK_SIZE, end - offset)
+            length = os.preadv(source_fd, [view[:count]], offset)
+            if not length:
+                break
+            written = 0
+            while written < length:
+                written += os.pwrite(destination_fd, view[written:length], offset + written)
+                # Written bytes are kept even if a later write fails
+                position[0] = offset + written
+            self.add_progress(job, 0, length)
+
+    def remove_partial(self, copy_path):
+        """Remove an unfinished duplicate"""
+        try:
+            if os.path.isdir(copy_path) and not os.path.islink(copy_path):
+                shutil.rmtree(copy_path)
+            else:
+                os.unlink(copy_path)
+        except OSError as e:
+            print(f"Error removing {copy_path}: {e}")
+
+    def add_progress(self, job, files, size):
+        """Count copied files and bytes, reporting them now and then (worker threads)"""
+        with job.lock:
+            job.copied_files += files
+            job.copied_bytes += size
+            now = time.monotonic()
+            if now - job.last_report < ProgressNotification.INTERVAL:
+                return
+            job.last_report = now
+        GLib.idle_add(self.show_progress, job)
+
+    def get_progress(self, job):
+        """Return the progress text of a job: files, bytes and time left"""
+        text = (f"{job.copied_files} / {job.total_files} · "
+                f"{GLib.format_size(job.copied_bytes)} / {GLib.format_size(job.total_bytes)}")
+        eta = job.get_eta()
+        if eta is not None:
+            minutes, seconds = divmod(int(eta), 60)
+            text += f" · {minutes}:{seconds:02d}"
+        return text
+
+    def on_show_timeout(self, job):
+        """Show the progress of a job still running after SHOW_AFTER (main loop)"""
+        job.show_source = 0
+        return self.show_progress(job)
+
+    def show_progress(self, job):
+        """Show the progress of a job running for long enough (main loop)"""
+        if job.finished:
+            return GLib.SOURCE_REMOVE
+        if job.notification is None:
+            if time.monotonic() - job.started < self.SHOW_AFTER:
+                return GLib.SOURCE_REMOVE
+            job.notification = ProgressNotification(
+                self.app_name, TEXTS['progress'], TEXTS['cancel'], job.cancelled.set
+            )
+        job.notification.update(self.get_progress(job))
+        return GLib.SOURCE_REMOVE
+
+    def finish_job(self, job):
+        """Report the end of a job, if it was long enough to show progress or went wrong (main loop)"""
+        job.finished = True
+        if job.show_source:
+            GLib.source_remove(job.show_source)
+            job.show_source = 0
+
+        if job.tiers:
+            print(f"Duplicated {job.copied_files} files ({GLib.format_size(job.copied_bytes)}): " +
+                  ', '.join(f"{tier} {count}" for tier, count in job.tiers.most_common()))
+
+        if job.cancelled.is_set():
+            summary = TEXTS['cancelled']
+        elif job.failed:
+            summary = TEXTS['failed']
+        else:
+            summary = TEXTS['done']
+
+        if job.notification is None and not job.failed:
+            return GLib.SOURCE_REMOVE
+        if job.notification is None:
+            job.notification = ProgressNotification(self.app_name, summary)
+        job.notification.finish(summary, self.get_progress(job))
+        return GLib.SOURCE_REMOVE
+
 class DuplicateExtension(GObject.GObject, Nautilus.MenuProvider):
     
     def __init__(self):
         super().__init__()
+        # Copies run on worker threads, never in the menu handler
+        self.engine = DuplicateEngine('Nautilus')
+        # Clean up after duplications interrupted by a crash or logout
+        self.engine.sweep_staging()
     
     def get_file_items(self, files):
         """Add 'Duplicate' option to context menu"""
@@ -207,51 +1135,16 @@ class DuplicateExtension(GObject.GObject, Nautilus.MenuProvider):
         return [item]
     
     def duplicate_files(self, menu, files):
-        """Duplicate selected files"""
+        """Duplicate selected files in the background"""
+        paths = []
         for file_info in files:
-            try:
-                # Get file path
-                uri = file_info.get_uri()
-                file_path = unquote(uri.replace('file://', ''))
-                
-                # Duplicate file
-                self.duplicate_single_file(file_path)
-                
-            except Exception as e:
-                # In case of error, continue with other files
-                print(f"Error during duplication: {e}")
-    
-    def duplicate_single_file(self, original_path):
-        """Duplicate a single file or folder"""
-        path = Path(original_path)
-        parent_dir = path.parent
-        name = path.stem
-        suffix = path.suffix
-        
-        # Build copy name (localized)
-        copy_suffix = TEXTS['copy_suffix']
-        if suffix:
-            copy_name = f"{name}{copy_suffix}{suffix}"
-        else:
-            copy_name = f"{name}{copy_suffix}"
-        
-        copy_path = parent_dir / copy_name
-        
-        # Handle name conflicts
-        counter = 2
-        while copy_path.exists():
-            if suffix:
-                copy_name = f"{name}{copy_suffix} {counter}{suffix}"
-            else:
-                copy_name = f"{name}{copy_suffix} {counter}"
-            copy_path = parent_dir / copy_name
-            counter += 1
-        
-        # Perform copy
-        if path.is_file():
-            shutil.copy2(original_path, str(copy_path))
-        elif path.is_dir():
-            shutil.copytree(original_path, str(copy_path))
+            # Get file path
+            file_path = Gio.File.new_for_uri(file_info.get_uri()).get_path()
+            if file_path:
+                paths.append(file_path)
+
+        if paths:
+            self.engine.start(paths)
 
 
 # Entry point for Nautilus
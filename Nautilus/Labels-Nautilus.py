@@ -2,13 +2,21 @@
 """
 A Nautilus Extension to add color labels on files, like in macOS and Pantheon Files
 Place in: ~/.local/share/nautilus-python/extensions/color_labels.py
+Needs color_labels_core.py (from Common/) in the same folder
 """
 import os
+import hashlib
+import time
+import threading
 import locale
-import subprocess
+from collections import OrderedDict
 from pathlib import Path
-from gi.repository import Nautilus, GObject, Gio
-from urllib.parse import unquote
+from gi.repository import Nautilus, GObject, Gio, GLib
+from color_labels_core import (
+    PALETTE, DEFAULT_BACKEND, UNKNOWN_LABEL, LABEL_BACKENDS, DirectoryEmblemPrefetcher,
+    LabelCache, LabelIndex, RefreshQueue, MountClassifier, LabelJobRunner, EmblemAssets,
+    get_file_path, iter_folder
+)
 
 def get_localized_text():
     """Returns texts according to system language"""
@@ -20,6 +28,9 @@ def get_localized_text():
             'remove_label': 'Remove Label',
             'tip_assign': 'Assign color labels to files',
             'tip_remove': 'Remove color label from files',
+            'cancel': 'Cancel',
+            'label_folder': 'Label All Items in This Folder',
+            'label_folder_recursive': 'Label All Items Including Subfolders',
             'colors': {
                 'blueberry': 'Blueberry',
                 'mint': 'Mint',
@@ -38,6 +49,9 @@ def get_localized_text():
             'remove_label': 'Etikett entfernen',
             'tip_assign': 'Farbetiketten zu Dateien hinzufügen',
             'tip_remove': 'Farbetikett von Dateien entfernen',
+            'cancel': 'Abbrechen',
+            'label_folder': 'Alle Objekte in diesem Ordner etikettieren',
+            'label_folder_recursive': 'Alle Objekte einschließlich Unterordnern etikettieren',
             'colors': {
                 'blueberry': 'Heidelbeere',
                 'mint': 'Minze',
@@ -56,6 +70,9 @@ def get_localized_text():
             'remove_label': 'Label verwijderen',
             'tip_assign': 'Kleurlabels toewijzen aan bestanden',
             'tip_remove': 'Kleurlabel verwijderen van bestanden',
+            'cancel': 'Annuleren',
+            'label_folder': 'Alle items in deze map labelen',
+            'label_folder_recursive': 'Alle items inclusief submappen labelen',
             'colors': {
                 'blueberry': 'Bosbes',
                 'mint': 'Munt',
@@ -74,6 +91,9 @@ def get_localized_text():
             'remove_label': 'Ta bort etikett',
             'tip_assign': 'Tilldela färgetiketter till filer',
             'tip_remove': 'Ta bort färgetikett från filer',
+            'cancel': 'Avbryt',
+            'label_folder': 'Märk alla objekt i den här mappen',
+            'label_folder_recursive': 'Märk alla objekt inklusive undermappar',
             'colors': {
                 'blueberry': 'Blåbär',
                 'mint': 'Mynta',
@@ -92,6 +112,9 @@ def get_localized_text():
             'remove_label': 'Fjern etiket',
             'tip_assign': 'Tildel farveetiketter til filer',
             'tip_remove': 'Fjern farveetiket fra filer',
+            'cancel': 'Annuller',
+            'label_folder': 'Mærk alle elementer i denne mappe',
+            'label_folder_recursive': 'Mærk alle elementer inklusive undermapper',
             'colors': {
                 'blueberry': 'Blåbær',
                 'mint': 'Mynte',
@@ -110,6 +133,9 @@ def get_localized_text():
             'remove_label': 'Fjern etikett',
             'tip_assign': 'Tildel fargetiketter til filer',
             'tip_remove': 'Fjern fargetikett fra filer',
+            'cancel': 'Avbryt',
+            'label_folder': 'Merk alle elementer i denne mappen',
+            'label_folder_recursive': 'Merk alle elementer inkludert undermapper',
             'colors': {
                 'blueberry': 'Blåbær',
                 'mint': 'Mynte',
@@ -128,6 +154,9 @@ def get_localized_text():
             'remove_label': 'Poista tunniste',
             'tip_assign': 'Määritä värillisiä tunnisteita tiedostoille',
             'tip_remove': 'Poista värillinen tunniste tiedostoista',
+            'cancel': 'Peruuta',
+            'label_folder': 'Merkitse kaikki tämän kansion kohteet',
+            'label_folder_recursive': 'Merkitse kaikki kohteet alikansiot mukaan lukien',
             'colors': {
                 'blueberry': 'Mustikka',
                 'mint': 'Minttu',
@@ -146,6 +175,9 @@ def get_localized_text():
             'remove_label': 'Supprimer l\'étiquette',
             'tip_assign': 'Assigner des étiquettes de couleur aux fichiers',
             'tip_remove': 'Supprimer l\'étiquette de couleur des fichiers',
+            'cancel': 'Annuler',
+            'label_folder': 'Étiqueter tous les éléments de ce dossier',
+            'label_folder_recursive': 'Étiqueter tous les éléments, sous-dossiers compris',
             'colors': {
                 'blueberry': 'Myrtille',
                 'mint': 'Menthe',
@@ -164,6 +196,9 @@ def get_localized_text():
             'remove_label': 'Rimuovi etichetta',
             'tip_assign': 'Assegna etichette colorate ai file',
             'tip_remove': 'Rimuovi etichetta colorata dai file',
+            'cancel': 'Annulla',
+            'label_folder': 'Etichetta tutti gli elementi di questa cartella',
+            'label_folder_recursive': 'Etichetta tutti gli elementi, sottocartelle incluse',
             'colors': {
                 'blueberry': 'Mirtillo',
                 'mint': 'Menta',
@@ -182,6 +217,9 @@ def get_localized_text():
             'remove_label': 'Eliminar etiqueta',
             'tip_assign': 'Asignar etiquetas de color a archivos',
             'tip_remove': 'Eliminar etiqueta de color de archivos',
+            'cancel': 'Cancelar',
+            'label_folder': 'Etiquetar todos los elementos de esta carpeta',
+            'label_folder_recursive': 'Etiquetar todos los elementos, incluidas las subcarpetas',
             'colors': {
                 'blueberry': 'Arándano',
                 'mint': 'Menta',
@@ -200,6 +238,9 @@ def get_localized_text():
             'remove_label': 'Remover etiqueta',
             'tip_assign': 'Atribuir etiquetas coloridas a arquivos',
             'tip_remove': 'Remover etiqueta colorida de arquivos',
+            'cancel': 'Cancelar',
+            'label_folder': 'Etiquetar todos os itens desta pasta',
+            'label_folder_recursive': 'Etiquetar todos os itens, incluindo subpastas',
             'colors': {
                 'blueberry': 'Mirtilo',
                 'mint': 'Hortelã',
@@ -218,6 +259,9 @@ def get_localized_text():
             'remove_label': 'Șterge eticheta',
             'tip_assign': 'Atribuie etichete colorate fișierelor',
             'tip_remove': 'Șterge eticheta colorată de pe fișiere',
+            'cancel': 'Anulează',
+            'label_folder': 'Etichetează toate elementele din acest dosar',
+            'label_folder_recursive': 'Etichetează toate elementele, inclusiv subdosarele',
             'colors': {
                 'blueberry': 'Afină',
                 'mint': 'Mentă',
@@ -236,6 +280,9 @@ def get_localized_text():
             'remove_label': 'Usuń etykietę',
             'tip_assign': 'Przypisz kolorowe etykiety do plików',
             'tip_remove': 'Usuń kolorową etykietę z plików',
+            'cancel': 'Anuluj',
+            'label_folder': 'Oznacz wszystkie elementy w tym folderze',
+            'label_folder_recursive': 'Oznacz wszystkie elementy wraz z podfolderami',
             'colors': {
                 'blueberry': 'Jagoda',
                 'mint': 'Mięta',
@@ -254,6 +301,9 @@ def get_localized_text():
             'remove_label': 'Címke eltávolítása',
             'tip_assign': 'Színes címkék hozzárendelése fájlokhoz',
             'tip_remove': 'Színes címke eltávolítása fájlokról',
+            'cancel': 'Mégse',
+            'label_folder': 'A mappa összes elemének címkézése',
+            'label_folder_recursive': 'Összes elem címkézése az almappákkal együtt',
             'colors': {
                 'blueberry': 'Áfonya',
                 'mint': 'Menta',
@@ -272,6 +322,9 @@ def get_localized_text():
             'remove_label': 'Удалить метку',
             'tip_assign': 'Назначить цветные метки файлам',
             'tip_remove': 'Удалить цветную метку с файлов',
+            'cancel': 'Отмена',
+            'label_folder': 'Пометить все объекты в этой папке',
+            'label_folder_recursive': 'Пометить все объекты, включая вложенные папки',
             'colors': {
                 'blueberry': 'Черника',
                 'mint': 'Мята',
@@ -290,6 +343,9 @@ def get_localized_text():
             'remove_label': '移除标签',
             'tip_assign': '为文件分配颜色标签',
             'tip_remove': '从文件移除颜色标签',
+            'cancel': '取消',
+            'label_folder': '标记此文件夹中的所有项目',
+            'label_folder_recursive': '标记所有项目（包括子文件夹）',
             'colors': {
                 'blueberry': '蓝莓',
                 'mint': '薄荷',
@@ -308,6 +364,9 @@ def get_localized_text():
             'remove_label': '移除標籤',
             'tip_assign': '為檔案分配顏色標籤',
             'tip_remove': '從檔案移除顏色標籤',
+            'cancel': '取消',
+            'label_folder': '標記此資料夾中的所有項目',
+            'label_folder_recursive': '標記所有項目（包括子資料夾）',
             'colors': {
                 'blueberry': '藍莓',
                 'mint': '薄荷',
@@ -326,6 +385,9 @@ def get_localized_text():
             'remove_label': 'ラベルを削除',
             'tip_assign': 'ファイルにカラーラベルを設定',
             'tip_remove': 'ファイルからカラーラベルを削除',
+            'cancel': 'キャンセル',
+            'label_folder': 'このフォルダー内のすべての項目にラベルを付ける',
+            'label_folder_recursive': 'サブフォルダーを含むすべての項目にラベルを付ける',
             'colors': {
                 'blueberry': 'ブルーベリー',
                 'mint': 'ミント',
@@ -344,6 +406,9 @@ def get_localized_text():
             'remove_label': '라벨 제거',
             'tip_assign': '파일에 컬러 라벨 할당',
             'tip_remove': '파일에서 컬러 라벨 제거',
+            'cancel': '취소',
+            'label_folder': '이 폴더의 모든 항목에 레이블 지정',
+            'label_folder_recursive': '하위 폴더를 포함한 모든 항목에 레이블 지정',
             'colors': {
                 'blueberry': '블루베리',
                 'mint': '민트',
@@ -362,6 +427,9 @@ def get_localized_text():
             'remove_label': 'लेबल हटाएं',
             'tip_assign': 'फाइलों को रंगीन लेबल असाइन करें',
             'tip_remove': 'फाइलों से रंगीन लेबल हटाएं',
+            'cancel': 'रद्द करें',
+            'label_folder': 'इस फ़ोल्डर के सभी आइटम लेबल करें',
+            'label_folder_recursive': 'सबफ़ोल्डर सहित सभी आइटम लेबल करें',
             'colors': {
                 'blueberry': 'ब्लूबेरी',
                 'mint': 'पुदीना',
@@ -380,6 +448,9 @@ def get_localized_text():
             'remove_label': 'إزالة التسمية',
             'tip_assign': 'تعيين تسميات ملونة للملفات',
             'tip_remove': 'إزالة التسمية الملونة من الملفات',
+            'cancel': 'إلغاء',
+            'label_folder': 'تسمية كل العناصر في هذا المجلد',
+            'label_folder_recursive': 'تسمية كل العناصر بما فيها المجلدات الفرعية',
             'colors': {
                 'blueberry': 'توت أزرق',
                 'mint': 'نعناع',
@@ -398,6 +469,9 @@ def get_localized_text():
             'remove_label': 'הסר תווית',
             'tip_assign': 'הקצה תוויות צבעוניות לקבצים',
             'tip_remove': 'הסר תווית צבעונית מקבצים',
+            'cancel': 'ביטול',
+            'label_folder': 'תיוג כל הפריטים בתיקייה זו',
+            'label_folder_recursive': 'תיוג כל הפריטים כולל תיקיות משנה',
             'colors': {
                 'blueberry': 'אוכמנית',
                 'mint': 'נענע',
@@ -416,6 +490,9 @@ def get_localized_text():
             'remove_label': 'Etiketi kaldır',
             'tip_assign': 'Dosyalara renkli etiketler ata',
             'tip_remove': 'Dosyalardan renkli etiketi kaldır',
+            'cancel': 'İptal',
+            'label_folder': 'Bu klasördeki tüm öğeleri etiketle',
+            'label_folder_recursive': 'Alt klasörler dahil tüm öğeleri etiketle',
             'colors': {
                 'blueberry': 'Yaban mersini',
                 'mint': 'Nane',
@@ -478,138 +555,211 @@ def get_localized_text():
 # Get localized texts
 TEXTS = get_localized_text()
 
+class MenuSelection:
+    """Files the context menu was last shown for
+
+    Menu items are built once and read the selection from this single handle
+    on activation, instead of each capturing the file list, so showing the
+    menu costs the same for one file or a hundred thousand.
+    """
+
+    def __init__(self):
+        self.files = None
+        # Labels every selected file has, 0 when unknown
+        self.all_labels = 0
+        # Folder the background menu was last shown for
+        self.folder = None
+
+    def current(self):
+        """Return the selected files, kept until the menu is shown again"""
+        return self.files or []
+
 class ColorLabelsExtension(GObject.GObject, Nautilus.MenuProvider, Nautilus.InfoProvider):
 
-    COLORS = {
-        'blueberry': {
-            'name': 'Blueberry',
-            'emoji': '🔵',
-            'hex': '#3689e6',
-            'emblem': 'label-blueberry'
-        },
-        'mint': {
-            'name': 'Mint',
-            'emoji': '🟢',
-            'hex': '#28bca3',
-            'emblem': 'label-mint'
-        },
-        'banana': {
-            'name': 'Banana',
-            'emoji': '🟡',
-            'hex': '#f9c440',
-            'emblem': 'label-banana'
-        },
-        'orange': {
-            'name': 'Orange',
-            'emoji': '🟠',
-            'hex': '#ffa154',
-            'emblem': 'label-orange'
-        },
-        'strawberry': {
-            'name': 'Strawberry',
-            'emoji': '🔴',
-            'hex': '#ed5353',
-            'emblem': 'label-strawberry'
-        },
-        'grape': {
-            'name': 'Grape',
-            'emoji': '🟣',
-            'hex': '#a56de2',
-            'emblem': 'label-grape'
-        },
-        'cocoa': {
-            'name': 'Cocoa',
-            'emoji': '🟤',
-            'hex': '#8a715e',
-            'emblem': 'label-cocoa'
-        },
-        'slate': {
-            'name': 'Slate',
-            'emoji': '⚪',
-            'hex': '#667885',
-            'emblem': 'label-slate'
-        }
-    }
+    # Label colors, shared with the command line
+    COLORS = PALETTE
+
+    # Number of files whose label is kept in memory
+    LABEL_CACHE_SIZE = 50000
+    # Labels kept from reads on slow mounts, and for how many seconds
+    DEFERRED_CACHE_SIZE = 5000
+    DEFERRED_LIFETIME = 30
+    # Largest selection whose labels are marked in the Label menu
+    MENU_STATE_LIMIT = 500
+    # Where labels are stored, one of LABEL_BACKENDS
+    LABEL_BACKEND = DEFAULT_BACKEND
 
     def __init__(self):
         super().__init__()
+        # Pending asynchronous emblem lookups, by operation handle
+        self.pending_lookups = {}
+        # (mount point, token) timing the lookups on mounts with a latency budget
+        self.lookup_timers = {}
+        # Label storage
+        self.backend = LABEL_BACKENDS[self.LABEL_BACKEND](
+            color_info['emblem'] for color_info in self.COLORS.values()
+        )
+        # Directory-level emblem snapshots
+        self.prefetcher = DirectoryEmblemPrefetcher(self.backend)
+        # Labels already looked up, until the file or its directory changes
+        self.label_cache = LabelCache(self.LABEL_CACHE_SIZE, on_change=self.prefetcher.forget)
+        # Files to redraw after a label operation
+        self.refresh_queue = RefreshQueue()
+        # Persistent index of labelled files
+        try:
+            self.label_index = LabelIndex(self.backend.labels)
+        except Exception as e:
+            print(f"Label index unavailable: {e}")
+            self.label_index = None
+        # Background writer for large selections
+        self.job_runner = LabelJobRunner('Nautilus')
+        # How labels are read on each mount, and labels read off the main loop
+        self.mounts = MountClassifier()
+        self.deferred_labels = OrderedDict()
+        self.deferred_reads = set()
+        # Context menu, built on first use, and the selection it applies to
+        self.menu_items = None
+        self.background_items = None
+        self.color_items = {}
+        self.selection = MenuSelection()
         # Check and create emblems if necessary
         self.ensure_emblems_exist()
 
-    def ensure_emblems_exist(self):
-        """Check and create SVG emblems if they don't exist"""
-        emblem_dir = Path.home() / '.local' / 'share' / 'icons' / 'hicolor' / '16x16' / 'emblems'
-
-        try:
-            # Create directory if it doesn't exist
-            emblem_dir.mkdir(parents=True, exist_ok=True)
+    # Stamp files recording which palette the emblems were generated for
+    EMBLEM_STAMP_DIR = Path.home() / '.local' / 'share' / 'color-labels'
 
-            # Check if all emblems exist
-            missing_emblems = []
-            for color_id, color_info in self.COLORS.items():
-                emblem_file = emblem_dir / f"{color_info['emblem']}.svg"
-                if not emblem_file.exists():
-                    missing_emblems.append((color_id, color_info))
+    def emblem_stamp(self):
+        """Return the stamp file of the current palette"""
+        palette = ';'.join(
+            f"{color_info['emblem']}={color_info['hex']}" for color_info in self.COLORS.values()
+        )
+        palette += f';version={EmblemAssets.VERSION}'
+        digest = hashlib.sha1(palette.encode()).hexdigest()[:16]
+        return self.EMBLEM_STAMP_DIR / f'emblems-{digest}.stamp'
 
-            # Create missing emblems
-            if missing_emblems:
-                print(f"Creating {len(missing_emblems)} missing color emblems...")
-                for color_id, color_info in missing_emblems:
-                    self.create_emblem_svg(color_info['emblem'], color_info['hex'], emblem_dir)
+    def ensure_emblems_exist(self):
+        """Schedule emblem creation unless they were generated for this palette
 
-                # Update icon cache
-                self.update_icon_cache()
+        A warm start costs a single stat of the stamp file, rendering emblems and
+        rebuilding the icon cache is left to a background thread once the file
+        manager is idle.
+        """
+        stamp = self.emblem_stamp()
+        if stamp.exists():
+            return
 
-        except Exception as e:
-            print(f"Error ensuring emblems exist: {e}")
+        def provision():
+            threading.Thread(
+                target=self.provision_emblems,
+                args=(stamp,),
+                name='color-labels-emblems',
+                daemon=True
+            ).start()
+            return GLib.SOURCE_REMOVE
 
-    def create_emblem_svg(self, emblem_name, hex_color, emblem_dir):
-        """Create a colored emblem SVG file"""
-        svg_content = f'''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-<svg
-   width="16"
-   height="16"
-   viewBox="0 0 4.233333 4.233333"
-   version="1.1"
-   id="svg1"
-   xmlns="http://www.w3.org/2000/svg"
-   xmlns:svg="http://www.w3.org/2000/svg">
-  <defs
-     id="defs1" />
-  <g
-     id="layer1">
-    <ellipse
-       style="fill:{hex_color};fill-opacity:1;stroke-width:0.264999"
-       id="path1"
-       cx="2.1166666"
-       cy="2.1166666"
-       rx="2.1170001"
-       ry="2.1166666" />
-  </g>
-</svg>'''
+        GLib.idle_add(provision, priority=GLib.PRIORITY_LOW)
 
+    def provision_emblems(self, stamp):
+        """Render missing or outdated emblems, then record the palette in its stamp file"""
         try:
-            svg_file = emblem_dir / f"{emblem_name}.svg"
-            svg_file.write_text(svg_content)
-            print(f"✓ Created: {svg_file}")
-        except Exception as e:
-            print(f"Error creating {emblem_name}.svg: {e}")
+            assets = EmblemAssets({
+                color_info['emblem']: color_info['hex'] for color_info in self.COLORS.values()
+            })
+            if not assets.provision():
+                # Retry on next start
+                return
+
+            stamp.parent.mkdir(parents=True, exist_ok=True)
+            for old_stamp in stamp.parent.glob('emblems-*.stamp'):
+                old_stamp.unlink(missing_ok=True)
+            stamp.touch()
 
-    def update_icon_cache(self):
-        """Update icon cache"""
-        try:
-            hicolor_dir = Path.home() / '.local' / 'share' / 'icons' / 'hicolor'
-            subprocess.run(['gtk-update-icon-cache', str(hicolor_dir)],
-                         check=False, capture_output=True)
-            print("✓ Icon cache updated")
         except Exception as e:
-            print(f"Warning: Could not update icon cache: {e}")
+            print(f"Error ensuring emblems exist: {e}")
 
     def get_file_items(self, files):
         """Create Label menu with color submenu"""
         if not files:
             return []
 
+        # The same items serve every selection, see MenuSelection
+        self.selection.files = files
+        if self.menu_items is None:
+            self.menu_items = self.build_menu()
+
+        # Mark the labels the selection already has
+        state = self.get_selection_labels(files)
+        all_labels, any_labels = state or (0, 0)
+        self.selection.all_labels = all_labels
+        for color_id, color_item in self.color_items.items():
+            bit = self.backend.labels.from_emblems([self.COLORS[color_id]['emblem']])
+            if all_labels & bit:
+                mark = 'all'
+            elif any_labels & bit:
+                mark = 'mixed'
+            else:
+                mark = None
+            label = self.get_color_item_label(color_id, mark)
+            if color_item.get_property('label') != label:
+                color_item.set_property('label', label)
+        return self.menu_items
+
+    def get_background_items(self, current_folder):
+        """Label every item of the folder from the background menu"""
+        if not get_file_path(current_folder):
+            return []
+
+        self.selection.folder = current_folder
+        if self.background_items is None:
+            self.background_items = self.build_background_menu()
+        return self.background_items
+
+    def get_selection_labels(self, files):
+        """Return masks of the labels (all files have, any file has), or None if unknown
+
+        Only labels already known are used, from the cache, a directory
+        snapshot or a read on a slow mount, so showing the menu never reads
+        label storage. Large selections aren't looked at.
+        """
+        if len(files) > self.MENU_STATE_LIMIT:
+            return None
+
+        every_label = self.backend.labels.all
+        all_labels = every_label
+        any_labels = 0
+        for file_info in files:
+            file_path = get_file_path(file_info)
+            if not file_path:
+                return None
+
+            found = False
+            if self.mounts.get_mode(file_path)[0] == 'sync':
+                found, labels = self.label_cache.get(file_path)
+            if not found:
+                found, labels = self.peek_labels(file_path)
+            if not found:
+                return None
+
+            all_labels &= labels
+            any_labels |= labels
+            # Every label is mixed, the other files can't change anything
+            if not all_labels and any_labels == every_label:
+                break
+        return all_labels, any_labels
+
+    def get_color_item_label(self, color_id, mark=None):
+        """Return the menu text of a color, marked 'all' or 'mixed' for the selection"""
+        color_info = self.COLORS[color_id]
+        color_name = TEXTS['colors'].get(color_id, color_info['name'])
+        label = f"{color_info['emoji']} {color_name}"
+        if mark == 'all':
+            return f"{label} ✓"
+        if mark == 'mixed':
+            return f"{label} –"
+        return label
+
+    def build_menu(self):
+        """Create the Label menu items, once for the lifetime of the extension"""
         main_item = Nautilus.MenuItem(
             name='ColorLabels::main',
             label=TEXTS['label'],
@@ -619,15 +769,17 @@ class ColorLabelsExtension(GObject.GObject, Nautilus.MenuProvider, Nautilus.Info
         submenu = Nautilus.Menu()
         main_item.set_submenu(submenu)
 
+        self.color_items = {}
         for color_id, color_info in self.COLORS.items():
             color_name = TEXTS['colors'].get(color_id, color_info['name'])
             color_item = Nautilus.MenuItem(
                 name=f'ColorLabels::{color_id}',
-                label=f"{color_info['emoji']} {color_name}",
+                label=self.get_color_item_label(color_id),
                 tip=f"Label files as {color_name}"
             )
-            color_item.connect('activate', self.apply_color_label, files, color_id)
+            color_item.connect('activate', self.on_color_activated, color_id)
             submenu.append_item(color_item)
+            self.color_items[color_id] = color_item
 
         # Add separator
         try:
@@ -654,120 +806,408 @@ class ColorLabelsExtension(GObject.GObject, Nautilus.MenuProvider, Nautilus.Info
             label=TEXTS["remove_label"],
             tip=TEXTS['tip_remove']
         )
-        remove_item.connect('activate', self.remove_color_label, files)
+        remove_item.connect('activate', self.on_remove_activated)
         submenu.append_item(remove_item)
 
         return [main_item]
 
+    def build_background_menu(self):
+        """Create the folder menu items, a color submenu for this folder and one with subfolders"""
+        items = []
+        for name, text, recursive in (
+            ('folder', TEXTS['label_folder'], False),
+            ('tree', TEXTS['label_folder_recursive'], True)
+        ):
+            folder_item = Nautilus.MenuItem(
+                name=f'ColorLabels::{name}',
+                label=text,
+                tip=TEXTS['tip_assign']
+            )
+            submenu = Nautilus.Menu()
+            folder_item.set_submenu(submenu)
+            for color_id, color_info in self.COLORS.items():
+                color_item = Nautilus.MenuItem(
+                    name=f'ColorLabels::{name}::{color_id}',
+                    label=self.get_color_item_label(color_id)
+                )
+                color_item.connect('activate', self.on_folder_color_activated, color_id, recursive)
+                submenu.append_item(color_item)
+            items.append(folder_item)
+        return items
+
+    def on_folder_color_activated(self, menu, color_id, recursive):
+        """Label the items of the folder the background menu was shown for"""
+        folder = self.selection.folder
+        if folder is not None:
+            self.label_folder(
+                folder,
+                self.backend.labels.from_emblems([self.COLORS[color_id]['emblem']]),
+                recursive
+            )
+
+    def label_folder(self, folder, add, recursive):
+        """Add a label mask to every item of a folder
+
+        Items are listed and written in the background, in batches, and can be
+        cancelled from the progress notification.
+        """
+        directory = get_file_path(folder)
+        if not directory:
+            return
+
+        self.job_runner.start_stream(
+            ([None, file_path, UNKNOWN_LABEL] for file_path in iter_folder(directory, recursive)),
+            lambda item: self.write_label_item(item, add, 0),
+            lambda item: self.show_folder_item(directory, item),
+            TEXTS['label'],
+            TEXTS['cancel'],
+            lambda job: self.report_writes(job.done, job.writes, job.done * 2)
+        )
+
+    def show_folder_item(self, directory, item):
+        """Display a label written by label_folder, redrawing items shown in the folder (main loop)"""
+        if os.path.dirname(item[1]) == directory:
+            item[0] = self.get_file_info(item[1])
+        self.show_color_label(item[0], item[1], item[2])
+
+    def get_file_info(self, file_path):
+        """Return the Nautilus file of a path, or None when it can't be had"""
+        try:
+            return Nautilus.FileInfo.create_for_uri(Gio.File.new_for_path(file_path).get_uri())
+        except Exception:
+            return None
+
+    def on_color_activated(self, menu, color_id):
+        """Label the files the menu was shown for, unless they all have the label already"""
+        files = self.selection.current()
+        bit = self.backend.labels.from_emblems([self.COLORS[color_id]['emblem']])
+        if self.selection.all_labels & bit:
+            # Checked label: take it off
+            self.run_label_job(files, 0, bit)
+        else:
+            self.apply_color_label(menu, files, color_id)
+
+    def on_remove_activated(self, menu):
+        """Remove labels from the files the menu was shown for"""
+        self.remove_color_label(menu, self.selection.current())
+
     def apply_color_label(self, menu, files, color_id):
         """Apply color label to selected files"""
         color_info = self.COLORS.get(color_id)
         if not color_info:
             return
 
-        for file_info in files:
-            try:
-                uri = file_info.get_uri()
-                file_path = unquote(uri.replace('file://', ''))
+        # Added to the labels the files already have
+        self.run_label_job(files, self.backend.labels.from_emblems([color_info['emblem']]), 0)
+
+    def remove_color_label(self, menu, files):
+        """Remove color labels from selected files"""
+        self.run_label_job(files, 0, self.backend.labels.all)
 
-                # 1. Remove current emblem
-                self.remove_emblem_metadata(file_path)
+    def run_label_job(self, files, add, remove):
+        """Add and remove label masks on files, in the background for large selections"""
+        items = []
+        remote = False
+        for file_info in files:
+            file_path = get_file_path(file_info)
+            if not file_path:
+                continue
+            # Files off local mounts are always written in the background
+            remote = remote or self.mounts.get_mode(file_path)[0] != 'sync'
+            # The known labels are replaced with the written ones
+            items.append([file_info, file_path, self.get_known_label(file_path)])
 
-                # 2. Add new emblem directly via Nautilus (immediate display)
-                file_info.add_emblem(color_info['emblem'])
+        # Writes the previous remove-then-set scheme needed, for reporting
+        legacy_writes = len(items) * (2 if add else 1)
 
-                # 3. Store new emblem in metadata for persistence
-                self.set_emblem_metadata(file_path, color_info['emblem'])
+        if remote or len(items) > LabelJobRunner.SMALL_SELECTION:
+            self.job_runner.start(
+                items,
+                lambda item: self.write_label_item(item, add, remove),
+                lambda item: self.show_color_label(item[0], item[1], item[2]),
+                TEXTS['label'],
+                TEXTS['cancel'],
+                lambda job: self.report_writes(job.done, job.writes, legacy_writes)
+            )
+            return
 
-                # 4. Refresh file immediately
-                self.refresh_file(file_path)
+        writes = 0
+        for item in items:
+            try:
+                writes += self.write_label_item(item, add, remove)
+                self.show_color_label(item[0], item[1], item[2])
 
             except Exception as e:
                 print(f"Error applying label: {e}")
                 continue
 
-    def remove_color_label(self, menu, files):
-        """Remove color label from selected files"""
-        for file_info in files:
-            try:
-                uri = file_info.get_uri()
-                file_path = unquote(uri.replace('file://', ''))
+        self.report_writes(len(items), writes, legacy_writes)
 
-                # 1. Remove emblem from metadata
-                self.remove_emblem_metadata(file_path)
+    def get_known_label(self, file_path):
+        """Return the label mask known without querying metadata, or UNKNOWN_LABEL"""
+        if self.mounts.get_mode(file_path)[0] != 'sync':
+            found, labels = self.peek_labels(file_path)
+            return (labels or 0) if found else UNKNOWN_LABEL
 
-                # 2. Refresh file
-                self.refresh_file(file_path)
+        found, labels = self.label_cache.get(file_path)
+        if not found:
+            prefetched = self.prefetcher.peek(file_path)
+            if prefetched is None or not prefetched[0]:
+                return UNKNOWN_LABEL
+            labels = prefetched[1]
+        return labels or 0
 
-            except Exception as e:
-                print(f"Error removing label: {e}")
-                continue
+    def write_label_item(self, item, add, remove):
+        """Write the labels of a [file info, path, labels] item, keeping the result in it"""
+        writes, item[2] = self.write_color_label(item[1], add, remove, item[2])
+        return writes
 
-    def set_emblem_metadata(self, file_path, emblem):
-        """Store emblem in file metadata"""
-        try:
-            file = Gio.File.new_for_path(file_path)
-            file.set_attribute_string(
-                'metadata::emblems',
-                emblem,
-                Gio.FileQueryInfoFlags.NONE,
-                None
-            )
-        except Exception as e:
-            print(f"Failed to set emblem metadata: {e}")
+    def write_color_label(self, file_path, add, remove, current=UNKNOWN_LABEL):
+        """Add and remove labels in file metadata, returns (writes, labels) (safe from worker threads)"""
+        # 1. Read current labels when they aren't known yet
+        if current is UNKNOWN_LABEL:
+            current = self.backend.read(file_path)
+
+        # 2. Nothing to do if the file already has these labels
+        labels = (current & ~remove) | add
+        if labels == current:
+            return 0, current
+
+        # 3. Replace the labels in a single metadata write
+        if not self.set_emblem_metadata(file_path, labels):
+            return 0, current
+        return 1, labels
+
+    def show_color_label(self, file_info, file_path, labels):
+        """Display a label change, file_info may be None for files not shown (main thread only)"""
+        # 1. Add new emblems directly via Nautilus (immediate display)
+        if file_info is not None:
+            self.add_label_emblems(file_info, labels)
+
+        # 2. Update what is known about the labels of the file
+        self.prefetcher.update(file_path, labels)
+        self.label_cache.invalidate(file_path)
+        if file_path in self.deferred_labels:
+            self.remember_deferred(file_path, labels)
+        if self.label_index:
+            self.label_index.record(file_path, labels)
+
+        # 3. Refresh file
+        if file_info is not None:
+            self.refresh_file(file_info)
+
+    def report_writes(self, files, writes, legacy_writes):
+        """Log how many metadata writes a label operation needed"""
+        print(f"Labelled {files} files with {writes} metadata writes "
+              f"({legacy_writes - writes} saved)")
+
+    def set_emblem_metadata(self, file_path, labels):
+        """Store a label mask in label storage with a single write, returns True on success"""
+        return self.backend.write(file_path, labels)
 
     def remove_emblem_metadata(self, file_path):
-        """Remove emblem from file metadata"""
-        try:
-            file = Gio.File.new_for_path(file_path)
-            file.set_attribute_string(
-                'metadata::emblems',
-                '',
-                Gio.FileQueryInfoFlags.NONE,
-                None
-            )
-        except Exception as e:
-            print(f"Failed to remove emblem metadata: {e}")
+        """Remove every label from label storage"""
+        return self.backend.write(file_path, 0)
+
+    def add_label_emblems(self, file, labels):
+        """Show every label of a file as an emblem"""
+        for emblem in self.backend.labels.to_emblems(labels):
+            file.add_emblem(emblem)
+
+    def refresh_file(self, file_info):
+        """Force file refresh in Nautilus, without touching the file itself"""
+        # Redraw once the whole label operation is done
+        self.refresh_queue.add(file_info)
 
-    def refresh_file(self, file_path):
-        """Force file refresh in Nautilus"""
+    def update_file_info_full(self, provider, handle, closure, file):
+        """Reload emblems from metadata without blocking the main loop"""
         try:
-            # Use Gio to trigger change event
-            file = Gio.File.new_for_path(file_path)
-            file.monitor_file(Gio.FileMonitorFlags.NONE, None)
-            # Touch file to force refresh
-            os.utime(file_path, None)
+            file_path = get_file_path(file)
+            if not file_path:
+                return Nautilus.OperationResult.COMPLETE
+
+            mode, mount_point = self.mounts.get_mode(file_path)
+            if mode == 'skip':
+                return Nautilus.OperationResult.COMPLETE
+            if mode == 'deferred':
+                self.read_deferred(file, file_path, mount_point)
+                return Nautilus.OperationResult.COMPLETE
+
+            # Answer directly when the label is cached or the directory already enumerated,
+            # the label cache stats files so it only serves local mounts
+            found, labels = self.label_cache.get(file_path) if mode == 'sync' else (False, None)
+            if not found:
+                prefetched = self.prefetcher.peek(file_path)
+                if prefetched is not None and prefetched[0]:
+                    found, labels = prefetched
+                    self.cache_labels(file_path, labels)
+
+            if found:
+                self.add_label_emblems(file, labels)
+                return Nautilus.OperationResult.COMPLETE
+
+            cancellable = Gio.Cancellable()
+            self.pending_lookups[handle] = cancellable
+            if mode == 'async':
+                self.lookup_timers[handle] = (mount_point, self.mounts.begin(mount_point))
+            data = (provider, handle, closure, file, cancellable)
+
+            if prefetched is None:
+                # First child of this directory: enumerate it once for all
+                self.prefetcher.request(
+                    file_path,
+                    lambda found, labels: self.on_emblem_prefetched(found, labels, file_path, data)
+                )
+            else:
+                self.query_emblem_async(file_path, data)
+            return Nautilus.OperationResult.IN_PROGRESS
+
         except Exception as e:
-            print(f"Failed to refresh file: {e}")
+            print(f"Error updating file info: {e}")
+            return Nautilus.OperationResult.FAILED
+
+    def query_emblem_async(self, file_path, data):
+        """Query the labels of a single file, the emblems are added once ready"""
+        cancellable = data[4]
+        self.backend.read_async(
+            file_path,
+            cancellable,
+            lambda labels, error: self.on_emblem_read(labels, error, file_path, data)
+        )
+
+    def on_emblem_prefetched(self, found, labels, file_path, data):
+        """Add emblems from a directory snapshot and complete the update"""
+        provider, handle, closure, file, cancellable = data
+
+        # Nautilus must not be notified about cancelled updates
+        if self.pending_lookups.get(handle) is not cancellable:
+            return
+
+        if not found:
+            # Not part of the snapshot, fall back to a single query
+            self.query_emblem_async(file_path, data)
+            return
+
+        del self.pending_lookups[handle]
+        self.end_lookup_timer(handle)
+        self.cache_labels(file_path, labels)
+        self.add_label_emblems(file, labels)
+        Nautilus.info_provider_update_complete_invoke(
+            closure, provider, handle, Nautilus.OperationResult.COMPLETE
+        )
+
+    def on_emblem_read(self, labels, error, file_path, data):
+        """Add emblems from an asynchronous label read and complete the update"""
+        provider, handle, closure, file, cancellable = data
+
+        # Nautilus must not be notified about cancelled updates
+        if self.pending_lookups.get(handle) is not cancellable:
+            return
+        del self.pending_lookups[handle]
+        self.end_lookup_timer(handle)
+
+        status = Nautilus.OperationResult.COMPLETE
+        if error is not None:
+            print(f"Error updating file info: {error}")
+            status = Nautilus.OperationResult.FAILED
+        else:
+            self.cache_labels(file_path, labels)
+            self.add_label_emblems(file, labels)
+
+        Nautilus.info_provider_update_complete_invoke(closure, provider, handle, status)
+
+    def cancel_update(self, provider, handle):
+        """Cancel a pending asynchronous labels lookup"""
+        cancellable = self.pending_lookups.pop(handle, None)
+        if cancellable:
+            cancellable.cancel()
+        self.end_lookup_timer(handle)
+
+    def end_lookup_timer(self, handle):
+        """Account the duration of an asynchronous lookup to its mount"""
+        timer = self.lookup_timers.pop(handle, None)
+        if timer is not None:
+            self.mounts.end(*timer)
+
+    def cache_labels(self, file_path, labels):
+        """Remember labels in the label cache, which stats files, on local mounts only"""
+        if self.mounts.get_mode(file_path)[0] == 'sync':
+            self.label_cache.put(file_path, labels)
+
+    def peek_labels(self, file_path):
+        """Return (found, labels) known without any file system access"""
+        entry = self.deferred_labels.get(file_path)
+        if entry is not None and time.monotonic() - entry[0] <= self.DEFERRED_LIFETIME:
+            return True, entry[1]
+        prefetched = self.prefetcher.peek(file_path)
+        if prefetched is not None and prefetched[0]:
+            return prefetched
+        return False, None
+
+    def remember_deferred(self, file_path, labels):
+        """Keep labels read on a slow mount for a while"""
+        self.deferred_labels[file_path] = (time.monotonic(), labels or 0)
+        self.deferred_labels.move_to_end(file_path)
+        while len(self.deferred_labels) > self.DEFERRED_CACHE_SIZE:
+            self.deferred_labels.popitem(last=False)
+
+    def read_deferred(self, file, file_path, mount_point):
+        """Show the labels known so far, otherwise read them on a worker of the mount"""
+        found, labels = self.peek_labels(file_path)
+        if found:
+            self.add_label_emblems(file, labels)
+            return
+        if file_path in self.deferred_reads:
+            return
+
+        self.deferred_reads.add(file_path)
+        self.mounts.submit(
+            mount_point,
+            lambda: self.backend.read(file_path),
+            lambda labels, error: self.on_deferred_read(file, file_path, labels, error)
+        )
+
+    def on_deferred_read(self, file, file_path, labels, error):
+        """Keep labels read on a worker and have them shown (main loop)"""
+        self.deferred_reads.discard(file_path)
+        if error is not None:
+            print(f"Error reading labels: {error}")
+            return
+        self.remember_deferred(file_path, labels)
+        if labels:
+            # Asks for update_file_info again, which finds the labels
+            file.invalidate_extension_info()
 
     def update_file_info(self, file):
         """Reload emblems from metadata on each display"""
         try:
-            uri = file.get_uri()
-            if not uri.startswith('file://'):
+            file_path = get_file_path(file)
+            if not file_path:
                 return
 
-            file_path = unquote(uri.replace('file://', ''))
-            if not os.path.exists(file_path):
+            mode, mount_point = self.mounts.get_mode(file_path)
+            if mode == 'skip':
+                return
+            if mode != 'sync':
+                # Never wait for a slow mount in the main loop
+                self.read_deferred(file, file_path, mount_point)
                 return
 
-            # Get emblem from metadata
-            file_gio = Gio.File.new_for_path(file_path)
-            info = file_gio.query_info(
-                'metadata::emblems',
-                Gio.FileQueryInfoFlags.NONE,
-                None
-            )
-            emblem = info.get_attribute_as_string('metadata::emblems')
+            # Get labels from the label cache, then the directory snapshot
+            found, labels = self.label_cache.get(file_path)
+            if not found:
+                found, labels = self.prefetcher.lookup(file_path)
 
-            if emblem:
-                file.add_emblem(emblem)
+            if not found:
+                if not os.path.exists(file_path):
+                    return
 
-        except Exception as e:
-            print(f"Error updating file info: {e}")
+                # Get labels from label storage
+                labels = self.backend.read(file_path)
+
+            self.label_cache.put(file_path, labels)
 
-def main():
-    pass
+            self.add_label_emblems(file, labels)
 
-if __name__ == "__main__":
-    main()
+        except Exception as e:
+            print(f"Error updating file info: {e}")
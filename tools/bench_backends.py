@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Benchmark the read and write throughput of the label storage backends
+For each backend, labels a tree of files (100 files per folder), then times
+reading every label one file at a time, one folder at a time, and with a
+single read_tree() of the whole tree, as the command line does.
+
+Usage: python3 tools/bench_backends.py [--files 100000] [--backends gvfs xattr sqlite]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from extension import isolate_home, load_core, make_files
+
+def rate(count, seconds):
+    return f"{seconds:8.3f}s {count / seconds:10.0f}/s"
+
+def bench(backend, paths):
+    """Print the write and read times of a backend on the files"""
+    directories = sorted({os.path.dirname(path) for path in paths})
+    root = os.path.dirname(directories[0])
+    masks = [1 << (index % len(backend.labels.emblems)) for index in range(len(paths))]
+
+    start = time.perf_counter()
+    if not all(backend.write_many(list(zip(paths, masks)))):
+        print(f"{backend.name}: writes failed, skipped")
+        return
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    read = [backend.read(path) for path in paths]
+    read_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for directory in directories:
+        backend.read_directory(directory)
+    directory_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    labelled = sum(1 for _ in backend.read_tree(root))
+    tree_time = time.perf_counter() - start
+
+    if read != masks or labelled != len(paths):
+        print(f"{backend.name}: read back wrong labels")
+    print(
+        f"{backend.name:7} write {rate(len(paths), write_time)}  read {rate(len(paths), read_time)}  "
+        f"read_directory {rate(len(paths), directory_time)}  read_tree {rate(len(paths), tree_time)}"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare label storage backends on a large tree")
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--backends', nargs='+', default=['gvfs', 'xattr', 'sqlite'])
+    parser.add_argument('--where', help="folder to create the tree in (gvfs needs one below home)")
+    args = parser.parse_args()
+
+    # Keeps the SQLite database out of the real home folder
+    real_home = os.path.expanduser('~')
+    isolate_home()
+    labels = load_core()
+    where = tempfile.mkdtemp(prefix='bench-backends-', dir=args.where or real_home)
+    print(f"{args.files} files in {where}")
+    try:
+        for name in args.backends:
+            backend = labels.LABEL_BACKENDS[name](
+                color_info['emblem'] for color_info in labels.PALETTE.values()
+            )
+            tree = os.path.join(where, name)
+            bench(backend, make_files(tree, args.files))
+            shutil.rmtree(tree)
+    finally:
+        shutil.rmtree(where, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark the folder copy of the Duplicate extension against shutil.copytree
+Copies a few generated trees with both, each copy timed up to the end of a
+sync so write-back isn't left out, and fails when the extension is slower
+than shutil by more than the tolerance on any of them.
+
+Usage: python3 tools/bench_copytree.py [--where DIR] [--runs N] [--tolerance 0.1] [--trees NAME...]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+
+from extension import load_extension
+
+# Name -> (folders, files per folder, file size)
+TREES = {
+    'small': (10, 20, 4096),
+    'node_modules': (1200, 17, 6 * 1024),
+    'large_files': (2, 10, 16 * 1024 * 1024),
+}
+
+def make_tree(root, folders, files, size):
+    """Create folders of files of random content"""
+    data = os.urandom(size)
+    for folder in range(folders):
+        directory = os.path.join(root, f'pkg{folder}', 'lib')
+        os.makedirs(directory)
+        for index in range(files):
+            with open(os.path.join(directory, f'f{index}.js'), 'wb') as file:
+                # Different content, so no file system can share blocks
+                file.write(index.to_bytes(8, 'little') + data[8:])
+
+def copy_with_engine(engine, duplicate, source, destination):
+    job = duplicate.DuplicateJob([source])
+    job.measures[source] = engine.measure(job, source)
+    os.mkdir(destination)
+    engine.copy_tree(job, source, destination)
+
+def copy_with_shutil(engine, duplicate, source, destination):
+    shutil.copytree(source, destination, symlinks=True)
+
+def time_copy(copy, engine, duplicate, source, where):
+    """Return the seconds a copy takes, up to the end of a sync"""
+    destination = os.path.join(where, 'copy')
+    os.sync()
+    start = time.perf_counter()
+    copy(engine, duplicate, source, destination)
+    os.sync()
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(destination)
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the Duplicate folder copy with shutil.copytree")
+    parser.add_argument('--where', help="folder to copy in, on the device to measure")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="slowdown accepted against shutil, 0.1 for 10%%")
+    parser.add_argument('--trees', nargs='+', default=list(TREES), choices=list(TREES))
+    parser.add_argument('--file-manager', default='Nautilus', choices=('Nautilus', 'Nemo'))
+    args = parser.parse_args()
+
+    duplicate = load_extension('Duplicate', args.file_manager)
+    where = tempfile.mkdtemp(prefix='bench-copytree-', dir=args.where)
+    # One engine, as the extension keeps it for its lifetime
+    engine = duplicate.DuplicateEngine('bench')
+    print(f"{where}: {os.cpu_count()} CPUs, {engine.get_copy_workers(where)} copy threads")
+
+    regressions = 0
+    try:
+        for name in args.trees:
+            folders, files, size = TREES[name]
+            source = os.path.join(where, name)
+            make_tree(source, folders, files, size)
+            # Alternate, so neither always runs on a cache warmed by the other
+            engine_times = []
+            shutil_times = []
+            for run in range(args.runs):
+                engine_times.append(time_copy(copy_with_engine, engine, duplicate, source, where))
+                shutil_times.append(time_copy(copy_with_shutil, engine, duplicate, source, where))
+            shutil.rmtree(source)
+
+            ratio = min(engine_times) / min(shutil_times)
+            print(
+                f"{name:14} {folders * files:6} files  "
+                f"shutil best {min(shutil_times):.3f}s median {statistics.median(shutil_times):.3f}s  "
+                f"extension best {min(engine_times):.3f}s median {statistics.median(engine_times):.3f}s  "
+                f"x{ratio:.2f}"
+            )
+            if ratio > 1 + args.tolerance:
+                regressions += 1
+    finally:
+        shutil.rmtree(where, ignore_errors=True)
+
+    if regressions:
+        print(f"FAIL: slower than shutil.copytree on {regressions} trees")
+        return 1
+    print("OK")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
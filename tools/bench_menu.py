@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Benchmark the Label context menu for selections of 1, 1k and 100k files
+Times get_file_items, as called on each right click, and the memory it
+allocates, the selection itself excluded. Neither should grow with the
+number of files selected.
+
+Usage: python3 tools/bench_menu.py [--sizes 1 1000 100000] [--file-manager Nemo]
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import tracemalloc
+
+from extension import isolate_home, load_extension, make_files
+
+class SelectedFile:
+    """Stands in for a file manager FileInfo"""
+
+    def __init__(self, path):
+        self.uri = 'file://' + path
+
+    def get_uri(self):
+        return self.uri
+
+class Window:
+    """Stands in for a Nemo window"""
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the Label menu for growing selections")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 1000, 100000])
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--file-manager', default='Nautilus', choices=('Nautilus', 'Nemo'))
+    args = parser.parse_args()
+
+    home = isolate_home()
+    labels = load_extension('Labels', args.file_manager)
+    labels.ColorLabelsExtension.ensure_emblems_exist = lambda self: None
+    extension = labels.ColorLabelsExtension()
+    window = Window()
+
+    def show_menu(files):
+        if args.file_manager == 'Nemo':
+            return extension.get_file_items(window, files)
+        return extension.get_file_items(files)
+
+    paths = make_files(os.path.join(home, 'files'), max(args.sizes), per_directory=1000)
+    for size in args.sizes:
+        files = [SelectedFile(path) for path in paths[:size]]
+        show_menu(files)
+
+        times = []
+        for run in range(args.runs):
+            start = time.perf_counter()
+            show_menu(files)
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        show_menu(files)
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(
+            f"{size:7} files: median {statistics.median(times) * 1000:8.3f} ms, "
+            f"max {max(times) * 1000:8.3f} ms, peak allocation {allocated / 1024:7.1f} KiB"
+        )
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
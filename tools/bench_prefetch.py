@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Benchmark label lookups one file at a time against directory prefetching
+For folders of 1k, 10k and 100k files, one in ten labelled, reads the labels
+of every file with one backend query per file, then through the
+DirectoryEmblemPrefetcher the extensions use, which reads the folder once.
+
+Usage: python3 tools/bench_prefetch.py [--sizes 1000 10000 100000] [--backend gvfs]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from extension import isolate_home, load_core
+
+def make_folder(backend, directory, count):
+    """Create count files, label one in ten, returns their paths"""
+    os.makedirs(directory)
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, f'f{index:07d}')
+        open(path, 'w').close()
+        paths.append(path)
+    masks = [1 << (index // 10 % len(backend.labels.emblems)) for index in range(0, count, 10)]
+    backend.write_many(list(zip(paths[::10], masks)))
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-file label reads with directory prefetching")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--backend', default='gvfs', help="gvfs, xattr or sqlite")
+    parser.add_argument('--where', help="folder to create the files in (gvfs needs one below home)")
+    args = parser.parse_args()
+
+    # The sqlite backend keeps its database in the home folder
+    home = isolate_home() if args.backend == 'sqlite' else None
+    labels = load_core()
+    backend = labels.LABEL_BACKENDS[args.backend](
+        color_info['emblem'] for color_info in labels.PALETTE.values()
+    )
+    where = tempfile.mkdtemp(prefix='bench-prefetch-', dir=args.where or home or os.path.expanduser('~'))
+    print(f"{args.backend} backend, in {where}")
+
+    try:
+        for size in args.sizes:
+            paths = make_folder(backend, os.path.join(where, str(size)), size)
+
+            start = time.perf_counter()
+            per_file = [backend.read(path) for path in paths]
+            per_file_time = time.perf_counter() - start
+
+            prefetcher = labels.DirectoryEmblemPrefetcher(backend)
+            start = time.perf_counter()
+            prefetched = [prefetcher.lookup(path)[1] for path in paths]
+            prefetch_time = time.perf_counter() - start
+
+            if per_file != prefetched:
+                print(f"FAIL: prefetched labels differ for {size} files")
+                return 1
+            print(
+                f"{size:7} files: per file {per_file_time:8.3f}s ({size / per_file_time:9.0f}/s)  "
+                f"prefetch {prefetch_time:8.3f}s ({size / prefetch_time:9.0f}/s)  "
+                f"x{per_file_time / prefetch_time:.1f}"
+            )
+            shutil.rmtree(os.path.join(where, str(size)))
+    finally:
+        shutil.rmtree(where, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
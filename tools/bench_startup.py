@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Benchmark the startup latency of the Labels extension
+Times the import of the extension and its constructor, as run by the file
+manager before the first window: cold, without emblems or stamp file, then
+warm. The emblem provisioning the cold start defers to an idle callback and
+a thread is timed apart, it isn't on the startup path.
+
+Usage: python3 tools/bench_startup.py [--runs 20] [--file-manager Nemo]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import contextlib
+import statistics
+
+from extension import isolate_home, load_extension, run_main_loop
+
+def summary(times):
+    return f"median {statistics.median(times) * 1000:7.2f} ms, max {max(times) * 1000:7.2f} ms"
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the Labels extension constructor")
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--file-manager', default='Nautilus', choices=('Nautilus', 'Nemo'))
+    args = parser.parse_args()
+
+    home = isolate_home()
+    start = time.perf_counter()
+    labels = load_extension('Labels', args.file_manager)
+    print(f"import {(time.perf_counter() - start) * 1000:.2f} ms")
+    extension_class = labels.ColorLabelsExtension
+
+    cold = []
+    warm = []
+    provisioning = []
+    try:
+        for run in range(args.runs):
+            # Nothing provisioned yet
+            shutil.rmtree(os.path.join(home, '.local', 'share', 'icons'), ignore_errors=True)
+            shutil.rmtree(extension_class.EMBLEM_STAMP_DIR, ignore_errors=True)
+            start = time.perf_counter()
+            extension = extension_class()
+            cold.append(time.perf_counter() - start)
+
+            stamp = extension.emblem_stamp()
+            start = time.perf_counter()
+            # Without the progress printed for every icon
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                provisioned = run_main_loop(stamp.exists, timeout=60)
+            if not provisioned:
+                print("FAIL: emblems weren't provisioned")
+                return 1
+            provisioning.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            extension_class()
+            warm.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    print(f"cold constructor      {summary(cold)}")
+    print(f"warm constructor      {summary(warm)}")
+    print(f"deferred provisioning {summary(provisioning)}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Check that GvfsMetadataReader reads the labels gvfs reports
+Without argument, labels files in a new folder of the home folder with
+`gio set`, `gio remove` and `gio move`, then compares what the reader finds in
+~/.local/share/gvfs-metadata with `gio info -a metadata::emblems`. The first
+labels are written to the tree file (gvfsd-metadata rewrites it about a
+minute after the last change), the others stay in its journal. With --record,
+the database and what gio reported are saved as a fixture.
+
+Given a fixture folder instead, replays it without gvfs.
+
+Usage:
+  python3 tools/check_gvfs_reader.py [--record DIR]
+  python3 tools/check_gvfs_reader.py tools/fixtures/gvfs-metadata/synthetic
+
+Record in a throwaway session, so no other metadata of yours ends up in the
+fixture:
+  HOME=$(mktemp -d) dbus-run-session -- python3 tools/check_gvfs_reader.py --record DIR
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+from extension import load_core
+
+KEY = 'metadata::emblems'
+# Seconds to wait for gvfsd-metadata to write its journal into the tree
+ROTATE_TIMEOUT = 150
+
+def gio(*args):
+    """Run gio, returns its output"""
+    return subprocess.run(['gio', *args], check=True, capture_output=True, text=True).stdout
+
+def gio_emblems(path):
+    """Return the emblems gio reports for a file, as a list"""
+    for line in gio('info', '-a', KEY, path).splitlines():
+        line = line.strip()
+        if line.startswith(KEY + ':'):
+            value = line[len(KEY) + 1:].strip()
+            if value.startswith('[') and value.endswith(']'):
+                return [emblem.strip() for emblem in value[1:-1].split(',') if emblem.strip()]
+            return [value] if value else []
+    return []
+
+def read_tag(tree):
+    """Return the tag of a tree file, which changes when the journal is written into it"""
+    try:
+        with open(tree, 'rb') as f:
+            return struct.unpack('>I', f.read(16)[12:16])[0]
+    except (OSError, struct.error):
+        return None
+
+def wait_for_rotation(tree, tag):
+    """Wait until gvfsd-metadata writes a new tree, returns False on timeout"""
+    deadline = time.monotonic() + ROTATE_TIMEOUT
+    while time.monotonic() < deadline:
+        if read_tag(tree) not in (None, tag):
+            return True
+        time.sleep(1)
+    return False
+
+def label_with_gio(root, directory):
+    """Label files under root through gvfs, returns {relative path: emblems} from gio info"""
+    tree = directory / 'home'
+    for name in ('a.txt', 'b.txt', 'other.txt', 'gone.txt', 'moved.txt', 'new.txt',
+                 'sub/c.txt', 'sub/deep/d.txt'):
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Path(path).touch()
+
+    # Written to the tree once gvfsd-metadata rotates its journal
+    tag = read_tag(tree)
+    gio('set', '-t', 'stringv', f'{root}/a.txt', KEY, 'label-mint', 'label-grape')
+    gio('set', f'{root}/b.txt', KEY, 'label-orange')
+    gio('set', f'{root}/other.txt', 'metadata::custom-icon-name', 'folder')
+    gio('set', '-t', 'stringv', f'{root}/gone.txt', KEY, 'label-blueberry')
+    gio('set', '-t', 'stringv', f'{root}/moved.txt', KEY, 'label-grape')
+    gio('set', '-t', 'stringv', f'{root}/sub/c.txt', KEY, 'label-banana')
+    gio('set', '-t', 'stringv', f'{root}/sub/deep/d.txt', KEY, 'label-strawberry')
+    print("Waiting for gvfsd-metadata to write its tree...")
+    if not wait_for_rotation(tree, tag):
+        print("The tree wasn't rewritten, every label is read from the journal")
+
+    # Left in the journal
+    gio('set', '-t', 'stringv', f'{root}/new.txt', KEY, 'label-orange', 'label-mint')
+    gio('set', f'{root}/b.txt', KEY, 'label-banana')
+    gio('set', '-t', 'unset', f'{root}/sub/c.txt', KEY)
+    gio('remove', f'{root}/gone.txt')
+    gio('move', f'{root}/moved.txt', f'{root}/renamed.txt')
+
+    files = {}
+    for folder, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(folder, name)
+            files[os.path.relpath(path, root)] = gio_emblems(path)
+    # Gone, gvfs must have dropped their labels
+    files['gone.txt'] = []
+    files['moved.txt'] = []
+    return files
+
+def record(directory, fixture, home, root, files):
+    """Save the metadata database and the labels gio reported"""
+    tag = read_tag(directory / 'home')
+    journal = directory / f'home-{tag:08x}.log'
+    # The last changes must still be in the journal, or its replay isn't covered
+    if not journal.exists():
+        raise SystemExit(f"{journal} doesn't exist, the journal was written into the tree")
+    os.makedirs(fixture, exist_ok=True)
+    shutil.copy(directory / 'home', fixture)
+    shutil.copy(journal, fixture)
+    with open(os.path.join(fixture, 'expected.json'), 'w') as f:
+        json.dump({'home': home, 'root': root, 'files': files}, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def fixture_reader(labels, fixture, home):
+    """Return a reader of a fixture, which maps the home folder of the recording to its home tree"""
+
+    class FixtureReader(labels.GvfsMetadataReader):
+        def find_tree(self, file_path):
+            if file_path == home or file_path.startswith(home + os.sep):
+                return 'home', home
+            return None, None
+
+    return FixtureReader(fixture)
+
+def check(reader, root, files):
+    """Compare the reader with the expected labels, returns the number of differences"""
+    errors = 0
+    for name, emblems in sorted(files.items()):
+        found, read = reader.lookup(os.path.join(root, name))
+        if not found or (read or []) != emblems:
+            print(f"{name}: lookup read {read if found else 'nothing'}, expected {emblems}")
+            errors += 1
+
+    expected = {os.path.join(root, name): emblems for name, emblems in files.items() if emblems}
+    subtree = dict(reader.read_subtree(root))
+    for path in sorted(set(expected) | set(subtree)):
+        if subtree.get(path) != expected.get(path):
+            print(f"{path}: read_subtree read {subtree.get(path)}, expected {expected.get(path)}")
+            errors += 1
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare GvfsMetadataReader with gio")
+    parser.add_argument('fixture', nargs='?', help="fixture folder to replay instead of using gio")
+    parser.add_argument('--record', metavar='DIR', help="save the database and gio's answers as a fixture")
+    args = parser.parse_args()
+
+    labels = load_core()
+
+    if args.fixture:
+        with open(os.path.join(args.fixture, 'expected.json')) as f:
+            expected = json.load(f)
+        # The paths of the recording don't exist here
+        reader = fixture_reader(labels, args.fixture, expected['home'])
+        root = expected['root']
+        files = expected['files']
+    else:
+        reader = labels.GvfsMetadataReader()
+        root = tempfile.mkdtemp(prefix='color-labels-check-', dir=reader.home)
+        try:
+            files = label_with_gio(root, reader.directory)
+            if args.record:
+                record(reader.directory, args.record, reader.home, root, files)
+        except BaseException:
+            shutil.rmtree(root, ignore_errors=True)
+            raise
+
+    errors = check(reader, root, files)
+    if not args.fixture:
+        shutil.rmtree(root, ignore_errors=True)
+    if errors:
+        print(f"FAIL: {errors} differences")
+        return 1
+    print(f"OK: {len(files)} files")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Check that relabelling many files redraws them in batches without piling up
+inotify watches
+Labels 10,000 files (100 folders) twice, as the Label menu of the extensions
+does: one label write per file, then the file is queued on the RefreshQueue.
+Each file redraws by reading its labels through the directory prefetcher and
+the label cache, as update_file_info does. Each label operation must flush
+the queue in a single idle callback that invalidates every file once. The
+file monitors alive must be the directory monitors kept by the label cache,
+and neither they nor the inotify watches of the process may grow from one
+operation to the next. GLib watches the parent folder of a file monitor, so
+monitors leaked per file only show in the monitor count.
+
+Runs on the shared label code with the real Gio, no file manager needed.
+
+Usage: python3 tools/check_inotify_watches.py [--files N] [--backend NAME]
+"""
+
+import gc
+import os
+import sys
+import argparse
+from collections import Counter
+
+from extension import isolate_home, load_core, run_main_loop, count_inotify_watches, make_files
+
+def count_file_monitors():
+    """Return the number of Gio.FileMonitor objects alive and not cancelled"""
+    from gi.repository import Gio
+
+    return sum(
+        1 for obj in gc.get_objects()
+        if isinstance(obj, Gio.FileMonitor) and not obj.is_cancelled()
+    )
+
+class RedrawnFile:
+    """Stands in for a FileInfo, which reloads its labels when invalidated"""
+
+    def __init__(self, path, redraw):
+        self.uri = 'file://' + path
+        self.path = path
+        self.redraw = redraw
+
+    def get_uri(self):
+        return self.uri
+
+    def invalidate_extension_info(self):
+        self.redraw(self)
+
+def main():
+    parser = argparse.ArgumentParser(description="Count redraws and inotify watches after labelling many files")
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--backend', default='sqlite', help="gvfs, xattr or sqlite")
+    args = parser.parse_args()
+
+    home = isolate_home()
+    labels = load_core()
+    backend = labels.LABEL_BACKENDS[args.backend](
+        color_info['emblem'] for color_info in labels.PALETTE.values()
+    )
+    prefetcher = labels.DirectoryEmblemPrefetcher(backend)
+    label_cache = labels.LabelCache(on_change=prefetcher.forget)
+    refresh_queue = labels.RefreshQueue()
+
+    flushes = []
+    queue_flush = refresh_queue.flush
+
+    def flush():
+        flushes.append(len(refresh_queue.pending))
+        return queue_flush()
+
+    refresh_queue.flush = flush
+
+    invalidations = Counter()
+    shown = {}
+
+    def redraw(file_info):
+        # As update_file_info: label cache first, then the directory snapshot
+        invalidations[file_info.path] += 1
+        found, mask = label_cache.get(file_info.path)
+        if not found:
+            found, mask = prefetcher.lookup(file_info.path)
+            label_cache.put(file_info.path, mask)
+        shown[file_info.path] = mask
+
+    paths = make_files(os.path.join(home, 'files'), args.files)
+    files = [RedrawnFile(path, redraw) for path in paths]
+    folders = len({os.path.dirname(path) for path in paths})
+    limit = labels.LabelCache.MAX_DIRECTORIES
+    before = count_inotify_watches()
+
+    monitors = []
+    watches = []
+    for batch, color_id in enumerate(('orange', 'grape'), 1):
+        mask = backend.labels.from_emblems([labels.PALETTE[color_id]['emblem']])
+        flushes.clear()
+        for file_info in files:
+            # As show_color_label after each write
+            if not backend.write(file_info.path, mask):
+                print(f"FAIL: couldn't label {file_info.path}")
+                return 1
+            prefetcher.update(file_info.path, mask)
+            label_cache.invalidate(file_info.path)
+            refresh_queue.add(file_info)
+
+        if not run_main_loop(lambda: flushes and not refresh_queue.source_id, timeout=300):
+            print(f"FAIL: the refresh queue wasn't flushed for {color_id}")
+            return 1
+        # Let monitor events of the writes come in, they must not redraw
+        run_main_loop(lambda: False, timeout=0.5)
+
+        monitors.append(count_file_monitors())
+        watches.append(count_inotify_watches() - before)
+        print(
+            f"{color_id}: {len(files)} files in {folders} folders, {len(flushes)} flushes, "
+            f"{monitors[-1]} file monitors, {watches[-1]} inotify watches (limit {limit})"
+        )
+        if flushes != [len(files)]:
+            print(f"FAIL: expected a single flush of {len(files)} files, got {len(flushes)} flushes")
+            return 1
+        if set(invalidations.values()) != {batch}:
+            print(f"FAIL: files weren't invalidated exactly once per operation: {Counter(invalidations.values())}")
+            return 1
+        if any(shown[path] != mask for path in paths):
+            print(f"FAIL: some files were redrawn without {color_id}")
+            return 1
+        if monitors[-1] != len(label_cache.directories):
+            print(f"FAIL: {monitors[-1]} file monitors alive, the label cache keeps {len(label_cache.directories)}")
+            return 1
+        if monitors[-1] > limit or watches[-1] > limit:
+            print("FAIL: more directory monitors than the label cache keeps")
+            return 1
+
+    if monitors[-1] > monitors[0] or watches[-1] > watches[0]:
+        print(f"FAIL: file monitors grew from {monitors[0]} to {monitors[-1]}, "
+              f"inotify watches from {watches[0]} to {watches[-1]}")
+        return 1
+    print("OK")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Check that duplicating a sparse file keeps its holes
+Creates a 1 GiB file holding three 3 MiB data extents, duplicates it with the
+Duplicate extension, once as the extension does and once per copy tier, and
+checks that the duplicate has the same content and takes about as many
+blocks as the source.
+
+Usage: python3 tools/check_sparse_duplicate.py [--where DIR] [--file-manager Nemo]
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+from extension import isolate_home, load_extension
+
+SIZE = 1 << 30
+EXTENTS = (0, 300 << 20, (700 << 20) + 123)
+EXTENT_SIZE = 3 << 20
+# Blocks of 512 bytes the duplicate may take beyond the source, for file system rounding
+SLACK_BLOCKS = 64
+
+def make_sparse_file(path):
+    with open(path, 'wb') as f:
+        f.truncate(SIZE)
+        for offset in EXTENTS:
+            f.seek(offset)
+            f.write(os.urandom(EXTENT_SIZE))
+
+def digest(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def compare(name, source, duplicate, tiers):
+    """Print how a duplicate compares to its source, returns False if it doesn't match"""
+    source_status = os.stat(source)
+    status = os.stat(duplicate)
+    same = digest(source) == digest(duplicate)
+    small = status.st_blocks <= source_status.st_blocks + SLACK_BLOCKS
+    print(
+        f"{name:28} size {status.st_size} blocks {status.st_blocks} (source {source_status.st_blocks}) "
+        f"tiers {', '.join(sorted(tiers)) or '?'}: "
+        f"{'same content' if same else 'CONTENT DIFFERS'}, {'holes kept' if small else 'HOLES FILLED'}"
+    )
+    return same and small and status.st_size == source_status.st_size
+
+def main():
+    parser = argparse.ArgumentParser(description="Duplicate a sparse file and check its holes are kept")
+    parser.add_argument('--where', help="folder on the file system to check")
+    parser.add_argument('--file-manager', default='Nautilus', choices=('Nautilus', 'Nemo'))
+    args = parser.parse_args()
+
+    where = tempfile.mkdtemp(prefix='check-sparse-', dir=args.where)
+    # Staging markers go to a throwaway home
+    isolate_home()
+    duplicate = load_extension('Duplicate', args.file_manager)
+    source = os.path.join(where, 'disk.img')
+    ok = True
+    try:
+        make_sparse_file(source)
+        if os.stat(source).st_blocks * 512 >= SIZE:
+            print("This file system doesn't keep holes, nothing to check")
+            return 0
+
+        # As the extension duplicates: staging copy, sync, then rename
+        engine = duplicate.DuplicateEngine('check')
+        job = duplicate.DuplicateJob([source])
+        job.measures[source] = engine.measure(job, source)
+        before = set(os.listdir(where))
+        engine.duplicate_single_file(job, source)
+        copy, = set(os.listdir(where)) - before
+        ok &= compare('duplicate', source, os.path.join(where, copy), job.tiers)
+        os.unlink(os.path.join(where, copy))
+
+        # Each copy tier on its own, the faster ones marked as unsupported
+        device = os.stat(where).st_dev
+        for skipped in range(len(engine.TIERS)):
+            engine = duplicate.DuplicateEngine('check')
+            engine.unsupported = {(tier, (device, device)) for tier in engine.TIERS[:skipped]}
+            job = duplicate.DuplicateJob([source])
+            destination = os.path.join(where, 'copy.img')
+            open(destination, 'wb').close()
+            engine.copy_file(job, source, destination)
+            ok &= compare(f'from {engine.TIERS[skipped]}', source, destination, job.tiers)
+            os.unlink(destination)
+    finally:
+        shutil.rmtree(where, ignore_errors=True)
+
+    print("OK" if ok else "FAIL")
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Helpers shared by the check and benchmark scripts of this folder
+Load an extension (Labels-Nemo.py, Duplicate-Nautilus.py...) or the shared
+label code (Common/color_labels_core.py) outside the file manager, run the
+GLib main loop and look at the process' inotify watches. Needs PyGObject, and
+for the extensions the typelib of the file manager (gir1.2-nautilus-4.0 or
+gir1.2-nemo-3.0).
+"""
+
+import os
+import sys
+import time
+import tempfile
+import importlib
+import importlib.util
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+# Installed next to the extensions, which import it
+COMMON = ROOT / 'Common'
+
+def isolate_home():
+    """Point HOME to a new temporary folder, so no real label or index is touched
+
+    Must be called before an extension is loaded: its database paths are
+    computed from the home folder at import time.
+    """
+    home = tempfile.mkdtemp(prefix='color-labels-home-')
+    os.environ['HOME'] = home
+    os.environ['XDG_DATA_HOME'] = os.path.join(home, '.local', 'share')
+    os.environ['XDG_CONFIG_HOME'] = os.path.join(home, '.config')
+    return home
+
+def load_extension(name, file_manager):
+    """Import an extension file, e.g. load_extension('Labels', 'Nemo')"""
+    # The file managers put the extension folder on the module path
+    if str(COMMON) not in sys.path:
+        sys.path.insert(0, str(COMMON))
+    path = ROOT / file_manager / f'{name}-{file_manager}.py'
+    module_name = f'{name.lower()}_{file_manager.lower()}'
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def load_core():
+    """Import the label code shared by the extensions, without any file manager"""
+    if str(COMMON) not in sys.path:
+        sys.path.insert(0, str(COMMON))
+    return importlib.import_module('color_labels_core')
+
+def run_main_loop(done, timeout=60.0):
+    """Dispatch GLib events until done() is true, return False on timeout"""
+    from gi.repository import GLib
+
+    context = GLib.MainContext.default()
+    deadline = time.monotonic() + timeout
+    while not done():
+        if time.monotonic() > deadline:
+            return False
+        if not context.iteration(False):
+            time.sleep(0.005)
+    return True
+
+def count_inotify_watches():
+    """Return the number of inotify watches held by this process"""
+    watches = 0
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            if os.readlink(f'/proc/self/fd/{fd}') != 'anon_inode:inotify':
+                continue
+            with open(f'/proc/self/fdinfo/{fd}') as fdinfo:
+                watches += sum(1 for line in fdinfo if line.startswith('inotify wd:'))
+        except OSError:
+            continue
+    return watches
+
+def make_files(root, count, per_directory=100):
+    """Create count empty files spread over folders of per_directory files"""
+    paths = []
+    for index in range(count):
+        directory = os.path.join(root, f'd{index // per_directory:05d}')
+        if index % per_directory == 0:
+            os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'f{index:07d}')
+        with open(path, 'w'):
+            pass
+        paths.append(path)
+    return paths
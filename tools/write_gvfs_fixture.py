@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Write the synthetic gvfs metadata fixture used by check_gvfs_reader.py
+The tree and journal are laid out after the structures of gvfs' metabuilder.c
+and metatree.c (MetaFileHeader, MetaJournalHeader, MetaJournalEntry), for
+machines without gvfsd-metadata. The expected labels are written by hand.
+Built from the same reading of gvfs as the reader, this fixture can't catch a
+misreading of the format: record one with `check_gvfs_reader.py --record`
+where gvfs is installed.
+
+Usage: python3 tools/write_gvfs_fixture.py [DIR]
+"""
+
+import os
+import sys
+import json
+import zlib
+import struct
+
+HOME = '/home/user'
+ROOT = HOME + '/Labels'
+TAG = 0x5eed0001
+
+# Tree path -> {key: value}, a list for stringv values
+TREE = {
+    '/Labels/a.txt': {'emblems': ['label-mint', 'label-grape']},
+    '/Labels/b.txt': {'emblems': 'label-orange'},
+    '/Labels/other.txt': {'custom-icon-name': 'folder'},
+    '/Labels/gone.txt': {'emblems': ['label-blueberry']},
+    '/Labels/moved.txt': {'emblems': ['label-grape']},
+    '/Labels/sub/c.txt': {'emblems': ['label-banana']},
+    '/Labels/sub/deep/d.txt': {'emblems': ['label-strawberry']},
+    '/Other/x.txt': {'emblems': ['label-mint']},
+}
+KEYS = ['custom-icon-name', 'emblems']
+
+# Journal operations written after the tree
+SET_KEY, SETV_KEY, UNSET_KEY, COPY_PATH, REMOVE_PATH = range(5)
+JOURNAL = [
+    (SETV_KEY, '/Labels/new.txt', 'emblems', ['label-orange', 'label-mint']),
+    (SET_KEY, '/Labels/b.txt', 'emblems', 'label-banana'),
+    (UNSET_KEY, '/Labels/sub/c.txt', 'emblems'),
+    (REMOVE_PATH, '/Labels/gone.txt'),
+    (COPY_PATH, '/Labels/renamed.txt', '/Labels/moved.txt'),
+    (REMOVE_PATH, '/Labels/moved.txt'),
+]
+# Torn last write, counted in the header but with a wrong checksum: gvfs stops
+# at it, so a.txt keeps its labels
+TORN = (SETV_KEY, '/Labels/a.txt', 'emblems', ['label-cocoa'])
+
+# What gio info reports once the journal is applied, relative to ROOT
+EXPECTED = {
+    'a.txt': ['label-mint', 'label-grape'],
+    'b.txt': ['label-banana'],
+    'other.txt': [],
+    'gone.txt': [],
+    'moved.txt': [],
+    'renamed.txt': ['label-grape'],
+    'new.txt': ['label-orange', 'label-mint'],
+    'sub/c.txt': [],
+    'sub/deep/d.txt': ['label-strawberry'],
+}
+
+class TreeWriter:
+    """Build a metadata tree file: header, key table, then directory entries"""
+
+    def __init__(self):
+        self.data = bytearray(32)
+
+    def add(self, chunk):
+        """Append 4-byte aligned data, returns its offset"""
+        while len(self.data) % 4:
+            self.data.append(0)
+        offset = len(self.data)
+        self.data += chunk
+        return offset
+
+    def add_string(self, string):
+        return self.add(string.encode() + b'\0')
+
+    def add_entry(self, name, node):
+        """Write a directory entry and its children, returns its (name, children, data, mtime)"""
+        name_offset = self.add_string(name)
+        children_offset = 0
+        if node['children']:
+            # Children are sorted by name, as gvfs searches them with bsearch
+            children = [
+                self.add_entry(child_name, child)
+                for child_name, child in sorted(node['children'].items(), key=lambda item: item[0].encode())
+            ]
+            children_offset = self.add(
+                struct.pack('>I', len(children))
+                + b''.join(struct.pack('>IIII', *child) for child in children)
+            )
+        data_offset = 0
+        if node['values']:
+            values = []
+            for key, value in sorted(node['values'].items(), key=lambda item: KEYS.index(item[0])):
+                key_id = KEYS.index(key)
+                if isinstance(value, list):
+                    strings = [self.add_string(string) for string in value]
+                    values.append((key_id | 1 << 31, self.add(
+                        struct.pack('>I', len(strings)) + b''.join(struct.pack('>I', s) for s in strings)
+                    )))
+                else:
+                    values.append((key_id, self.add_string(value)))
+            data_offset = self.add(
+                struct.pack('>I', len(values)) + b''.join(struct.pack('>II', *value) for value in values)
+            )
+        return name_offset, children_offset, data_offset, 0
+
+    def build(self, entries):
+        root = {'children': {}, 'values': {}}
+        for path, values in entries.items():
+            node = root
+            for part in filter(None, path.split('/')):
+                node = node['children'].setdefault(part, {'children': {}, 'values': {}})
+            node['values'].update(values)
+
+        keys = [self.add_string(key) for key in KEYS]
+        attributes = self.add(struct.pack('>I', len(keys)) + b''.join(struct.pack('>I', key) for key in keys))
+        root_offset = self.add(struct.pack('>IIII', *self.add_entry('/', root)))
+        # Magic, version 1.0, not rotated, tag, root, attributes, time
+        self.data[0:32] = b'\xda\x1ameta\x01\x00' + struct.pack('>IIIIQ', 0, TAG, root_offset, attributes, 0)
+        return bytes(self.data)
+
+def build_journal(operations, torn=None, size=4096):
+    """Build a journal: header, then entries framed by their size on both ends"""
+    # MetaJournalHeader: magic, version 1.0, tag, file size, number of entries (20 bytes)
+    count = len(operations) + (torn is not None)
+    data = bytearray(b'\xda\x1ajour\x01\x00' + struct.pack('>III', TAG, size, count))
+    for operation in operations + ([torn] if torn else []):
+        entry_type, path = operation[:2]
+        entry = bytearray(struct.pack('>IIQ', 0, 0, 0)) + bytes([entry_type]) + path.encode() + b'\0'
+        if entry_type == SET_KEY:
+            entry += operation[2].encode() + b'\0' + operation[3].encode() + b'\0'
+        elif entry_type == SETV_KEY:
+            entry += operation[2].encode() + b'\0'
+            entry += bytes(-len(entry) % 4)
+            entry += struct.pack('>I', len(operation[3])) + b''.join(s.encode() + b'\0' for s in operation[3])
+        elif entry_type in (UNSET_KEY, COPY_PATH):
+            entry += operation[2].encode() + b'\0'
+        entry += bytes(-len(entry) % 4)
+        entry_size = len(entry) + 4
+        entry[0:4] = struct.pack('>I', entry_size)
+        entry += struct.pack('>I', entry_size)
+        # Checksum of everything after itself
+        entry[4:8] = struct.pack('>I', zlib.crc32(entry[8:]) ^ (operation is torn))
+        data += entry
+    return bytes(data + bytes(size - len(data)))
+
+def main():
+    fixture = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'gvfs-metadata', 'synthetic'
+    )
+    os.makedirs(fixture, exist_ok=True)
+    with open(os.path.join(fixture, 'home'), 'wb') as f:
+        f.write(TreeWriter().build(TREE))
+    with open(os.path.join(fixture, f'home-{TAG:08x}.log'), 'wb') as f:
+        f.write(build_journal(JOURNAL, TORN))
+    with open(os.path.join(fixture, 'expected.json'), 'w') as f:
+        json.dump({'home': HOME, 'root': ROOT, 'files': EXPECTED}, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print(f"Wrote {fixture}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())